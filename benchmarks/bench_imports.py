@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""Import-time report of the bot and planner entry points.
+
+Imports each module in a fresh interpreter with `python -X importtime` and
+reports the total import time, the packages that cost the most and the
+peak RSS after import, as JSON.
+
+    python benchmarks/bench_imports.py
+    python benchmarks/bench_imports.py --modules bot processing.planner --top 15 --output imports.json
+    python benchmarks/bench_imports.py --compare old.json
+"""
+import argparse
+import json
+import os
+import platform
+import re
+import subprocess
+import sys
+import time
+
+# Make sure we can import from the project
+project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, project_root)
+
+from benchmarks.bench_planner import git_commit  # noqa: E402
+
+LINE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)")
+
+# Stampa il picco di RSS in byte dopo l'import (ru_maxrss è in KB su Linux, in byte su macOS)
+SCRIPT = ("import resource, sys; import {module}; rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss; "
+          "print(rss if sys.platform == 'darwin' else rss * 1024)")
+
+
+def import_once(module):
+    """Return (import time report lines, peak RSS in bytes) of one fresh import."""
+    env = dict(os.environ, PYTHONPATH=project_root)
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", SCRIPT.format(module=module)],
+                          cwd=project_root, env=env, capture_output=True, text=True)
+    if proc.returncode != 0:
+        raise RuntimeError(f"import {module} failed:\n{proc.stderr[-2000:]}")
+    return proc.stderr.splitlines(), int(proc.stdout.split()[-1])
+
+
+def parse(lines, module):
+    """Total microseconds of module and self time summed per top-level package."""
+    total = 0
+    packages = {}
+    for line in lines:
+        match = LINE.match(line)
+        if not match:
+            continue
+        self_us, cumulative_us, _, name = int(match[1]), int(match[2]), match[3], match[4]
+        if name == module:
+            total = cumulative_us
+        package = name.split(".")[0]
+        packages[package] = packages.get(package, 0) + self_us
+    return total, packages
+
+
+def bench_module(module, runs, top):
+    """Best of runs imports, so the first one also warms the bytecode and page caches."""
+    best = None
+    for _ in range(runs):
+        lines, rss = import_once(module)
+        total, packages = parse(lines, module)
+        if best is None or total < best[0]:
+            best = (total, packages, rss)
+    total, packages, rss = best
+    slowest = sorted(packages.items(), key=lambda item: item[1], reverse=True)[:top]
+    return {
+        "module": module,
+        "import_ms": round(total / 1000, 1),
+        "peak_rss_mb": round(rss / 2 ** 20, 1),
+        "packages_ms": {name: round(us / 1000, 1) for name, us in slowest},
+    }
+
+
+def compare(old, new, threshold=1.2):
+    """Print the import time change per module; return how many got slower than threshold."""
+    old_modules = {result["module"]: result for result in old["results"]}
+    regressions = 0
+    for result in new["results"]:
+        before = old_modules.get(result["module"])
+        if not before or before["import_ms"] == 0:
+            continue
+        ratio = result["import_ms"] / before["import_ms"]
+        flag = "REGRESSION" if ratio > threshold else ""
+        regressions += bool(flag)
+        print(f"{result['module']:>24} {before['import_ms']:10.1f} ms -> {result['import_ms']:10.1f} ms  "
+              f"x{ratio:5.2f} {flag}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--modules", nargs="+", default=["bot", "processing.planner"],
+                        help="modules to import, relative to the project root")
+    parser.add_argument("--runs", type=int, default=3, help="imports per module, the fastest is reported")
+    parser.add_argument("--top", type=int, default=10, help="packages listed per module")
+    parser.add_argument("--output", help="write the JSON report here")
+    parser.add_argument("--compare", help="previous JSON report to compare against")
+    args = parser.parse_args(argv)
+
+    report = {
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "results": [bench_module(module, args.runs, args.top) for module in args.modules],
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+    else:
+        print(text)
+
+    if args.compare:
+        with open(args.compare) as f:
+            return 1 if compare(json.load(f), report) else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,464 @@
+#!/usr/bin/env python3
+"""Offline load test of the bot against local stand-ins of every external API.
+
+Starts stand-ins for Telegram, weatherapi.com, Nominatim, Overpass and
+Mistral with the given latencies, runs bot.py in a subprocess pointed at
+them (in a fresh working directory, so caches and state start empty unless
+--workdir is given) and replays synthetic users sending weather, forecast,
+position and route requests at --rate requests per second. Reports as JSON:
+
+- p50/p95/p99 latency per request kind until the bot's first answer and
+  until the final one (the GPX for /route), measured at the Telegram stand-in;
+- handler time, event loop lag, planner queue wait and job time from the
+  bot's metrics endpoint;
+- route quality: success rate, closed loops and length error against the
+  requested distance.
+
+Planner settings (PLANNER_WORKERS, PLANNER_QUEUE_SIZE, ...) are passed to
+the bot from the environment.
+
+    python benchmarks/bench_load.py --rate 2 --duration 120
+    python benchmarks/bench_load.py --mix weather=0.5,route=0.5 --latency overpass=3,mistral=1 --output load.json
+    python benchmarks/bench_load.py --compare old.json
+"""
+import argparse
+import asyncio
+import gzip
+import json
+import logging
+import os
+import platform
+import random
+import re
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+import numpy as np
+
+# Make sure we can import from the project
+project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, project_root)
+
+from benchmarks.bench_planner import git_commit  # noqa: E402
+from benchmarks.standins import (MistralStandIn, NominatimStandIn, OverpassStandIn, TelegramStandIn,  # noqa: E402
+                                 WeatherStandIn, locate)
+
+logger = logging.getLogger("load_test")
+
+KINDS = ("weather", "forecast", "position", "route")
+DEFAULT_MIX = "weather=0.35,forecast=0.2,position=0.25,route=0.2"
+
+# Latenza media in secondi di ogni stand-in
+DEFAULT_LATENCY = "telegram=0.03,weather=0.15,nominatim=0.3,overpass=1.5,mistral=0.8"
+
+CITIES = ("Torino", "Milano", "Genova", "Aosta", "Cuneo", "Asti", "Alessandria", "Novara", "Biella", "Ivrea")
+STREETS = ("Via Roma", "Corso Francia", "Via Po", "Corso Vittorio Emanuele II", "Via Garibaldi", "Via Nizza",
+           "Corso Regina Margherita", "Via Cernaia", "Corso Casale", "Via Sacchi")
+LEVELS = ("beginner", "intermediate", "advanced")
+
+# Risposte che chiudono una richiesta /route senza GPX
+ROUTE_FAILURES = ("❌", "🛑", "⏳ You already")
+
+PERCENTILES = (50, 95, 99)
+
+
+def parse_pairs(text, cast=float):
+    """{"a": 1.0, "b": 2.0} from "a=1,b=2"."""
+    pairs = {}
+    for item in filter(None, (part.strip() for part in text.split(","))):
+        key, value = item.split("=", 1)
+        pairs[key.strip()] = cast(value)
+    return pairs
+
+
+def percentiles(values):
+    if not values:
+        return {f"p{p}": None for p in PERCENTILES}
+    return {f"p{p}": round(float(np.percentile(values, p)), 4) for p in PERCENTILES}
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class Request:
+    """One user message and the bot's answers to it."""
+
+    def __init__(self, kind, user, text=None, location=None, distance_km=None):
+        self.kind = kind
+        self.user = user
+        self.text = text
+        self.location = location
+        self.distance_km = distance_km
+        self.sent = None
+        self.first = None
+        self.last = None
+        self.outcome = None
+        self.caption = None
+        self.gpx = None
+        self.finished = asyncio.Event()
+
+
+class LoadDriver:
+    """Synthetic users, each with at most one request waiting for the bot.
+
+    A request is answered by the first message the bot sends to its chat
+    and finished by the last one: for /route the GPX document or an error,
+    for the other commands the first answer. Users waiting for an answer
+    are not reused, so new users (starting with /start) join when the
+    arrival rate outgrows them.
+    """
+
+    def __init__(self, telegram, mix, route_km, free_form=0.2, timeout=900, seed=0):
+        self.telegram = telegram
+        self.kinds = list(mix)
+        self.weights = [mix[kind] for kind in self.kinds]
+        self.route_km = route_km
+        self.free_form = free_form
+        self.timeout = timeout
+        self.rng = random.Random(seed)
+        self.requests = []
+        self._idle = []
+        self._next_user = 1000
+        self._waiting = {}
+        telegram.on_message = self.on_message
+
+    def on_message(self, chat_id, method, fields, at):
+        request = self._waiting.get(chat_id)
+        if request is None:
+            return
+        if request.first is None:
+            request.first = at
+        text = fields.get("text", "")
+        if method == "sendDocument":
+            filename, data = fields["document"]
+            request.caption = fields.get("caption", "")
+            request.gpx = gzip.decompress(data) if filename.endswith(".gz") else data
+            self._finish(request, "ok", at)
+        elif request.kind != "route":
+            self._finish(request, "error" if text.startswith("❌") else "ok", at)
+        elif text.startswith(ROUTE_FAILURES):
+            self._finish(request, "rejected" if "Too many" in text else "error", at)
+
+    def _finish(self, request, outcome, at):
+        request.outcome = outcome
+        request.last = at
+        self._waiting.pop(request.user, None)
+        request.finished.set()
+
+    def build(self, kind, user):
+        rng = self.rng
+        if kind == "weather":
+            return Request(kind, user, text=f"/weather {rng.choice(CITIES)}")
+        if kind == "forecast":
+            return Request(kind, user, text=f"/forecast {rng.choice(CITIES)}")
+        if kind == "position":
+            lat, lon = locate(f"position {rng.random()}")
+            return Request(kind, user, location=(lat, lon))
+        if kind == "route":
+            address = f"{rng.choice(STREETS)} {rng.randint(1, 150)}, Torino"
+            km, level = rng.choice(self.route_km), rng.choice(LEVELS)
+            if rng.random() < self.free_form:
+                # Testo libero: passa dal modello invece che dal parser locale
+                text = f"/route a {km:g} km {level} ride starting from {address} please"
+            else:
+                text = f"/route {address} {km:g} {level}"
+            return Request(kind, user, text=text, distance_km=km)
+        raise ValueError(f"Unknown request kind {kind}")
+
+    async def send(self, request):
+        self._waiting[request.user] = request
+        request.sent = time.perf_counter()
+        self.telegram.push(self.telegram.message(request.user, request.text, request.location))
+        self.requests.append(request)
+        try:
+            await asyncio.wait_for(request.finished.wait(), self.timeout)
+        except asyncio.TimeoutError:
+            self._waiting.pop(request.user, None)
+            request.outcome = "timeout"
+
+    async def session(self):
+        """One request of a random kind from an idle user, or from a new one after /start."""
+        kind = self.rng.choices(self.kinds, self.weights)[0]
+        if self._idle:
+            user = self._idle.pop()
+        else:
+            user = self._next_user
+            self._next_user += 1
+            await self.send(Request("start", user, text="/start"))
+        await self.send(self.build(kind, user))
+        self._idle.append(user)
+
+    async def run(self, rate, duration):
+        """Start sessions with exponential inter-arrival times, then wait for all of them."""
+        loop = asyncio.get_running_loop()
+        tasks = []
+        end = loop.time() + duration
+        while True:
+            await asyncio.sleep(self.rng.expovariate(rate))
+            if loop.time() >= end:
+                break
+            tasks.append(asyncio.create_task(self.session()))
+        await asyncio.gather(*tasks)
+
+
+def request_report(requests, duration):
+    report = {}
+    for kind in sorted({r.kind for r in requests}):
+        done = [r for r in requests if r.kind == kind]
+        answered = [r for r in done if r.first is not None]
+        outcomes = {}
+        for r in done:
+            outcomes[r.outcome] = outcomes.get(r.outcome, 0) + 1
+        report[kind] = {
+            "count": len(done),
+            "outcomes": outcomes,
+            "first_answer_s": percentiles([r.first - r.sent for r in answered]),
+            "final_answer_s": percentiles([r.last - r.sent for r in done if r.last is not None]),
+        }
+    report["throughput_rps"] = round(sum(r.outcome == "ok" for r in requests) / duration, 3)
+    return report
+
+
+def route_quality(requests):
+    routes = [r for r in requests if r.kind == "route"]
+    errors, closed = [], 0
+    for r in routes:
+        if r.outcome != "ok":
+            continue
+        match = re.search(r"([\d.]+) km", r.caption or "")
+        if match:
+            errors.append(abs(float(match[1]) - r.distance_km) / r.distance_km)
+        points = re.findall(rb'<trkpt lat="([-\d.]+)" lon="([-\d.]+)"', r.gpx or b"")
+        closed += bool(points) and points[0] == points[-1]
+    ok = sum(r.outcome == "ok" for r in routes)
+    return {
+        "routes": len(routes),
+        "success_rate": round(ok / len(routes), 3) if routes else None,
+        "closed_loops": closed,
+        "length_error": percentiles(errors),
+    }
+
+
+def parse_histograms(text):
+    """{(name, labels without le): [(upper bound, cumulative count)]} from the Prometheus text format."""
+    histograms = {}
+    for line in text.splitlines():
+        match = re.match(r"^(\w+)_bucket\{(.*)\} (\S+)$", line)
+        if not match:
+            continue
+        labels = dict(re.findall(r'(\w+)="((?:[^"\\]|\\.)*)"', match[2]))
+        bound = labels.pop("le")
+        key = (match[1], tuple(sorted(labels.items())))
+        histograms.setdefault(key, []).append((float(bound), float(match[3])))
+    return histograms
+
+
+def histogram_quantiles(buckets):
+    """p50/p95/p99 interpolated within the buckets, like Prometheus' histogram_quantile."""
+    buckets = sorted(buckets)
+    total = buckets[-1][1] if buckets else 0
+    result = {"count": int(total)}
+    for p in PERCENTILES:
+        if not total:
+            result[f"p{p}"] = None
+            continue
+        rank = total * p / 100
+        lower, below = 0.0, 0.0
+        for bound, count in buckets:
+            if count >= rank:
+                if bound == float("inf"):
+                    value = lower
+                else:
+                    value = lower + (bound - lower) * (rank - below) / max(count - below, 1e-9)
+                break
+            lower, below = bound, count
+        result[f"p{p}"] = round(value, 4)
+    return result
+
+
+def bot_report(metrics_text):
+    """Quantiles of the bot-side histograms, summed over the labels not grouped by."""
+    groups = {"handler_seconds": "handler", "event_loop_lag_seconds": None, "planner_queue_wait_seconds": None,
+              "planner_job_seconds": None, "upstream_request_seconds": "service"}
+    summed = {}
+    for (name, labels), buckets in parse_histograms(metrics_text).items():
+        if name not in groups:
+            continue
+        group = dict(labels).get(groups[name], "all") if groups[name] else "all"
+        merged = summed.setdefault(name, {}).setdefault(group, {})
+        for bound, count in buckets:
+            merged[bound] = merged.get(bound, 0) + count
+    return {name: {group: histogram_quantiles(list(buckets.items())) for group, buckets in by_group.items()}
+            for name, by_group in summed.items()}
+
+
+async def wait_for_workers(client, url, workers, proc, timeout=300):
+    """Wait until the bot's planner workers have finished their imports."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"bot exited with code {proc.returncode}")
+        try:
+            text = (await client.get(url)).text
+            started = sum(float(v) for v in re.findall(r"^planner_worker_start_seconds_count\{.*\} (\S+)$", text,
+                                                       re.MULTILINE))
+            if started >= workers:
+                return
+        except httpx.TransportError:
+            pass
+        await asyncio.sleep(0.5)
+    raise RuntimeError("planner workers did not start in time")
+
+
+async def driver_lag(samples, interval=0.1):
+    """Event loop lag of the load driver itself: high values make its latencies unreliable."""
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        samples.append(max(loop.time() - start - interval, 0.0))
+
+
+async def run(args, workdir):
+    latency = parse_pairs(args.latency)
+    telegram = await TelegramStandIn(latency.get("telegram", 0)).start()
+    standins = [telegram] + [await cls(latency.get(cls.name, 0)).start()
+                             for cls in (WeatherStandIn, NominatimStandIn, OverpassStandIn, MistralStandIn)]
+    weather, nominatim, overpass, mistral = standins[1:]
+    metrics_port = free_port()
+    workers = int(os.getenv("PLANNER_WORKERS", "2"))
+
+    env = dict(
+        os.environ,
+        PYTHONPATH=project_root,
+        TOKEN="123456:LOAD-TEST",
+        API_KEY="load-test",
+        MISTRAL_API_KEY="load-test",
+        TELEGRAM_BASE_URL=f"{telegram.url}/bot",
+        WEATHER_API_URL=f"{weather.url}/v1",
+        NOMINATIM_URL=nominatim.url,
+        NOMINATIM_RATE=str(args.nominatim_rate),
+        OVERPASS_URL=f"{overpass.url}/api",
+        MISTRAL_SERVER_URL=mistral.url,
+        METRICS_HOST="127.0.0.1",
+        METRICS_PORT=str(metrics_port),
+        LOG_FILE=os.path.join(workdir, "bot.log"),
+    )
+    metrics_url = f"http://127.0.0.1:{metrics_port}/metrics"
+    lag = []
+    lag_task = asyncio.create_task(driver_lag(lag))
+    with open(os.path.join(workdir, "bot.out"), "ab") as out:
+        proc = subprocess.Popen([sys.executable, os.path.join(project_root, "bot.py")], cwd=workdir, env=env,
+                                stdout=out, stderr=subprocess.STDOUT)
+    try:
+        async with httpx.AsyncClient(timeout=10) as client:
+            logger.info("Waiting for the bot to start polling and its planner workers to be ready")
+            await asyncio.wait_for(telegram.polling.wait(), 120)
+            await wait_for_workers(client, metrics_url, workers, proc)
+
+            driver = LoadDriver(telegram, parse_pairs(args.mix), args.route_km, args.free_form, args.timeout,
+                                args.seed)
+            logger.info(f"Sending {args.rate} requests/s for {args.duration} s")
+            start = time.perf_counter()
+            await driver.run(args.rate, args.duration)
+            elapsed = time.perf_counter() - start
+            bot_metrics = bot_report((await client.get(metrics_url)).text)
+    finally:
+        lag_task.cancel()
+        proc.send_signal(signal.SIGINT)
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, proc.wait, 60)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+        for standin in standins:
+            await standin.close()
+
+    return {
+        "requests": request_report(driver.requests, elapsed),
+        "route_quality": route_quality(driver.requests),
+        "bot": bot_metrics,
+        "upstream_calls": {standin.name: standin.requests for standin in standins},
+        "driver_loop_lag_s": percentiles(lag),
+        "elapsed_s": round(elapsed, 1),
+        "users": len({r.user for r in driver.requests}),
+    }
+
+
+def compare(old, new, threshold=1.2):
+    """Print the p95 final answer latency change per kind; return how many got slower than threshold."""
+    regressions = 0
+    for kind, data in new["results"]["requests"].items():
+        before = old["results"]["requests"].get(kind)
+        if not isinstance(data, dict) or not before or not before["final_answer_s"]["p95"]:
+            continue
+        now, was = data["final_answer_s"]["p95"], before["final_answer_s"]["p95"]
+        if now is None:
+            continue
+        ratio = now / was
+        flag = "REGRESSION" if ratio > threshold else ""
+        regressions += bool(flag)
+        print(f"{kind:>10} p95 {was * 1000:10.1f} ms -> {now * 1000:10.1f} ms  x{ratio:5.2f} {flag}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rate", type=float, default=1.0, help="new requests per second")
+    parser.add_argument("--duration", type=float, default=60, help="seconds of traffic")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="relative weight of each request kind")
+    parser.add_argument("--latency", default=DEFAULT_LATENCY, help="mean latency in seconds of each stand-in")
+    parser.add_argument("--route-km", type=float, nargs="+", default=[10, 20, 40, 70], help="requested route lengths")
+    parser.add_argument("--free-form", type=float, default=0.2,
+                        help="share of /route requests in free text, parsed by the Mistral stand-in")
+    parser.add_argument("--nominatim-rate", type=float, default=1.0, help="geocoding requests per second")
+    parser.add_argument("--timeout", type=float, default=900, help="seconds to wait for the answer to a request")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workdir", help="run the bot here, keeping caches between runs (default: a temp dir)")
+    parser.add_argument("--output", help="write the JSON report here")
+    parser.add_argument("--compare", help="previous JSON report to compare against")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    unknown = set(parse_pairs(args.mix)) - set(KINDS)
+    if unknown:
+        parser.error(f"unknown request kinds: {', '.join(sorted(unknown))}")
+
+    if args.workdir:
+        os.makedirs(args.workdir, exist_ok=True)
+        results = asyncio.run(run(args, os.path.abspath(args.workdir)))
+    else:
+        with tempfile.TemporaryDirectory() as workdir:
+            results = asyncio.run(run(args, workdir))
+
+    report = {
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "config": {"rate": args.rate, "duration": args.duration, "mix": parse_pairs(args.mix),
+                   "latency": parse_pairs(args.latency), "route_km": args.route_km, "free_form": args.free_form,
+                   "planner_workers": int(os.getenv("PLANNER_WORKERS", "2"))},
+        "results": results,
+    }
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+    else:
+        print(text)
+
+    if args.compare:
+        with open(args.compare) as f:
+            return 1 if compare(json.load(f), report) else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+"""Offline benchmark of the route planning pipeline, stage by stage.
+
+Runs geocode, graph load, nearest node, path search, length sum and GPX
+write against synthetic road graphs and any GraphML fixtures in
+benchmarks/fixtures, and reports wall time, peak RSS and success rate per
+stage as JSON.
+
+    python benchmarks/bench_planner.py --sizes 1000 10000 100000 --output bench.json
+    python benchmarks/bench_planner.py --compare old.json --output new.json
+"""
+import argparse
+import glob
+import io
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+import psutil
+
+# Make sure we can import from the project
+project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, project_root)
+
+from benchmarks.synthetic import CENTER, GENERATORS, extent_m  # noqa: E402
+from processing.geocoding import GeocodeCache, Geocoder, RateLimiter, StaticBackend  # noqa: E402
+from processing.gpx import write_gpx  # noqa: E402
+from processing.graph_store import CSRGraph, GraphStore  # noqa: E402
+from processing.loops import find_loops, path_length, search_radius  # noqa: E402
+from processing.routing import RoutingEngine, nearest_node  # noqa: E402
+
+logger = logging.getLogger("benchmark")
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+STAGES = ("geocode", "graph_load", "nearest_node", "path_search", "length_sum", "gpx_write")
+
+
+class PeakRSS:
+    """Samples the process RSS in a background thread and keeps the maximum."""
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.process = psutil.Process()
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        self.peak = self.process.memory_info().rss
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, self.process.memory_info().rss)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, self.process.memory_info().rss)
+
+
+class StageTimer:
+    def __init__(self):
+        self.samples = {stage: [] for stage in STAGES}
+
+    def run(self, stage, fn, *args):
+        """Run one stage, recording (seconds, peak RSS bytes, success)."""
+        with PeakRSS() as rss:
+            start = time.perf_counter()
+            try:
+                result = fn(*args)
+                ok = result is not None
+            except Exception as e:
+                logger.error(f"Stage {stage} failed: {e}")
+                result, ok = None, False
+            elapsed = time.perf_counter() - start
+        self.samples[stage].append((elapsed, rss.peak, ok))
+        return result
+
+    def summary(self):
+        report = {}
+        for stage, samples in self.samples.items():
+            if not samples:
+                continue
+            times = np.array([s[0] for s in samples])
+            report[stage] = {
+                "runs": len(samples),
+                "success_rate": sum(s[2] for s in samples) / len(samples),
+                "wall_s_mean": float(times.mean()),
+                "wall_s_p50": float(np.median(times)),
+                "wall_s_max": float(times.max()),
+                "peak_rss_mb": max(s[1] for s in samples) / 2 ** 20,
+            }
+        return report
+
+
+def run_pipeline(timer, store, region, target_m, start, geocoder):
+    """One pass of the planner stages on a stored region, starting near `start`."""
+    location = timer.run("geocode", geocoder.geocode, f"{start[0]:.5f},{start[1]:.5f}")
+    if location is None:
+        return
+    lat, lon = location
+
+    sub = timer.run("graph_load", lambda: store.get(region).within(lat, lon, search_radius(target_m)))
+    if sub is None:
+        return
+
+    def snap():
+        # Solo la regione del benchmark: i grafi sintetici condividono centro e id dei nodi
+        idx, _ = store.index(region).nearest(np.array([lat]), np.array([lon]))
+        node_id = store.get(region).node_ids[idx[0]]
+        try:
+            return sub.index_of(node_id)
+        except KeyError:
+            return nearest_node(sub, lat, lon)
+
+    start_node = timer.run("nearest_node", snap)
+    if start_node is None:
+        return
+
+    def search():
+        engine = RoutingEngine(sub, start_node)
+        loops = find_loops(engine, target_m)
+        return (engine, loops[0][0]) if loops else None
+
+    found = timer.run("path_search", search)
+    if found is None:
+        return
+    engine, route = found
+    timer.run("length_sum", path_length, engine.matrix, route)
+    timer.run("gpx_write", lambda: write_gpx(io.StringIO(), sub, route) or True)
+
+
+def bench_graph(name, graph, distance_km, runs, workdir, seed=0):
+    logger.info(f"Benchmarking {name}: {graph.n_nodes} nodes, {graph.n_edges} edges")
+    store = GraphStore(workdir)
+    graph.save(os.path.join(workdir, name))
+    del graph
+    graph = store.get(name)
+    store.index(name)
+
+    # Distanza richiesta limitata a quella che il grafo può contenere
+    target_m = min(distance_km * 1000, 0.8 * extent_m(graph))
+    rng = np.random.default_rng(seed)
+    center_lat, center_lon = float(np.median(graph.lat)), float(np.median(graph.lon))
+    spread = 0.1 * (graph.lat.max() - graph.lat.min())
+    starts = [(center_lat + rng.uniform(-spread, spread), center_lon + rng.uniform(-spread, spread))
+              for _ in range(runs)]
+
+    cache_file = os.path.join(workdir, f"{name}_geocode.sqlite")
+    geocoder = Geocoder(StaticBackend({f"{lat:.5f},{lon:.5f}": (lat, lon) for lat, lon in starts}),
+                        GeocodeCache(cache_file), RateLimiter(cache_file, rate=1e9))
+
+    timer = StageTimer()
+    for start in starts:
+        run_pipeline(timer, store, name, target_m, start, geocoder)
+    return {"graph": name, "nodes": graph.n_nodes, "edges": graph.n_edges, "target_km": target_m / 1000,
+            "stages": timer.summary()}
+
+
+def fixture_graphs():
+    """CSRGraphs from the GraphML files recorded in benchmarks/fixtures."""
+    import osmnx as ox
+
+    for path in sorted(glob.glob(os.path.join(FIXTURES_DIR, "*.graphml"))):
+        yield os.path.splitext(os.path.basename(path))[0], CSRGraph.from_networkx(ox.load_graphml(path))
+
+
+def record_fixture(name, address, dist):
+    """Download a graph once and save it as a GraphML fixture (needs network access)."""
+    import osmnx as ox
+
+    os.makedirs(FIXTURES_DIR, exist_ok=True)
+    G = ox.graph_from_address(address, dist=dist, network_type="bike", simplify=True)
+    ox.save_graphml(G, os.path.join(FIXTURES_DIR, f"{name}.graphml"))
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=project_root,
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(old, new, threshold=1.2):
+    """Print stages whose mean wall time grew by more than threshold; return their count."""
+    old_stages = {(r["graph"], stage): data for r in old["results"] for stage, data in r["stages"].items()}
+    regressions = 0
+    for result in new["results"]:
+        for stage, data in result["stages"].items():
+            before = old_stages.get((result["graph"], stage))
+            if not before or before["wall_s_mean"] == 0:
+                continue
+            ratio = data["wall_s_mean"] / before["wall_s_mean"]
+            flag = "REGRESSION" if ratio > threshold else ""
+            regressions += bool(flag)
+            print(f"{result['graph']:>24} {stage:>14} {before['wall_s_mean'] * 1000:10.2f} ms "
+                  f"-> {data['wall_s_mean'] * 1000:10.2f} ms  x{ratio:5.2f} {flag}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1_000, 10_000, 100_000],
+                        help="node counts of the synthetic graphs (up to 1000000)")
+    parser.add_argument("--kinds", nargs="+", default=list(GENERATORS), choices=list(GENERATORS))
+    parser.add_argument("--distance", type=float, default=40, help="requested loop length in km")
+    parser.add_argument("--runs", type=int, default=5, help="start points per graph")
+    parser.add_argument("--no-fixtures", action="store_true", help="skip the GraphML fixtures")
+    parser.add_argument("--record", nargs=3, metavar=("NAME", "ADDRESS", "DIST_M"),
+                        help="download a GraphML fixture and exit")
+    parser.add_argument("--output", help="write the JSON report here")
+    parser.add_argument("--compare", help="previous JSON report to compare against")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    logging.getLogger("processing").setLevel(logging.WARNING)
+
+    if args.record:
+        record_fixture(args.record[0], args.record[1], float(args.record[2]))
+        return 0
+
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        if not args.no_fixtures:
+            for name, graph in fixture_graphs():
+                results.append(bench_graph(name, graph, args.distance, args.runs, workdir))
+        for kind in args.kinds:
+            for size in args.sizes:
+                graph = GENERATORS[kind](size)
+                results.append(bench_graph(f"{kind}_{size}", graph, args.distance, args.runs, workdir))
+
+    report = {
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "center": CENTER,
+        "results": results,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+    else:
+        print(text)
+
+    if args.compare:
+        with open(args.compare) as f:
+            return 1 if compare(json.load(f), report) else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
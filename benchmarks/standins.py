@@ -0,0 +1,355 @@
+"""Local stand-ins for the APIs the bot talks to, for offline load tests.
+
+Each stand-in is a small asyncio HTTP/1.1 server answering the requests
+the bot actually makes, after a configurable latency:
+
+- TelegramStandIn: Bot API methods used by python-telegram-bot, with
+  getUpdates long polling fed by push();
+- WeatherStandIn: weatherapi.com current.json and forecast.json;
+- NominatimStandIn: the /search endpoint used by geopy;
+- OverpassStandIn: osmnx's /status and /interpreter, serving a synthetic
+  street grid for the queried polygon;
+- MistralStandIn: chat completions answering the route parser's prompt.
+
+Addresses are placed around CENTER by a hash, so the same text always
+gets the same coordinates.
+"""
+import asyncio
+import email.parser
+import email.policy
+import hashlib
+import json
+import math
+import random
+import re
+import time
+from urllib.parse import parse_qs, urlsplit
+
+from benchmarks.synthetic import CENTER
+
+# Raggio entro cui vengono collocati gli indirizzi sintetici
+SPREAD_M = 4000
+
+# Passo della griglia stradale sintetica in gradi (circa 130 m)
+GRID_LAT = 0.0012
+GRID_LON = 0.0017
+
+# Punti di forma tra due incroci della griglia, come i nodi intermedi delle way OSM
+SHAPE_POINTS = 2
+
+
+def locate(text, center=CENTER, spread_m=SPREAD_M):
+    """Deterministic (lat, lon) of an address within spread_m of center."""
+    digest = hashlib.blake2b(text.strip().casefold().encode("utf-8"), digest_size=8).digest()
+    a, b = int.from_bytes(digest[:4], "big") / 2 ** 32, int.from_bytes(digest[4:], "big") / 2 ** 32
+    r, theta = spread_m * math.sqrt(a), 2 * math.pi * b
+    lat = center[0] + math.degrees(r * math.cos(theta) / 6_371_000)
+    lon = center[1] + math.degrees(r * math.sin(theta) / (6_371_000 * math.cos(math.radians(center[0]))))
+    return round(lat, 6), round(lon, 6)
+
+
+class StandIn:
+    """Minimal keep-alive HTTP/1.1 server; subclasses implement handle().
+
+    Every answer is delayed by latency seconds, spread uniformly by
+    ±jitter of it.
+    """
+
+    name = "standin"
+
+    def __init__(self, latency=0.0, jitter=0.5, host="127.0.0.1", port=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.host = host
+        self.port = port
+        self.requests = 0
+        self._server = None
+        self._connections = set()
+
+    @property
+    def url(self):
+        return f"http://{self.host}:{self.port}"
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._serve, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            for writer in list(self._connections):
+                writer.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def delay(self):
+        if self.latency > 0:
+            await asyncio.sleep(self.latency * random.uniform(1 - self.jitter, 1 + self.jitter))
+
+    async def handle(self, method, path, query, headers, body):
+        """Return (status, content type, body bytes)."""
+        raise NotImplementedError
+
+    async def _serve(self, reader, writer):
+        self._connections.add(writer)
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b"\r\n\r\n")
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+                    break
+                lines = head.decode("latin-1").split("\r\n")
+                method, target, _ = lines[0].split(" ", 2)
+                headers = {}
+                for line in lines[1:]:
+                    if ":" in line:
+                        key, value = line.split(":", 1)
+                        headers[key.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                parts = urlsplit(target)
+                query = {k: v[-1] for k, v in parse_qs(parts.query).items()}
+
+                self.requests += 1
+                await self.delay()
+                try:
+                    status, content_type, payload = await self.handle(method, parts.path, query, headers, body)
+                except Exception as e:
+                    status, content_type, payload = "500 Internal Server Error", "text/plain", str(e).encode()
+                close = headers.get("connection", "").lower() == "close"
+                writer.write(f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n"
+                             f"Content-Length: {len(payload)}\r\n"
+                             f"Connection: {'close' if close else 'keep-alive'}\r\n\r\n".encode("ascii") + payload)
+                await writer.drain()
+                if close:
+                    break
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            self._connections.discard(writer)
+            writer.close()
+
+
+def _json(data, status="200 OK"):
+    return status, "application/json", json.dumps(data).encode("utf-8")
+
+
+def form_fields(headers, body):
+    """Fields of a urlencoded, multipart or JSON request body; file parts as (filename, bytes)."""
+    content_type = headers.get("content-type", "")
+    if content_type.startswith("application/json"):
+        return json.loads(body or b"{}")
+    if content_type.startswith("multipart/form-data"):
+        message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+            b"Content-Type: " + content_type.encode("latin-1") + b"\r\n\r\n" + body)
+        fields = {}
+        for part in message.iter_parts():
+            name = part.get_param("name", header="content-disposition")
+            data = part.get_payload(decode=True)
+            filename = part.get_filename()
+            fields[name] = (filename, data) if filename else data.decode("utf-8")
+        return fields
+    return {k: v[-1] for k, v in parse_qs(body.decode("utf-8")).items()}
+
+
+class TelegramStandIn(StandIn):
+    """Bot API stand-in: updates are queued with push(), bot messages reported to on_message.
+
+    on_message(chat_id, method, fields, at) is called for every sendMessage,
+    editMessageText and sendDocument, with the time the request arrived.
+    """
+
+    name = "telegram"
+
+    def __init__(self, latency=0.0, jitter=0.5, on_message=None, **kwargs):
+        super().__init__(latency, jitter, **kwargs)
+        self.on_message = on_message
+        self.polling = asyncio.Event()
+        self._updates = []
+        self._update_id = 0
+        self._message_id = 0
+        self._arrived = asyncio.Event()
+        self.bot = {"id": 123456, "is_bot": True, "first_name": "OutdoorBuddyBot", "username": "outdoor_buddy_bot"}
+
+    def next_message_id(self):
+        self._message_id += 1
+        return self._message_id
+
+    def push(self, message):
+        """Queue a message update for the bot; returns its update id."""
+        self._update_id += 1
+        self._updates.append({"update_id": self._update_id, "message": message})
+        self._arrived.set()
+        return self._update_id
+
+    def message(self, user_id, text=None, location=None):
+        """A private chat message from user_id as the Bot API sends it."""
+        message = {
+            "message_id": self.next_message_id(),
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private", "first_name": f"user{user_id}"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"},
+        }
+        if text is not None:
+            message["text"] = text
+            if text.startswith("/"):
+                message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        if location is not None:
+            message["location"] = {"latitude": location[0], "longitude": location[1]}
+        return message
+
+    async def get_updates(self, offset, timeout):
+        self._updates = [u for u in self._updates if u["update_id"] >= offset]
+        if not self._updates and timeout > 0:
+            self._arrived.clear()
+            try:
+                await asyncio.wait_for(self._arrived.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            self._updates = [u for u in self._updates if u["update_id"] >= offset]
+        return self._updates[:100]
+
+    def _sent(self, fields, **extra):
+        chat_id = int(fields["chat_id"])
+        return {"message_id": int(fields.get("message_id") or self.next_message_id()), "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"}, "from": self.bot, **extra}
+
+    async def handle(self, method, path, query, headers, body):
+        api_method = path.rsplit("/", 1)[-1]
+        fields = {**query, **form_fields(headers, body)}
+        at = time.perf_counter()
+        if api_method == "getMe":
+            return _json({"ok": True, "result": self.bot})
+        if api_method == "getUpdates":
+            self.polling.set()
+            updates = await self.get_updates(int(fields.get("offset") or 0), float(fields.get("timeout") or 0))
+            return _json({"ok": True, "result": updates})
+        if api_method in ("sendMessage", "editMessageText"):
+            result = self._sent(fields, text=fields.get("text", ""))
+        elif api_method == "sendDocument":
+            filename, data = fields.get("document", ("document", b""))
+            result = self._sent(fields, caption=fields.get("caption", ""),
+                                document={"file_id": f"doc{self.requests}", "file_unique_id": f"doc{self.requests}",
+                                          "file_name": filename, "file_size": len(data)})
+        else:
+            return _json({"ok": True, "result": True})
+        if self.on_message is not None:
+            self.on_message(int(fields["chat_id"]), api_method, fields, at)
+        return _json({"ok": True, "result": result})
+
+
+class WeatherStandIn(StandIn):
+    """weatherapi.com stand-in: every location exists and it is always 18°C and sunny."""
+
+    name = "weather"
+
+    async def handle(self, method, path, query, headers, body):
+        q = query.get("q", "")
+        if re.match(r"^-?\d+(\.\d+)?,-?\d+(\.\d+)?$", q):
+            lat, lon = map(float, q.split(","))
+            name = "Grid cell"
+        else:
+            lat, lon = locate(q)
+            name = q.title()
+        data = {"location": {"name": name, "lat": lat, "lon": lon},
+                "current": {"temp_c": 18.0, "condition": {"text": "Sunny"}}}
+        if path.endswith("/forecast.json"):
+            today = time.time()
+            data["forecast"] = {"forecastday": [
+                {"date": time.strftime("%Y-%m-%d", time.gmtime(today + day * 86400)),
+                 "day": {"maxtemp_c": 22.0, "mintemp_c": 11.0, "condition": {"text": "Partly cloudy"}}}
+                for day in range(int(query.get("days", 3)))]}
+        elif not path.endswith("/current.json"):
+            return _json({"error": {"code": 1005, "message": "API URL is invalid."}}, "400 Bad Request")
+        return _json(data)
+
+
+class NominatimStandIn(StandIn):
+    """Nominatim stand-in: every address resolves to a point near CENTER."""
+
+    name = "nominatim"
+
+    async def handle(self, method, path, query, headers, body):
+        if not path.endswith("/search"):
+            return _json([], "404 Not Found")
+        address = query.get("q", "")
+        lat, lon = locate(address)
+        return _json([{"place_id": 1, "lat": str(lat), "lon": str(lon), "display_name": address,
+                       "boundingbox": [str(lat - 0.001), str(lat + 0.001), str(lon - 0.001), str(lon + 0.001)]}])
+
+
+class OverpassStandIn(StandIn):
+    """Overpass stand-in answering every network query with a street grid.
+
+    Grid nodes sit on a global lattice, so the answers for adjacent tiles
+    share their border nodes like real OSM data. Junctions are SHAPE_POINTS
+    + 1 lattice steps apart, the nodes between them only shape the ways.
+    """
+
+    name = "overpass"
+
+    async def handle(self, method, path, query, headers, body):
+        if path.endswith("/status"):
+            text = ("Connected as: 1\nCurrent time: {}\nAnnounced endpoint: none\nRate limit: 0\n"
+                    "2 slots available now.\nCurrently running queries (pid, space limit, time limit, start time):\n")
+            return "200 OK", "text/plain", text.format(time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())).encode()
+        data = form_fields(headers, body).get("data") or query.get("data", "")
+        match = re.search(r"poly:'([^']*)'", data) or re.search(r'poly:"([^"]*)"', data)
+        if match is None:
+            return _json({"elements": []})
+        coords = list(map(float, match[1].split()))
+        lats, lons = coords[0::2], coords[1::2]
+        return _json({"elements": self.grid(min(lats), min(lons), max(lats), max(lons))})
+
+    @staticmethod
+    def grid(south, west, north, east):
+        step = SHAPE_POINTS + 1
+        lat_step, lon_step = GRID_LAT / step, GRID_LON / step
+        rows = range(math.floor(south / GRID_LAT) * step, (math.ceil(north / GRID_LAT)) * step + 1)
+        cols = range(math.floor(west / GRID_LON) * step, (math.ceil(east / GRID_LON)) * step + 1)
+
+        def node_id(row, col):
+            return 1 + (row % 1_000_000) * 2_000_000 + col % 2_000_000
+
+        # Nodi solo sulle strade: le righe e le colonne degli incroci
+        elements = [{"type": "node", "id": node_id(r, c), "lat": round(r * lat_step, 7), "lon": round(c * lon_step, 7)}
+                    for r in rows for c in cols if r % step == 0 or c % step == 0]
+        tags = {"highway": "residential"}
+        elements += [{"type": "way", "id": 1_000_000_000 + r, "nodes": [node_id(r, c) for c in cols], "tags": tags}
+                     for r in rows if r % step == 0]
+        elements += [{"type": "way", "id": 2_000_000_000 + c, "nodes": [node_id(r, c) for r in rows], "tags": tags}
+                     for c in cols if c % step == 0]
+        return elements
+
+
+class MistralStandIn(StandIn):
+    """Mistral chat completions stand-in for the route parser's prompt.
+
+    Each numbered text is read as "... <km> km ... <level> ... from <address>".
+    """
+
+    name = "mistral"
+
+    @staticmethod
+    def extract(text):
+        distance = re.search(r"(\d+(?:[.,]\d+)?)\s*km", text, re.IGNORECASE)
+        level = re.search(r"\b(beginner|intermediate|advanced)\b", text, re.IGNORECASE)
+        address = re.search(r"\bfrom (.+?)(?: please)?[.!]?$", text, re.IGNORECASE)
+        return {"address": address[1] if address else None,
+                "distance": float(distance[1].replace(",", ".")) if distance else None,
+                "level": level[1].lower() if level else None}
+
+    async def handle(self, method, path, query, headers, body):
+        if not path.endswith("/chat/completions"):
+            return _json({"detail": "Not Found"}, "404 Not Found")
+        request = json.loads(body)
+        prompt = request["messages"][-1]["content"]
+        texts = re.findall(r"^\d+\. (.*)$", prompt, re.MULTILINE)
+        content = json.dumps({"results": [self.extract(text) for text in texts]})
+        return _json({
+            "id": f"cmpl-{self.requests}", "object": "chat.completion", "model": request.get("model", "stand-in"),
+            "created": int(time.time()),
+            "usage": {"prompt_tokens": len(prompt) // 4, "completion_tokens": len(content) // 4,
+                      "total_tokens": (len(prompt) + len(content)) // 4},
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+        })
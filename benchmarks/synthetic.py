@@ -0,0 +1,68 @@
+import math
+
+import numpy as np
+
+from processing.graph_store import CSRGraph, EARTH_RADIUS_M, offsets_from_counts
+
+# Centro dei grafi sintetici (Torino)
+CENTER = (45.07, 7.68)
+
+
+def _meters_to_degrees(dy, dx, lat0):
+    dlat = np.degrees(dy / EARTH_RADIUS_M)
+    dlon = np.degrees(dx / (EARTH_RADIUS_M * math.cos(math.radians(lat0))))
+    return dlat, dlon
+
+
+def _build(y, x, sources, targets, seed):
+    """CSRGraph from planar coordinates in meters and an undirected edge list."""
+    rng = np.random.default_rng(seed)
+    lat0, lon0 = CENTER
+    dlat, dlon = _meters_to_degrees(y - y.mean(), x - x.mean(), lat0)
+    lengths = np.hypot(y[sources] - y[targets], x[sources] - x[targets]) * rng.uniform(1.0, 1.3, len(sources))
+
+    # Both directions, except for about 10% one-way streets
+    oneway = rng.random(len(sources)) < 0.1
+    src = np.concatenate((sources, targets[~oneway]))
+    dst = np.concatenate((targets, sources[~oneway]))
+    lengths = np.concatenate((lengths, lengths[~oneway])).astype(np.float32)
+
+    order = np.lexsort((dst, src))
+    n = len(y)
+    return CSRGraph(np.arange(1, n + 1, dtype=np.int64), lat0 + dlat, lon0 + dlon,
+                    offsets_from_counts(np.bincount(src, minlength=n)), dst[order].astype(np.int32), lengths[order])
+
+
+def grid_graph(n_nodes, spacing=100.0, seed=0):
+    """Square street grid with about n_nodes intersections spaced `spacing` meters apart."""
+    side = max(2, int(math.sqrt(n_nodes)))
+    idx = np.arange(side * side).reshape(side, side)
+    y, x = np.divmod(np.arange(side * side), side)
+    sources = np.concatenate((idx[:, :-1].ravel(), idx[:-1, :].ravel()))
+    targets = np.concatenate((idx[:, 1:].ravel(), idx[1:, :].ravel()))
+    return _build(y * spacing, x * spacing, sources, targets, seed)
+
+
+def random_geometric_graph(n_nodes, spacing=100.0, degree=6.0, seed=0):
+    """Random points joined to their neighbours within the radius giving the mean degree."""
+    from scipy.spatial import cKDTree
+
+    rng = np.random.default_rng(seed)
+    extent = math.sqrt(n_nodes) * spacing
+    points = rng.uniform(0, extent, size=(n_nodes, 2))
+    radius = math.sqrt(degree / (math.pi * n_nodes)) * extent
+    pairs = cKDTree(points).query_pairs(radius, output_type="ndarray")
+    return _build(points[:, 0], points[:, 1], pairs[:, 0], pairs[:, 1], seed)
+
+
+def extent_m(graph):
+    """Side of the graph's bounding box in meters (the shorter one)."""
+    dlat = float(graph.lat.max() - graph.lat.min())
+    dlon = float(graph.lon.max() - graph.lon.min()) * math.cos(math.radians(CENTER[0]))
+    return math.radians(min(dlat, dlon)) * EARTH_RADIUS_M
+
+
+GENERATORS = {
+    "grid": grid_graph,
+    "geometric": random_geometric_graph,
+}
@@ -1,10 +1,13 @@
 from telegram import Update, KeyboardButton, ReplyKeyboardMarkup
 from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, filters, CallbackContext, \
-    ConversationHandler, PersistenceInput, PicklePersistence
-from processing import utils
-from concurrent.futures import ProcessPoolExecutor
-import sklearn
-import requests
+    ConversationHandler, PersistenceInput
+from processing import metrics
+from processing.history import mean_temperatures
+from processing.persistence import SQLitePersistence, UserPreferences
+from processing.route_parser import DEFAULT_LEVEL, RouteParser
+from processing.weather import WeatherClient
+from processing.worker_pool import PlannerBusy, PlannerCancelled, PlannerMemoryError, PlannerPool, PlannerPoolFull, \
+    PlannerTimeout
 import os
 import signal
 import asyncio
@@ -12,10 +15,9 @@ import logging
 from datetime import datetime, timedelta
 import re
 from dotenv import load_dotenv
-import json
+import gzip
+import importlib
 import sys
-import tempfile
-from mistralai import Mistral
 
 
 # Configurazione del logging
@@ -30,8 +32,10 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 # URL e chiavi API
-URL = "http://api.weatherapi.com/v1"
+URL = os.getenv("WEATHER_API_URL", "http://api.weatherapi.com/v1")
 TOKEN = os.getenv("TOKEN")
+# Endpoint alternativo della Bot API (server locale o stand-in del load test)
+TELEGRAM_BASE_URL = os.getenv("TELEGRAM_BASE_URL")
 API_KEY = os.getenv("API_KEY")
 
 
@@ -39,17 +43,50 @@ API_KEY = os.getenv("API_KEY")
 AWAITING_COMMAND = 0
 is_paused = False
 
-# Configurazione della persistenza
-persistence = PicklePersistence(
-    filepath='bot_data.pickle',
+# Configurazione della persistenza: solo bot_data e stati delle conversazioni, importati
+# al primo avvio dal vecchio file pickle
+persistence = SQLitePersistence(
     store_data=PersistenceInput(
         bot_data=True,
-        chat_data=True,
-        user_data=True,
-        callback_data=True,
-    )
+        chat_data=False,
+        user_data=False,
+        callback_data=False,
+    ),
+    migrate_from='bot_data.pickle',
 )
 
+# Indirizzo di casa, livello e percorsi recenti di ogni utente
+preferences = UserPreferences()
+
+# Client HTTP condiviso per weatherapi.com
+weather_client = WeatherClient(API_KEY, base_url=URL)
+
+# Parametri di /route: sintassi documentata in locale, il resto con Mistral
+route_parser = RouteParser(os.getenv("MISTRAL_API_KEY"))
+
+# Endpoint Prometheus e log JSON lines delle metriche
+metrics_server = metrics.MetricsServer()
+
+# Pool di processi per il calcolo dei percorsi
+planner_pool = PlannerPool(
+    workers=int(os.getenv("PLANNER_WORKERS", "2")),
+    queue_size=int(os.getenv("PLANNER_QUEUE_SIZE", "8")),
+    job_timeout=int(os.getenv("PLANNER_JOB_TIMEOUT", "600")),
+    max_jobs_per_worker=int(os.getenv("PLANNER_MAX_JOBS_PER_WORKER", "20")),
+    # Secondi di attesa che ogni km in più concede ai percorsi più corti arrivati dopo
+    seconds_per_km=float(os.getenv("PLANNER_SECONDS_PER_KM", "3")),
+)
+
+# Attese dei percorsi in corso: non passano da application.create_task, che allo stop le attenderebbe
+# fino alla fine del calcolo
+route_tasks = set()
+
+# Intervallo minimo tra due modifiche del messaggio di avanzamento
+PROGRESS_EDIT_INTERVAL = 3.0
+
+# GPX più grandi di così vengono inviati compressi con gzip (0 = mai)
+GPX_GZIP_THRESHOLD = int(os.getenv("GPX_GZIP_THRESHOLD", str(5 * 1024 * 1024)))
+
 
 async def start(update: Update, context: CallbackContext) -> int:
     global is_paused
@@ -64,12 +101,14 @@ async def start(update: Update, context: CallbackContext) -> int:
 
     await update.message.reply_text(
         "Hi! Welcome to OutdoorBuddyBot\nUse:\n/weather [Municipality] -> to have the current weather\n/forecast [Municipality] -> to see next 4 days forecast"
-        "\n/route [Address] [distance in km] [level of training:\n\tbeginner,intermediate,advanced] -> to have a suggested bike track for your adventutres\n/stop -> to pause the Bot.",
+        "\n/history [Municipality] -> to see last 7 days mean temperature"
+        "\n/route [Address] [distance in km] [level of training:\n\tbeginner,intermediate,advanced] -> to have a suggested bike track for your adventutres\n/home [Address] -> to set the address used when /route has none\n/cancel -> to stop the route being planned\n/stop -> to pause the Bot.",
         reply_markup=reply_markup)
 
     return AWAITING_COMMAND
 
 
+@metrics.instrument("forecast")
 async def forecast(update: Update, context: CallbackContext) -> int:
     if context.bot_data.get('is_paused', False):
         await update.message.reply_text("🛑 Bot is paused. Use /resume to continue.")
@@ -81,11 +120,9 @@ async def forecast(update: Update, context: CallbackContext) -> int:
 
     try:
         city = " ".join(context.args)
-        params = {"key": API_KEY, "q": city, "days": 5, "lang": "en"}
-        response = requests.get(f"{URL}/forecast.json", params=params)
+        data = await weather_client.forecast(city, days=5)
 
-        if response.status_code == 200:
-            data = response.json()
+        if data is not None:
             city_name = data["location"]["name"]
             forecast_days = data["forecast"]["forecastday"]
 
@@ -109,6 +146,7 @@ async def forecast(update: Update, context: CallbackContext) -> int:
     return AWAITING_COMMAND
 
 
+@metrics.instrument("weather")
 async def weather(update: Update, context: CallbackContext) -> int:
     if context.bot_data.get('is_paused', False):
         await update.message.reply_text("🛑 Bot is paused. Use /resume to continue.")
@@ -120,11 +158,9 @@ async def weather(update: Update, context: CallbackContext) -> int:
 
     try:
         city = " ".join(context.args)
-        params = {"key": API_KEY, "q": city, "lang": "en"}
-        response = requests.get(f"{URL}/current.json", params=params)
+        data = await weather_client.current(city)
 
-        if response.status_code == 200:
-            data = response.json()
+        if data is not None:
             city_name = data["location"]["name"]
             temp = data["current"]["temp_c"]
             description = data["current"]["condition"]["text"]
@@ -140,6 +176,74 @@ async def weather(update: Update, context: CallbackContext) -> int:
     return AWAITING_COMMAND
 
 
+@metrics.instrument("history")
+async def history(update: Update, context: CallbackContext) -> int:
+    if context.bot_data.get('is_paused', False):
+        await update.message.reply_text("🛑 Bot is paused. Use /resume to continue.")
+        return AWAITING_COMMAND
+
+    if not context.args:
+        await update.message.reply_text("❌ Use:\n/history [City name]")
+        return AWAITING_COMMAND
+
+    try:
+        city = " ".join(context.args)
+        # Risolve il comune con weatherapi, che restituisce anche le coordinate
+        data = await weather_client.current(city)
+
+        if data is not None:
+            city_name = data["location"]["name"]
+            lat, lon = data["location"]["lat"], data["location"]["lon"]
+            station, temps = await asyncio.get_running_loop().run_in_executor(
+                None, mean_temperatures, lat, lon, 7)
+
+            message = f"📍 {city_name} (station: {station})\n🗓 Last 7 days mean temperature:\n\n"
+            for day, temp in temps.items():
+                value = f"{temp:.1f}°C" if temp == temp else "n/a"
+                message += f"📅 {day.strftime('%d/%m/%Y')}: 🌡 {value}\n"
+
+            await update.message.reply_text(message)
+        else:
+            await update.message.reply_text("❌ Municipality not found.")
+    except Exception as e:
+        logger.error(f"Error in history command: {e}")
+        await update.message.reply_text("❌ An error occurred while fetching the temperature history.")
+
+    return AWAITING_COMMAND
+
+
+@metrics.instrument("cancel")
+async def cancel(update: Update, context: CallbackContext) -> int:
+    if planner_pool.cancel(update.effective_user.id):
+        await update.message.reply_text("🛑 Cancelling your route request...")
+    else:
+        await update.message.reply_text("ℹ️ You have no route being planned.")
+    return AWAITING_COMMAND
+
+
+@metrics.instrument("home")
+async def home(update: Update, context: CallbackContext) -> int:
+    if context.bot_data.get('is_paused', False):
+        await update.message.reply_text("🛑 Bot is paused. Use /resume to continue.")
+        return AWAITING_COMMAND
+
+    user_id = update.effective_user.id
+    address = " ".join(context.args).strip()
+    loop = asyncio.get_running_loop()
+    if not address:
+        prefs = await loop.run_in_executor(None, preferences.get, user_id)
+        if prefs["home_address"]:
+            await update.message.reply_text(f"🏠 Home address: {prefs['home_address']}\n"
+                                            f"Use /route [km] [level] to start from it.")
+        else:
+            await update.message.reply_text("❌ Use:\n/home [Address]")
+        return AWAITING_COMMAND
+
+    await loop.run_in_executor(None, preferences.set_home, user_id, address)
+    await update.message.reply_text(f"🏠 Home address set to {address}.\nUse /route [km] [level] to start from it.")
+    return AWAITING_COMMAND
+
+
 async def stop(update: Update, context: CallbackContext) -> int:
     # Salva lo stato di pausa nei dati persistenti
     context.bot_data['is_paused'] = True
@@ -154,6 +258,7 @@ async def resume(update: Update, context: CallbackContext) -> int:
     return AWAITING_COMMAND
 
 
+@metrics.instrument("position")
 async def position(update: Update, context: CallbackContext) -> int:
     if context.bot_data.get('is_paused', False):
         await update.message.reply_text("🛑 Bot is paused. Use /resume to continue.")
@@ -166,11 +271,9 @@ async def position(update: Update, context: CallbackContext) -> int:
 
             logger.info(f"📍 Coordinates received: Lat {lat}, Lon {lon}")
 
-            params = {"key": API_KEY, "q": f"{lat},{lon}", "lang": "en"}
-            response = requests.get(f"{URL}/current.json", params=params)
+            data = await weather_client.current_at(lat, lon)
 
-            if response.status_code == 200:
-                data = response.json()
+            if data is not None:
                 city = data["location"]["name"]
                 temp = data["current"]["temp_c"]
                 description = data["current"]["condition"]["text"]
@@ -186,35 +289,7 @@ async def position(update: Update, context: CallbackContext) -> int:
     return AWAITING_COMMAND
 
 
-async def parse_input_with_ai(message: str) -> dict:
-    try:
-        prompt = (
-            "Extract the following parameters from the text: address, distance (km), level, duration (hours), and ascent (optional). "
-            "Return a JSON. Ignore irrelevant details.\n"
-            f"Text: {message}\nOutput:"
-        )
-
-        async with Mistral(
-            api_key=os.getenv("MISTRAL_API_KEY"),
-        ) as mistral:
-            response = await mistral.chat.complete_async(
-                model="mistral-small-latest",
-                messages=[
-                    {
-                        "content": prompt,
-                        "role": "user",
-                    },
-                ], stream =False)
-
-        response_text = response.choices[0].message.content.strip()
-        response_text = re.sub(r"```json\n(.*?)\n```", r"\1", response_text, flags=re.DOTALL)
-
-        return json.loads(response_text)
-    except Exception as e:
-        logger.error(f"Error in AI parsing: {e}")
-        raise
-
-
+@metrics.instrument("route")
 async def route(update: Update, context: CallbackContext) -> int:
     if context.bot_data.get('is_paused', False):
         await update.message.reply_text("🛑 Bot is paused. Use /resume to continue.")
@@ -226,16 +301,16 @@ async def route(update: Update, context: CallbackContext) -> int:
             return AWAITING_COMMAND
 
         user_input = update.message.text[len("/route"):]
+        user_id = update.effective_user.id
+        prefs = await asyncio.get_running_loop().run_in_executor(None, preferences.get, user_id)
         try:
-            params = await parse_input_with_ai(user_input)
+            params = await route_parser.parse(user_input, home=prefs["home_address"],
+                                              default_level=prefs["level"] or DEFAULT_LEVEL)
         except Exception as e:
             logger.error(f"Error in AI parsing: {e}")
-            # Fallback to default values
-            params = {
-                "address": "Via Vigna 10, Ciriè",
-                "distance": 50,
-                "level": "intermediate"
-            }
+            await update.message.reply_text(
+                "❌ Could not understand the route request.\nUse: /route [Address] [km] [level]")
+            return AWAITING_COMMAND
 
         logger.info(f"Params after parsing: {params}")
         address = params["address"]
@@ -254,22 +329,26 @@ async def route(update: Update, context: CallbackContext) -> int:
         message = await update.message.reply_text("🔄 Processing your route request. This may take a few minutes...")
 
         # Create a unique ID for this route request
-        route_id = f"route_{update.effective_user.id}_{int(asyncio.get_event_loop().time())}"
-        output_file = f"{route_id}.gpx"
-
-        # Run the route planner in a separate Python process
-        success = await run_route_planner_process(address, distance, level, output_file)
+        route_id = f"route_{user_id}_{int(asyncio.get_event_loop().time())}"
 
-        if success:
-            # Update the message to indicate success
-            await message.edit_text("✅ Route successfully created. Check your email for the GPX file.")
+        # Queue the job on the worker pool: one job per user, shortest routes first
+        try:
+            job = planner_pool.enqueue(user=user_id, progress=progress_editor(message), address=address,
+                                       distance_km=distance, level=level)
+        except PlannerBusy:
+            await message.edit_text("⏳ You already have a route being planned. Use /cancel to stop it.")
+            return AWAITING_COMMAND
+        except PlannerPoolFull:
+            await message.edit_text("❌ Too many route requests right now. Please try again later.")
+            return AWAITING_COMMAND
 
-            # Here you would add code to email the GPX file to the user
-            # send_email_with_attachment(user_email, output_file)
+        if job.ahead:
+            await message.edit_text(f"⏳ Route request queued, {job.ahead} ahead of yours. Use /cancel to stop it.")
 
-            logger.info("Route creation completed, response sent.")
-        else:
-            await message.edit_text("❌ Failed to create route. Please try again with different parameters.")
+        # Il calcolo prosegue in background, così il bot continua a rispondere agli altri comandi
+        task = asyncio.create_task(finish_route(update.message, message, job, route_id))
+        route_tasks.add(task)
+        task.add_done_callback(route_done)
     except Exception as e:
         logger.error(f"Error in route command: {e}")
         await update.message.reply_text(f"❌ Error: {str(e)}")
@@ -277,67 +356,102 @@ async def route(update: Update, context: CallbackContext) -> int:
     return AWAITING_COMMAND
 
 
-async def run_route_planner_process(address, distance, level, output_file):
-    """Run the route planner in a separate process with timeout"""
-    try:
-        # Create a temporary JSON file to pass parameters
-        with tempfile.NamedTemporaryFile(mode='w', suffix='.json', delete=False) as f:
-            params_file = f.name
-            json.dump({
-                "address": address,
-                "distance": distance,
-                "level": level,
-                "output_file": output_file
-            }, f)
-
-        # Get the path to the dedicated route planner script
-        script_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'route_planner_process.py')
-
-        # Make sure the script exists
-        if not os.path.exists(script_path):
-            logger.error(f"Route planner script not found at: {script_path}")
-            return False
-
-        # Run the script with timeout and increased memory limit
-        env = os.environ.copy()
-        # Increase Python memory limit if your system supports it
-        env["PYTHONMALLOC"] = "malloc"  # Use system malloc which might be more efficient
-
-        # Run the script with timeout
-        process = await asyncio.create_subprocess_exec(
-            sys.executable, script_path, params_file,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE,
-            env=env
-        )
+def progress_editor(message):
+    """Progress callback editing the processing message, at most every PROGRESS_EDIT_INTERVAL seconds."""
+    last = {"text": None, "time": 0.0}
 
-        try:
-            # Set a longer timeout (10 minutes)
-            stdout, stderr = await asyncio.wait_for(process.communicate(), timeout=600)
-
-            if process.returncode != 0:
-                logger.error(f"Route planning process failed with return code {process.returncode}")
-                if stderr:
-                    logger.error(f"STDERR: {stderr.decode()}")
-                if stdout:
-                    logger.info(f"STDOUT: {stdout.decode()}")
-                return False
-
-            logger.info("Route planning process completed successfully")
-            return True
-        except asyncio.TimeoutError:
-            logger.error("Route planning process timed out after 10 minutes")
-            process.kill()
-            return False
+    async def edit(stage, percent):
+        text = f"🔄 {stage}... {percent}%"
+        now = asyncio.get_running_loop().time()
+        if text == last["text"] or now - last["time"] < PROGRESS_EDIT_INTERVAL:
+            return
+        last.update(text=text, time=now)
+        await message.edit_text(text)
+
+    return edit
+
+
+async def finish_route(request, message, job, route_id):
+    """Wait for a queued route job, then send the GPX as a document in reply to the request."""
+    try:
+        result = await run_route_planner(job)
+    except PlannerCancelled as e:
+        await message.edit_text(f"🛑 {e}.")
+        return
+    except PlannerMemoryError as e:
+        await message.edit_text(f"❌ {e}")
+        return
+
+    if result is None:
+        await message.edit_text("❌ Failed to create route. Please try again with different parameters.")
+        return
+
+    # Il GPX arriva in memoria dal worker e viene inviato senza passare dal disco
+    data, filename = result["gpx"], f"{route_id}.gpx"
+    if GPX_GZIP_THRESHOLD and len(data) > GPX_GZIP_THRESHOLD:
+        data = await asyncio.get_running_loop().run_in_executor(None, gzip.compress, data)
+        filename += ".gz"
+
+    caption = f"🚴 {result['length_m'] / 1000:.1f} km"
+    if result.get("ascent_m"):
+        caption += f", ⛰ {result['ascent_m']:.0f} m of climbing"
+    await request.reply_document(document=data, filename=filename, caption=caption)
+    await message.edit_text("✅ Route successfully created.")
+    await asyncio.get_running_loop().run_in_executor(
+        None, preferences.add_route, job.user, job.params["address"], job.params["distance_km"],
+        job.params["level"])
+    logger.info("Route creation completed, GPX sent.")
+
+
+def route_done(task):
+    route_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error(f"Error sending a planned route: {task.exception()}")
+
+
+async def run_route_planner(job):
+    """Wait for a route job on the warm worker pool, with timeout. Returns the result dict or None."""
+    try:
+        result = await job.future
+        logger.info(f"Route planning completed successfully: {len(result['gpx'])} bytes of GPX, "
+                    f"{result['length_m'] / 1000:.1f} km, cached: {result['cached']}")
+        return result
+    except PlannerCancelled as e:
+        logger.info(f"Route planning for user {job.user} cancelled: {e}")
+        raise
+    except PlannerTimeout as e:
+        logger.error(str(e))
+        return None
+    except PlannerMemoryError as e:
+        logger.error(f"Route planner out of memory: {e}")
+        raise
     except Exception as e:
         logger.error(f"Failed to run route planner: {e}")
-        return False
-    finally:
-        # Clean up temporary files
-        try:
-            os.unlink(params_file)
-        except Exception:
-            pass
+        return None
+
+
+async def post_init(application) -> None:
+    await metrics_server.start()
+    await planner_pool.start()
+    # Il client Mistral viene importato in un thread, senza ritardare l'avvio del polling
+    asyncio.get_running_loop().run_in_executor(None, importlib.import_module, "mistralai")
+
+
+async def post_stop(application) -> None:
+    # Con il polling fermo /cancel non arriva più: i percorsi in coda o in calcolo vengono annullati
+    # e gli utenti avvisati finché il bot può ancora inviare messaggi
+    planner_pool.stop()
+    await asyncio.gather(*route_tasks, return_exceptions=True)
+
+
+async def post_shutdown(application) -> None:
+    logger.info(f"Weather cache stats: {weather_client.stats()}")
+    await planner_pool.close()
+    await weather_client.close()
+    await route_parser.close()
+    preferences.close()
+    await metrics_server.close()
+
 
 async def error_handler(update: Update, context: CallbackContext) -> None:
     """Gestisce gli errori incontrati dal dispatcher."""
@@ -350,14 +464,21 @@ async def error_handler(update: Update, context: CallbackContext) -> None:
 def main() -> None:
     try:
         # Inizializza l'applicazione con persistenza
-        application = ApplicationBuilder().token(TOKEN).persistence(persistence).build()
+        builder = ApplicationBuilder().token(TOKEN).persistence(persistence)
+        if TELEGRAM_BASE_URL:
+            file_url = TELEGRAM_BASE_URL.rsplit("/bot", 1)[0] + "/file/bot"
+            builder = builder.base_url(TELEGRAM_BASE_URL).base_file_url(file_url)
+        application = builder.post_init(post_init).post_stop(post_stop).post_shutdown(post_shutdown).build()
 
         # Gestione degli stati della conversazione
         states = {
             AWAITING_COMMAND: [
                 CommandHandler("weather", weather),
                 CommandHandler("forecast", forecast),
+                CommandHandler("history", history),
                 CommandHandler("route", route),
+                CommandHandler("cancel", cancel),
+                CommandHandler("home", home),
                 CommandHandler("stop", stop),
                 CommandHandler("resume", resume),
                 MessageHandler(filters.LOCATION, position),
@@ -0,0 +1,315 @@
+import csv
+import hashlib
+import json
+import logging
+import math
+import multiprocessing
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+logger = logging.getLogger(__name__)
+
+# Lato in gradi delle celle con cui i punti di partenza vengono raggruppati (un grafo per cella)
+BATCH_GROUP_DEG = float(os.getenv("BATCH_GROUP_DEG", "0.1"))
+
+FIELDS = ("id", "address", "lat", "lon", "distance_km", "level", "mode", "sides")
+
+# Lock sull'indice condiviso dai processi del batch
+_index_lock = threading.Lock()
+
+
+def _number(value):
+    return None if value in (None, "") else float(value)
+
+
+def request_id(request):
+    """Stable id of a request without one, from its start, distance, level, mode and sides."""
+    start = request["address"] or f"{request['lat']:.6f},{request['lon']:.6f}"
+    text = f"{start}|{request['distance_km']:g}|{request['level']}|{request['mode']}|{request['sides']}"
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=8).hexdigest()
+
+
+def normalize_request(row, line):
+    """Request dict from a CSV or JSONL row; raises ValueError if it has no start or distance."""
+    from processing.route_parser import DEFAULT_LEVEL, LEVELS
+
+    request = {
+        "id": str(row.get("id") or "").strip() or None,
+        "address": str(row.get("address") or "").strip() or None,
+        "lat": _number(row.get("lat")),
+        "lon": _number(row.get("lon")),
+        "distance_km": _number(row.get("distance_km", row.get("distance"))),
+        "level": str(row.get("level") or DEFAULT_LEVEL).strip().lower(),
+        "mode": str(row.get("mode") or "bike").strip(),
+        "sides": int(_number(row.get("sides")) or 3),
+    }
+    if request["address"] is None and (request["lat"] is None or request["lon"] is None):
+        raise ValueError(f"line {line}: an address or lat and lon are needed")
+    if not request["distance_km"] or request["distance_km"] <= 0:
+        raise ValueError(f"line {line}: distance_km must be a positive number")
+    if request["level"] not in LEVELS:
+        raise ValueError(f"line {line}: level must be one of {', '.join(LEVELS)}")
+    request["id"] = request["id"] or request_id(request)
+    return request
+
+
+def read_requests(path):
+    """Route requests from a CSV file with a header row or a JSONL file, one per line.
+
+    Columns / keys: address or lat and lon, distance_km, and optionally id,
+    level, mode and sides.
+    """
+    with open(path, newline="", encoding="utf-8") as f:
+        if path.endswith((".jsonl", ".json")):
+            rows = [(json.loads(line), n) for n, line in enumerate(f, 1) if line.strip()]
+        else:
+            rows = [(row, n) for n, row in enumerate(csv.DictReader(f), 2)]
+    return [normalize_request(row, n) for row, n in rows]
+
+
+def read_index(path):
+    """{request id: status} of the routes already in a JSONL route index, the last line of each id winning."""
+    done = {}
+    if path is None or not os.path.exists(path):
+        return done
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # Riga troncata da un'interruzione
+                continue
+            done[record["id"]] = record["status"]
+    return done
+
+
+def _append(path, record):
+    if path is None:
+        return
+    line = json.dumps(record, ensure_ascii=False) + "\n"
+    with _index_lock:
+        with open(path, "a", encoding="utf-8") as f:
+            f.write(line)
+            f.flush()
+            os.fsync(f.fileno())
+
+
+def _write_gpx(gpx_dir, request_id_, data):
+    """Write a GPX file atomically, so an interrupted batch leaves no partial file."""
+    path = os.path.join(gpx_dir, f"{request_id_}.gpx")
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+    return os.path.basename(path)
+
+
+def group_requests(requests, size=BATCH_GROUP_DEG):
+    """Requests with coordinates grouped by mode and grid cell of size degrees."""
+    groups = {}
+    for request in requests:
+        cell = (request["mode"], math.floor(request["lat"] / size), math.floor(request["lon"] / size))
+        groups.setdefault(cell, []).append(request)
+    return list(groups.values())
+
+
+def _record(request, status, **fields):
+    return {key: request[key] for key in FIELDS} | {"status": status} | fields
+
+
+def plan_group(group, gpx_dir=None, index=None):
+    """Plan every request of a group on one graph; return {status: count}.
+
+    The graph is loaded once around the group's center, large enough for
+    the farthest start and longest route. Requests without a loop in it,
+    and all of them if it cannot be loaded (e.g. it does not fit in the
+    memory budget), are planned on their own with plan_route.
+    """
+    from processing import planner
+    from processing.graph_store import distances_m
+    from processing.loops import search_radius
+    from processing.memory import MemoryBudgetExceeded
+
+    counts = {}
+    lat = sum(r["lat"] for r in group) / len(group)
+    lon = sum(r["lon"] for r in group) / len(group)
+    mode = group[0]["mode"]
+    radius = max(float(distances_m(r["lat"], r["lon"], lat, lon)) + search_radius(r["distance_km"] * 1000, r["sides"])
+                 for r in group)
+
+    graph = None
+    pending = []
+    for request in group:
+        start_id, cached = planner.cached_route(request["lat"], request["lon"], request["distance_km"],
+                                                request["level"], mode, request["sides"])
+        if cached is not None:
+            _finish(request, {"gpx": cached["gpx"], "length_m": cached["length_m"], "node_ids": cached["nodes"],
+                              "cached": True}, gpx_dir, index, counts, 0.0)
+        else:
+            pending.append((request, start_id))
+    if not pending:
+        return counts
+
+    try:
+        with planner.metrics.span("planner_stage", stage="graph_load"):
+            graph = planner.load_graph(lat, lon, radius, mode)
+        logger.info(f"Loaded {graph.n_nodes} nodes within {radius / 1000:.1f} km for {len(pending)} routes")
+    except MemoryBudgetExceeded as e:
+        logger.warning(f"Group graph does not fit, planning its routes one by one: {e}")
+    except MemoryError:
+        raise
+    except Exception as e:
+        # Ogni percorso da solo può ancora riuscire, con un grafo più piccolo
+        logger.warning(f"Cannot load one graph for {len(pending)} routes near {lat:.4f}, {lon:.4f}, "
+                       f"planning them one by one: {e}")
+
+    for request, start_id in pending:
+        started = time.perf_counter()
+        try:
+            result = None
+            if graph is not None:
+                engine, loops = planner.search_loops(graph, request["lat"], request["lon"],
+                                                     request["distance_km"] * 1000, request["level"],
+                                                     request["sides"], start_id)
+                if loops:
+                    result = planner.save_routes(engine, loops, request["lat"], request["lon"],
+                                                 request["distance_km"], request["level"], mode, request["sides"])
+            if result is None:
+                # Nessun anello nel grafo del gruppo: ricerca con espansione del raggio
+                result = planner.plan_route(request["address"] or f"{request['lat']},{request['lon']}",
+                                            request["distance_km"], request["level"], mode=mode,
+                                            sides=request["sides"], start=(request["lat"], request["lon"]))
+            _finish(request, result, gpx_dir, index, counts, time.perf_counter() - started)
+        except MemoryBudgetExceeded as e:
+            # Questo percorso non ci sta, gli altri del gruppo possono ancora
+            _fail(request, e, index, counts)
+        except MemoryError:
+            raise
+        except Exception as e:
+            _fail(request, e, index, counts)
+    return counts
+
+
+def _fail(request, error, index, counts):
+    logger.error(f"Route {request['id']} failed: {error}")
+    _append(index, _record(request, "error", error=str(error)))
+    counts["error"] = counts.get("error", 0) + 1
+
+
+def _finish(request, result, gpx_dir, index, counts, seconds):
+    fields = {"length_m": round(result["length_m"], 1), "cached": result["cached"], "seconds": round(seconds, 3)}
+    if result.get("ascent_m") is not None:
+        fields["ascent_m"] = round(result["ascent_m"], 1)
+    if gpx_dir is not None:
+        fields["gpx"] = _write_gpx(gpx_dir, request["id"], result["gpx"])
+    fields["nodes"] = [int(node) for node in result["node_ids"]]
+    _append(index, _record(request, "ok", **fields))
+    counts["ok"] = counts.get("ok", 0) + 1
+    logger.info(f"Route {request['id']}: {result['length_m'] / 1000:.1f} km"
+                f"{' (cached)' if result['cached'] else ''}")
+
+
+def _init_process(lock):
+    global _index_lock
+    _index_lock = lock
+    # Ogni processo ha il suo budget di memoria, come i worker del bot
+    from processing.planner import budget
+
+    budget.install()
+
+
+def plan_batch(requests, gpx_dir=None, index=None, workers=1, retry_errors=False):
+    """Plan many routes, loading one graph per group of nearby start points.
+
+    Each result is written as it is found: a GPX file in gpx_dir named
+    after the request id and a line in the JSONL route index (id, request,
+    status, length, GPX file and OSM node ids, or the error). Requests
+    already in the index are skipped, failed ones too unless retry_errors,
+    so an interrupted batch resumes where it stopped. Addresses are
+    geocoded first; groups are spread over workers processes. Routes are
+    also stored in the route cache, so the bot answers them at once.
+    Returns {status: count}.
+    """
+    from processing.utils import get_coordinates
+
+    if gpx_dir is not None:
+        os.makedirs(gpx_dir, exist_ok=True)
+    done = read_index(index)
+    skip = {"ok", "error"} if not retry_errors else {"ok"}
+    todo = [r for r in requests if done.get(r["id"]) not in skip]
+    counts = {"skipped": len(requests) - len(todo)}
+    logger.info(f"{len(todo)} routes to plan, {counts['skipped']} already in the index")
+
+    located = []
+    for request in todo:
+        if request["lat"] is None:
+            try:
+                request["lat"], request["lon"] = get_coordinates(request["address"])
+            except Exception as e:
+                _fail(request, f"cannot geocode {request['address']!r}: {e}", index, counts)
+                continue
+        located.append(request)
+
+    # Prima i gruppi più grandi, che tengono occupati i processi più a lungo
+    groups = sorted(group_requests(located), key=len, reverse=True)
+    logger.info(f"{len(located)} routes in {len(groups)} groups")
+
+    def add(group_counts):
+        for status, count in group_counts.items():
+            counts[status] = counts.get(status, 0) + count
+
+    if workers <= 1:
+        from processing.planner import budget
+
+        budget.install()
+        for group in groups:
+            add(plan_group(group, gpx_dir, index))
+        return counts
+
+    ctx = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(workers, mp_context=ctx, initializer=_init_process, initargs=(ctx.Lock(),)) as pool:
+        futures = [pool.submit(plan_group, group, gpx_dir, index) for group in groups]
+        for future in as_completed(futures):
+            add(future.result())
+    return counts
+
+
+def main(argv):
+    """Usage: python -m processing.batch <requests.csv|requests.jsonl> [--gpx-dir DIR] [--index FILE.jsonl]
+                                    [--workers N] [--retry-errors]
+
+    Plans a loop for every row (address or lat/lon, distance_km, and
+    optionally id, level, mode, sides). Results go to DIR/<id>.gpx and to
+    the JSONL route index (default DIR/index.jsonl); rerunning the same
+    command resumes after the routes already in the index.
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser(prog="python -m processing.batch", usage=main.__doc__.split("\n\n")[0][7:])
+    parser.add_argument("requests")
+    parser.add_argument("--gpx-dir")
+    parser.add_argument("--index")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--retry-errors", action="store_true")
+    args = parser.parse_args(argv)
+    index = args.index or (os.path.join(args.gpx_dir, "index.jsonl") if args.gpx_dir else None)
+    if index is None:
+        print(main.__doc__)
+        return 1
+
+    try:
+        requests = read_requests(args.requests)
+    except (OSError, ValueError) as e:
+        print(f"{args.requests}: {e}")
+        return 1
+    counts = plan_batch(requests, args.gpx_dir, index, args.workers, args.retry_errors)
+    print(", ".join(f"{count} {status}" for status, count in sorted(counts.items())))
+    return 1 if counts.get("error") else 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,177 @@
+import glob
+import logging
+import os
+import sys
+
+import numpy as np
+
+from processing.graph_store import offsets_from_counts
+
+logger = logging.getLogger(__name__)
+
+# Cartella con i tile DEM in formato GeoTIFF (EPSG:4326)
+DEM_DIR = os.getenv("DEM_DIR", "dem")
+
+# GeoTIFF tags
+MODEL_PIXEL_SCALE = 33550
+MODEL_TIEPOINT = 33922
+GEO_KEY_DIRECTORY = 34735
+GDAL_NODATA = 42113
+GT_RASTER_TYPE = 1025
+RASTER_PIXEL_IS_POINT = 2
+
+
+class DEMTile:
+    """One north-up GeoTIFF elevation raster in lat/lon coordinates.
+
+    The decoded raster is cached as a .npy file next to the GeoTIFF so later
+    loads are memory-mapped and shared between worker processes.
+    """
+
+    def __init__(self, path):
+        from PIL import Image
+
+        with Image.open(path) as img:
+            tags = img.tag_v2
+            scale_x, scale_y = tags[MODEL_PIXEL_SCALE][:2]
+            i, j, _, x, y, _ = tags[MODEL_TIEPOINT][:6]
+            nodata = tags.get(GDAL_NODATA)
+            keys = tags.get(GEO_KEY_DIRECTORY, ())
+            pixel_is_point = any(keys[k] == GT_RASTER_TYPE and keys[k + 3] == RASTER_PIXEL_IS_POINT
+                                 for k in range(4, len(keys) - 3, 4))
+
+            cache = os.path.splitext(path)[0] + ".npy"
+            if not os.path.exists(cache) or os.path.getmtime(cache) < os.path.getmtime(path):
+                data = np.asarray(img, dtype=np.float32)
+                if nodata is not None:
+                    data = np.where(data == float(nodata), np.nan, data)
+                np.save(cache, data)
+
+        self.data = np.load(cache, mmap_mode="r")
+        self.scale_x, self.scale_y = scale_x, scale_y
+        # Coordinate del centro del pixel (0, 0)
+        offset = 0.0 if pixel_is_point else 0.5
+        self.lon0 = x + (offset - i) * scale_x
+        self.lat0 = y - (offset - j) * scale_y
+        rows, cols = self.data.shape
+        self.bounds = (self.lat0 - (rows - 1) * scale_y, self.lon0, self.lat0, self.lon0 + (cols - 1) * scale_x)
+
+    def covers(self, lat, lon):
+        south, west, north, east = self.bounds
+        return (lat >= south) & (lat <= north) & (lon >= west) & (lon <= east)
+
+    def sample(self, lat, lon):
+        """Bilinear interpolation at arrays of points inside the tile."""
+        rows, cols = self.data.shape
+        r = np.clip((self.lat0 - lat) / self.scale_y, 0, rows - 1)
+        c = np.clip((lon - self.lon0) / self.scale_x, 0, cols - 1)
+        r0 = np.minimum(np.floor(r).astype(np.int64), rows - 2)
+        c0 = np.minimum(np.floor(c).astype(np.int64), cols - 2)
+        fr, fc = r - r0, c - c0
+        top = self.data[r0, c0] * (1 - fc) + self.data[r0, c0 + 1] * fc
+        bottom = self.data[r0 + 1, c0] * (1 - fc) + self.data[r0 + 1, c0 + 1] * fc
+        return top * (1 - fr) + bottom * fr
+
+
+class ElevationModel:
+    """Set of DEM tiles sampled in bulk for graph nodes."""
+
+    def __init__(self, paths):
+        self.tiles = [DEMTile(path) for path in paths]
+
+    def sample(self, lat, lon):
+        """Elevation in meters at arrays of points, NaN where no tile covers them."""
+        lat, lon = np.asarray(lat, dtype=np.float64), np.asarray(lon, dtype=np.float64)
+        elevation = np.full(lat.shape, np.nan, dtype=np.float32)
+        for tile in self.tiles:
+            mask = tile.covers(lat, lon) & np.isnan(elevation)
+            if mask.any():
+                elevation[mask] = tile.sample(lat[mask], lon[mask])
+        return elevation
+
+    def add_to(self, graph):
+        """Fill graph.elevation and the per-edge ascent in one vectorized pass.
+
+        The ascent of an edge is the sum of the climbs along its shape points,
+        so a simplified edge over a hill is not flattened to the difference
+        between its two ends.
+        """
+        elevation = self.sample(graph.lat, graph.lon)
+        missing = np.isnan(elevation)
+        if missing.all():
+            logger.warning("No DEM tile covers the graph, elevation not added")
+            return graph
+        if missing.any():
+            logger.warning(f"{int(missing.sum())} nodes outside the DEM, using the mean elevation")
+            elevation[missing] = np.nanmean(elevation)
+
+        sources = np.repeat(np.arange(graph.n_nodes), np.diff(graph.offsets))
+        graph.elevation = elevation
+        graph.ascent = self.edge_ascent(graph, elevation[sources], elevation[graph.targets])
+        return graph
+
+    def edge_ascent(self, graph, start, end):
+        """Positive elevation deltas summed along each edge, from start through its shape points to end."""
+        if graph.geom_offsets is None or graph.geom_offsets[-1] == graph.geom_offsets[0]:
+            return np.maximum(end - start, 0).astype(np.float32)
+        # Profilo di ogni arco: estremo iniziale, punti intermedi, estremo finale
+        sizes = np.diff(graph.geom_offsets) + 2
+        bounds = offsets_from_counts(sizes)
+        profile = np.empty(bounds[-1], dtype=np.float32)
+        inner = np.ones(bounds[-1], dtype=bool)
+        inner[bounds[:-1]] = inner[bounds[1:] - 1] = False
+        profile[~inner] = np.column_stack((start, end)).ravel()
+        first, last = graph.geom_offsets[0], graph.geom_offsets[-1]
+        profile[inner] = self.sample(graph.geom_lat[first:last], graph.geom_lon[first:last])
+
+        # I punti fuori dal DEM vengono saltati, senza spezzare il profilo dell'arco
+        edges = np.repeat(np.arange(len(sizes)), sizes)
+        known = ~np.isnan(profile)
+        profile, edges = profile[known], edges[known]
+        climbs = np.where(edges[1:] == edges[:-1], np.maximum(np.diff(profile), 0), 0)
+        return np.bincount(edges[:-1], weights=climbs, minlength=len(sizes)).astype(np.float32)
+
+
+_model = None
+
+
+def get_elevation_model():
+    """Return the DEM loaded from DEM_DIR, or None if there are no tiles."""
+    global _model
+    if _model is None:
+        paths = sorted(glob.glob(os.path.join(DEM_DIR, "*.tif")) + glob.glob(os.path.join(DEM_DIR, "*.tiff")))
+        if not paths:
+            return None
+        _model = ElevationModel(paths)
+        logger.info(f"Loaded {len(paths)} DEM tiles from {DEM_DIR}")
+    return _model
+
+
+def main(argv):
+    """Usage: python -m processing.elevation <region name>
+
+    Samples the DEM for a region of the graph store and saves elevation and
+    ascent next to its arrays.
+    """
+    from processing.graph_store import CSRGraph, GraphStore
+
+    if not argv:
+        print(main.__doc__)
+        return 1
+    dem = get_elevation_model()
+    if dem is None:
+        print(f"No GeoTIFF tiles found in {DEM_DIR}")
+        return 1
+
+    path = os.path.join(GraphStore().root, argv[0])
+    graph = dem.add_to(CSRGraph.load(path, mmap=False))
+    if graph.elevation is None:
+        return 1
+    np.save(os.path.join(path, "elevation.npy"), graph.elevation)
+    np.save(os.path.join(path, "ascent.npy"), graph.ascent)
+    return 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    sys.exit(main(sys.argv[1:]))
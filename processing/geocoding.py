@@ -0,0 +1,201 @@
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from urllib.parse import urlsplit
+
+from processing import metrics
+
+logger = logging.getLogger(__name__)
+
+# Configurazione della cache di geocoding
+GEOCODE_CACHE_PATH = os.getenv("GEOCODE_CACHE_PATH", "geocode_cache.sqlite")
+GEOCODE_TTL = int(os.getenv("GEOCODE_TTL", str(30 * 24 * 3600)))
+GEOCODE_NEGATIVE_TTL = int(os.getenv("GEOCODE_NEGATIVE_TTL", str(24 * 3600)))
+GEOCODE_MAX_ENTRIES = int(os.getenv("GEOCODE_MAX_ENTRIES", "50000"))
+
+# Nominatim usage policy: at most one request per second (a self-hosted instance can allow more)
+NOMINATIM_RATE = float(os.getenv("NOMINATIM_RATE", "1.0"))
+
+# Istanza Nominatim alternativa, ad esempio "http://127.0.0.1:8080" ("" = nominatim.openstreetmap.org)
+NOMINATIM_URL = os.getenv("NOMINATIM_URL", "")
+
+
+def normalize_address(address):
+    """Canonical form of an address so near-duplicates share a cache entry."""
+    text = unicodedata.normalize("NFKC", address).casefold()
+    text = re.sub(r"\s*,\s*", ", ", text)
+    text = re.sub(r"[^\w\s,'-]", " ", text)
+    text = re.sub(r"\s+", " ", text)
+    return text.strip(" ,")
+
+
+def _connect(path):
+    conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    return conn
+
+
+class NominatimBackend:
+    """Geocodes with a single reusable Nominatim client."""
+
+    def __init__(self, user_agent="route_planner_bot", timeout=10, url=NOMINATIM_URL):
+        from geopy.geocoders import Nominatim
+
+        options = {}
+        if url:
+            parts = urlsplit(url)
+            options = {"scheme": parts.scheme, "domain": parts.netloc + parts.path.rstrip("/")}
+        self.client = Nominatim(user_agent=user_agent, timeout=timeout, **options)
+
+    def geocode(self, address):
+        location = self.client.geocode(address)
+        if location is None:
+            return None
+        return location.latitude, location.longitude
+
+
+class StaticBackend:
+    """Local stand-in backend answering from a dict, for tests and offline runs."""
+
+    def __init__(self, locations):
+        self.locations = {normalize_address(k): v for k, v in locations.items()}
+        self.calls = 0
+
+    def geocode(self, address):
+        self.calls += 1
+        return self.locations.get(normalize_address(address))
+
+
+class GeocodeCache:
+    """Persistent LRU cache of geocoding results with TTL, stored in SQLite."""
+
+    def __init__(self, path=GEOCODE_CACHE_PATH, ttl=GEOCODE_TTL, negative_ttl=GEOCODE_NEGATIVE_TTL,
+                 max_entries=GEOCODE_MAX_ENTRIES):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._conn = _connect(path)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS geocode ("
+            "key TEXT PRIMARY KEY, lat REAL, lon REAL, created REAL, last_used REAL)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS geocode_last_used ON geocode (last_used)")
+
+    def get(self, key):
+        """Return (found, location); location is None for cached misses."""
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT lat, lon, created FROM geocode WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return False, None
+            lat, lon, created = row
+            ttl = self.ttl if lat is not None else self.negative_ttl
+            if now - created > ttl:
+                self._conn.execute("DELETE FROM geocode WHERE key = ?", (key,))
+                return False, None
+            self._conn.execute("UPDATE geocode SET last_used = ? WHERE key = ?", (now, key))
+        return True, (lat, lon) if lat is not None else None
+
+    def put(self, key, location):
+        now = time.time()
+        lat, lon = location if location is not None else (None, None)
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO geocode VALUES (?, ?, ?, ?, ?)", (key, lat, lon, now, now))
+            count = self._conn.execute("SELECT COUNT(*) FROM geocode").fetchone()[0]
+            if count > self.max_entries:
+                self._conn.execute(
+                    "DELETE FROM geocode WHERE key IN (SELECT key FROM geocode ORDER BY last_used LIMIT ?)",
+                    (count - self.max_entries,))
+
+
+class RateLimiter:
+    """Token bucket shared by every process using the same SQLite file."""
+
+    def __init__(self, path=GEOCODE_CACHE_PATH, rate=NOMINATIM_RATE, burst=1, name="nominatim"):
+        self.rate = rate
+        self.burst = burst
+        self.name = name
+        self._lock = threading.Lock()
+        self._conn = _connect(path)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS token_bucket (name TEXT PRIMARY KEY, tokens REAL, updated REAL)")
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                wait = self._take()
+            if wait is None:
+                return
+            time.sleep(wait)
+
+    def _take(self):
+        """Take a token if available, else return the seconds to wait for one."""
+        now = time.time()
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = self._conn.execute(
+                "SELECT tokens, updated FROM token_bucket WHERE name = ?", (self.name,)).fetchone()
+            tokens, updated = row if row else (self.burst, now)
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            if tokens >= 1:
+                self._conn.execute("INSERT OR REPLACE INTO token_bucket VALUES (?, ?, ?)",
+                                   (self.name, tokens - 1, now))
+                return None
+            self._conn.execute("INSERT OR REPLACE INTO token_bucket VALUES (?, ?, ?)", (self.name, tokens, now))
+            return (1 - tokens) / self.rate
+        finally:
+            self._conn.execute("COMMIT")
+
+
+class Geocoder:
+    """Cached, rate-limited geocoding in front of a pluggable backend."""
+
+    def __init__(self, backend=None, cache=None, limiter=None):
+        self.backend = backend or NominatimBackend()
+        self.cache = cache or GeocodeCache()
+        self.limiter = limiter or RateLimiter()
+
+    def geocode(self, address):
+        """Return (lat, lon) or None if the address is unknown."""
+        key = normalize_address(address)
+        found, location = self.cache.get(key)
+        if found:
+            logger.info(f"Geocode cache hit for '{key}'")
+            metrics.inc("cache_requests_total", cache="geocode", result="hit")
+            return location
+        metrics.inc("cache_requests_total", cache="geocode", result="miss")
+
+        with metrics.span("rate_limit_wait", limiter=self.limiter.name):
+            self.limiter.acquire()
+        with metrics.span("upstream_request", service=type(self.backend).__name__):
+            location = self.backend.geocode(address)
+        self.cache.put(key, location)
+        return location
+
+    def geocode_many(self, addresses):
+        """Geocode a batch, looking up each distinct normalized address only once."""
+        results = {}
+        for address in addresses:
+            key = normalize_address(address)
+            if key not in results:
+                results[key] = self.geocode(address)
+        return [results[normalize_address(address)] for address in addresses]
+
+
+_geocoder = None
+
+
+def get_geocoder():
+    global _geocoder
+    if _geocoder is None:
+        _geocoder = Geocoder()
+    return _geocoder
+
+
+def set_geocoder(geocoder):
+    """Replace the process-wide geocoder, e.g. with one using StaticBackend."""
+    global _geocoder
+    _geocoder = geocoder
@@ -0,0 +1,56 @@
+import io
+from xml.sax.saxutils import escape
+
+import numpy as np
+
+GPX_HEADER = (
+    '<?xml version="1.0" encoding="UTF-8"?>\n'
+    '<gpx xmlns="http://www.topografix.com/GPX/1/1" version="1.1" creator="OutdoorBuddyBot">\n'
+    '<trk>\n'
+)
+GPX_FOOTER = "</trkseg>\n</trk>\n</gpx>\n"
+
+
+def _points(lat, lon, ele=None):
+    if ele is None:
+        return [f'<trkpt lat="{y:.7f}" lon="{x:.7f}"></trkpt>\n' for y, x in zip(lat.tolist(), lon.tolist())]
+    return [f'<trkpt lat="{y:.7f}" lon="{x:.7f}"><ele>{z:.1f}</ele></trkpt>\n'
+            for y, x, z in zip(lat.tolist(), lon.tolist(), ele.tolist())]
+
+
+def write_gpx(out, graph, route, elevation=None, name=None):
+    """Stream the GPX track of route (node indices of graph) to a text file object.
+
+    Curved edges contribute their intermediate shape points. elevation is an
+    optional per-node array; shape points get values interpolated between
+    the two ends of their edge.
+    """
+    out.write(GPX_HEADER)
+    if name:
+        out.write(f"<name>{escape(name)}</name>\n")
+    out.write("<trkseg>\n")
+
+    for u, v in zip(route[:-1], route[1:]):
+        lat = [graph.lat[u]]
+        lon = [graph.lon[u]]
+        edge = graph.edge_index(u, v)
+        if edge >= 0:
+            shape_lat, shape_lon = graph.edge_shape(edge)
+            lat = np.concatenate((lat, shape_lat))
+            lon = np.concatenate((lon, shape_lon))
+        ele = None
+        if elevation is not None:
+            ele = np.interp(np.arange(len(lat)), [0, len(lat)], [elevation[u], elevation[v]])
+        out.writelines(_points(np.asarray(lat), np.asarray(lon), ele))
+
+    last = route[-1]
+    out.writelines(_points(graph.lat[last:last + 1], graph.lon[last:last + 1],
+                           None if elevation is None else elevation[last:last + 1]))
+    out.write(GPX_FOOTER)
+
+
+def gpx_bytes(graph, route, elevation=None, name=None):
+    """Return the GPX track of route as UTF-8 bytes."""
+    buffer = io.StringIO()
+    write_gpx(buffer, graph, route, elevation, name)
+    return buffer.getvalue().encode("utf-8")
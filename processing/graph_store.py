@@ -0,0 +1,569 @@
+import json
+import logging
+import math
+import os
+import re
+import sys
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+EARTH_RADIUS_M = 6_371_000
+
+# Cartella con le regioni precaricate
+GRAPH_STORE_DIR = os.getenv("GRAPH_STORE_DIR", "graph_store")
+
+# Indice spaziale salvato accanto agli array di ogni regione
+INDEX_FILE = "spatial_index.pkl"
+
+
+def distances_m(lat, lon, lat0, lon0):
+    """Vectorized haversine distance in meters from (lat0, lon0) to arrays of points."""
+    lat, lon = np.radians(lat), np.radians(lon)
+    lat0, lon0 = math.radians(lat0), math.radians(lon0)
+    a = np.sin((lat - lat0) / 2) ** 2 + np.cos(lat) * math.cos(lat0) * np.sin((lon - lon0) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(a))
+
+
+def ranges(offsets, indices):
+    """Concatenated positions offsets[i]:offsets[i + 1] for every i in indices, and their counts."""
+    starts = offsets[indices]
+    counts = offsets[indices + 1] - starts
+    positions = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(int(counts.sum()))
+    return positions, counts
+
+
+# Vie di ogni rete come (tag, operatore, valori) di un filtro Overpass, gli stessi di network_type in osmnx 2.0
+NETWORK_FILTERS = {
+    "bike": [
+        ("highway", "", ""), ("area", "!~", "yes"), ("access", "!~", "private"),
+        ("highway", "!~", "abandoned|bus_guideway|construction|corridor|elevator|escalator|footway|motor|no|"
+                          "planned|platform|proposed|raceway|razed|steps"),
+        ("bicycle", "!~", "no"), ("service", "!~", "private"),
+    ],
+    "walk": [
+        ("highway", "", ""), ("area", "!~", "yes"), ("access", "!~", "private"),
+        ("highway", "!~", "abandoned|bus_guideway|construction|cycleway|motor|no|planned|platform|proposed|"
+                          "raceway|razed"),
+        ("foot", "!~", "no"), ("service", "!~", "private"), ("sidewalk", "!~", "separate"),
+        ("sidewalk:both", "!~", "separate"), ("sidewalk:left", "!~", "separate"),
+        ("sidewalk:right", "!~", "separate"),
+    ],
+    "drive": [
+        ("highway", "", ""), ("area", "!~", "yes"), ("access", "!~", "private"),
+        ("highway", "!~", "abandoned|bridleway|bus_guideway|construction|corridor|cycleway|elevator|escalator|"
+                          "footway|no|path|pedestrian|planned|platform|proposed|raceway|razed|service|steps|track"),
+        ("motor_vehicle", "!~", "no"), ("motorcar", "!~", "no"),
+        ("service", "!~", "alley|driveway|emergency_access|parking|parking_aisle|private"),
+    ],
+}
+
+
+def network_filter(mode):
+    """(tag, operator, pattern) conditions selecting the ways of a network mode."""
+    try:
+        return NETWORK_FILTERS[mode]
+    except KeyError:
+        raise ValueError(f"Unknown network mode {mode!r}, expected one of {', '.join(NETWORK_FILTERS)}") from None
+
+
+def overpass_filter(mode):
+    """The conditions of network_filter as an Overpass way filter, e.g. for osmnx's custom_filter."""
+    return "".join(f'["{key}"{operator}"{pattern}"]' if operator else f'["{key}"]'
+                   for key, operator, pattern in network_filter(mode))
+
+
+def matches_filter(tags, conditions):
+    """Whether a way's tags pass the conditions of network_filter, with Overpass semantics."""
+    for key, operator, pattern in conditions:
+        value = tags.get(key)
+        if isinstance(value, list):
+            value = ";".join(map(str, value))
+        if not operator:
+            ok = value is not None
+        elif operator == "~":
+            ok = value is not None and re.search(pattern, str(value)) is not None
+        else:
+            ok = value is None or re.search(pattern, str(value)) is None
+        if not ok:
+            return False
+    return True
+
+
+def graph_from_osm_extract(source, mode="bike"):
+    """Load an OSM XML extract as an osmnx graph of the mode's network.
+
+    osmnx reads every highway way of an extract; the ways outside the
+    mode's network_filter, which tiles are downloaded with (motorways for
+    bikes, cycleways for walking, private roads, ...), are removed before
+    the largest connected component is simplified.
+    """
+    import osmnx as ox
+
+    conditions = network_filter(mode)
+    # Solo per la lettura: i tag usati dal filtro devono restare sugli archi
+    useful_tags = ox.settings.useful_tags_way
+    ox.settings.useful_tags_way = sorted(set(useful_tags) | {key for key, _, _ in conditions})
+    try:
+        G = ox.graph_from_xml(source, bidirectional=mode in ox.settings.bidirectional_network_types,
+                              simplify=False, retain_all=True)
+    finally:
+        ox.settings.useful_tags_way = useful_tags
+    G.remove_edges_from([(u, v, k) for u, v, k, tags in G.edges(keys=True, data=True)
+                         if not matches_filter(tags, conditions)])
+    # Come graph_from_xml senza retain_all, solo la componente connessa più grande
+    return ox.simplify_graph(ox.truncate.largest_component(G))
+
+
+def offsets_from_counts(counts):
+    offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    return offsets
+
+
+class CSRGraph:
+    """Road graph stored as flat arrays in compressed sparse row layout.
+
+    Nodes are sorted by OSM id; the out-edges of node i are
+    targets[offsets[i]:offsets[i + 1]] with the matching lengths in meters.
+    The intermediate shape points of edge e, when known, are
+    geom_lat/geom_lon[geom_offsets[e]:geom_offsets[e + 1]]. Node elevation
+    and per-edge ascent in meters are present once a DEM has been sampled.
+    """
+
+    __slots__ = ("node_ids", "lat", "lon", "offsets", "targets", "lengths",
+                 "geom_offsets", "geom_lat", "geom_lon", "elevation", "ascent")
+
+    ARRAYS = ("node_ids", "lat", "lon", "offsets", "targets", "lengths")
+    OPTIONAL_ARRAYS = ("geom_offsets", "geom_lat", "geom_lon", "elevation", "ascent")
+
+    def __init__(self, node_ids, lat, lon, offsets, targets, lengths,
+                 geom_offsets=None, geom_lat=None, geom_lon=None, elevation=None, ascent=None):
+        self.node_ids = node_ids
+        self.lat = lat
+        self.lon = lon
+        self.offsets = offsets
+        self.targets = targets
+        self.lengths = lengths
+        self.geom_offsets = geom_offsets
+        self.geom_lat = geom_lat
+        self.geom_lon = geom_lon
+        self.elevation = elevation
+        self.ascent = ascent
+
+    @property
+    def n_nodes(self):
+        return len(self.node_ids)
+
+    @property
+    def n_edges(self):
+        return len(self.targets)
+
+    @property
+    def nbytes(self):
+        return sum(getattr(self, name).nbytes for name in self.ARRAYS + self.OPTIONAL_ARRAYS
+                   if getattr(self, name) is not None)
+
+    @classmethod
+    def from_networkx(cls, G):
+        """Build the arrays from an osmnx graph, keeping the shortest of parallel edges."""
+        node_ids = np.array(sorted(G.nodes()), dtype=np.int64)
+        lat = np.array([G.nodes[n]["y"] for n in node_ids], dtype=np.float64)
+        lon = np.array([G.nodes[n]["x"] for n in node_ids], dtype=np.float64)
+
+        best = {}
+        for u, v, data in G.edges(data=True):
+            if u == v:
+                continue
+            length = data.get("length", 0.0)
+            if (u, v) not in best or length < best[(u, v)][0]:
+                best[(u, v)] = (length, data.get("geometry"))
+
+        if best:
+            pairs = np.array(list(best.keys()), dtype=np.int64)
+            sources = np.searchsorted(node_ids, pairs[:, 0])
+            targets = np.searchsorted(node_ids, pairs[:, 1])
+            lengths = np.fromiter((b[0] for b in best.values()), dtype=np.float32, count=len(best))
+        else:
+            sources = targets = np.empty(0, dtype=np.int64)
+            lengths = np.empty(0, dtype=np.float32)
+
+        order = np.lexsort((targets, sources))
+        offsets = offsets_from_counts(np.bincount(sources, minlength=len(node_ids)))
+
+        # Punti intermedi della geometria (esclusi gli estremi, che sono nodi)
+        geometries = list(best.values())
+        shapes = []
+        for i in order:
+            geometry = geometries[i][1]
+            shapes.append(np.asarray(geometry.coords)[1:-1] if geometry is not None else np.empty((0, 2)))
+        geom_offsets = offsets_from_counts([len(shape) for shape in shapes])
+        points = np.concatenate(shapes) if shapes else np.empty((0, 2))
+
+        return cls(node_ids, lat, lon, offsets, targets[order].astype(np.int32), lengths[order],
+                   geom_offsets, points[:, 1].astype(np.float64), points[:, 0].astype(np.float64))
+
+    @classmethod
+    def merge(cls, graphs):
+        """Union of graphs sharing OSM node ids, e.g. adjacent tiles of a network.
+
+        Nodes present in several graphs are kept once and of the edges joining
+        the same two nodes the shortest is kept, with its shape. Elevation and
+        ascent survive only if every graph has them.
+        """
+        graphs = [graph for graph in graphs if graph.n_nodes]
+        if len(graphs) == 1:
+            return graphs[0]
+        if not graphs:
+            empty = np.empty(0, dtype=np.int64)
+            return cls(empty, empty.astype(np.float64), empty.astype(np.float64), np.zeros(1, dtype=np.int64),
+                       empty.astype(np.int32), empty.astype(np.float32))
+
+        all_ids = np.concatenate([graph.node_ids for graph in graphs])
+        node_ids, first = np.unique(all_ids, return_index=True)
+
+        def nodes(name):
+            if any(getattr(graph, name) is None for graph in graphs):
+                return None
+            return np.concatenate([getattr(graph, name) for graph in graphs])[first]
+
+        # Archi come coppie di id OSM, poi rinumerati sui nodi dell'unione
+        src_ids = np.concatenate([np.repeat(graph.node_ids, np.diff(graph.offsets)) for graph in graphs])
+        dst_ids = np.concatenate([graph.node_ids[graph.targets] for graph in graphs])
+        lengths = np.concatenate([graph.lengths for graph in graphs])
+        sources = np.searchsorted(node_ids, src_ids)
+        targets = np.searchsorted(node_ids, dst_ids)
+
+        # Il più corto di ogni gruppo (source, target) è il primo nell'ordinamento
+        order = np.lexsort((lengths, targets, sources))
+        sources, targets = sources[order], targets[order]
+        first_of_pair = np.ones(len(order), dtype=bool)
+        first_of_pair[1:] = (sources[1:] != sources[:-1]) | (targets[1:] != targets[:-1])
+        edges = order[first_of_pair]
+        sources, targets = sources[first_of_pair], targets[first_of_pair]
+
+        geometry = (None, None, None)
+        if any(graph.geom_offsets is not None for graph in graphs):
+            counts = np.concatenate([np.diff(graph.geom_offsets) if graph.geom_offsets is not None
+                                     else np.zeros(graph.n_edges, dtype=np.int64) for graph in graphs])
+            points, counts = ranges(offsets_from_counts(counts), edges)
+            geom_lat = np.concatenate([graph.geom_lat for graph in graphs if graph.geom_offsets is not None])
+            geom_lon = np.concatenate([graph.geom_lon for graph in graphs if graph.geom_offsets is not None])
+            geometry = (offsets_from_counts(counts), geom_lat[points], geom_lon[points])
+
+        ascent = None
+        if all(graph.ascent is not None for graph in graphs):
+            ascent = np.concatenate([graph.ascent for graph in graphs])[edges]
+
+        return cls(node_ids, nodes("lat"), nodes("lon"),
+                   offsets_from_counts(np.bincount(sources, minlength=len(node_ids))),
+                   targets.astype(np.int32), lengths[edges], *geometry,
+                   elevation=nodes("elevation"), ascent=ascent)
+
+    def simplified(self):
+        """Join the edges through nodes that only continue a road, like osmnx's simplify_graph.
+
+        A node is kept if it is a junction, a dead end or where a road turns
+        from one-way to two-way. The nodes removed become shape points of
+        the joined edge, whose length and ascent are the sums of its parts.
+        Of parallel edges the shortest is kept.
+        """
+        n = self.n_nodes
+        if not n:
+            return self
+        sources = np.repeat(np.arange(n), np.diff(self.offsets))
+        targets = self.targets.astype(np.int64)
+        out_degree = np.diff(self.offsets)
+        in_degree = np.bincount(targets, minlength=n)
+        pairs = np.unique(np.concatenate([sources * n + targets, targets * n + sources]))
+        neighbours = np.bincount(pairs // n, minlength=n)
+        interior = (neighbours == 2) & (((in_degree == 1) & (out_degree == 1)) |
+                                        ((in_degree == 2) & (out_degree == 2)))
+
+        while True:
+            # Arco successivo lungo la strada: l'uscita del nodo interno che non torna indietro
+            follow = interior[targets]
+            nxt = np.full(self.n_edges, -1, dtype=np.int64)
+            first = self.offsets[targets[follow]]
+            nxt[follow] = np.where(targets[first] == sources[follow], first + 1, first)
+
+            # Pointer jumping: ultimo arco di ogni catena e archi che mancano per arrivarci
+            last = np.where(nxt >= 0, nxt, np.arange(self.n_edges))
+            hops = (nxt >= 0).astype(np.int64)
+            for _ in range(max(self.n_edges, 1).bit_length() + 1):
+                hops = hops + hops[last]
+                last = last[last]
+            cyclic = nxt[last] >= 0
+            if not cyclic.any():
+                break
+            # Anelli senza incroci: i loro nodi restano
+            interior[sources[cyclic]] = False
+
+        order = np.lexsort((-hops, last))
+        chain_starts = np.nonzero(np.r_[True, last[order][1:] != last[order][:-1]])[0]
+        # Il primo arco di ogni catena è quello che parte da un nodo tenuto
+        chain_sources = sources[order[chain_starts]]
+        chain_targets = targets[last[order[chain_starts]]]
+        chain_lengths = np.add.reduceat(self.lengths[order].astype(np.float64), chain_starts).astype(np.float32)
+        chain_ascent = None
+        if self.ascent is not None:
+            chain_ascent = np.add.reduceat(self.ascent[order].astype(np.float64), chain_starts).astype(np.float32)
+
+        # Forma: i punti di ogni arco seguiti dal suo nodo di arrivo, tranne per l'ultimo arco
+        shape_counts = (np.diff(self.geom_offsets)[order] if self.geom_offsets is not None
+                        else np.zeros(len(order), dtype=np.int64))
+        through = nxt[order] >= 0
+        point_offsets = offsets_from_counts(shape_counts + through)
+        geom_lat = np.empty(point_offsets[-1], dtype=np.float64)
+        geom_lon = np.empty(point_offsets[-1], dtype=np.float64)
+        if self.geom_offsets is not None:
+            points, counts = ranges(self.geom_offsets, order)
+            slots = np.repeat(point_offsets[:-1] - np.cumsum(counts) + counts, counts) + np.arange(len(points))
+            geom_lat[slots] = self.geom_lat[points]
+            geom_lon[slots] = self.geom_lon[points]
+        node_slots = point_offsets[1:][through] - 1
+        geom_lat[node_slots] = self.lat[targets[order[through]]]
+        geom_lon[node_slots] = self.lon[targets[order[through]]]
+        chain_counts = np.add.reduceat(shape_counts + through, chain_starts)
+        chain_geom_offsets = offsets_from_counts(chain_counts)
+
+        keep = np.nonzero(~interior)[0]
+        new_index = np.full(n, -1, dtype=np.int64)
+        new_index[keep] = np.arange(len(keep))
+        chain_sources, chain_targets = new_index[chain_sources], new_index[chain_targets]
+
+        # Come in from_networkx: niente anelli su un nodo, il più corto degli archi paralleli
+        edges = np.nonzero(chain_sources != chain_targets)[0]
+        edges = edges[np.lexsort((chain_lengths[edges], chain_targets[edges], chain_sources[edges]))]
+        first_of_pair = np.ones(len(edges), dtype=bool)
+        first_of_pair[1:] = ((chain_sources[edges][1:] != chain_sources[edges][:-1]) |
+                             (chain_targets[edges][1:] != chain_targets[edges][:-1]))
+        edges = edges[first_of_pair]
+        points, counts = ranges(chain_geom_offsets, edges)
+
+        return CSRGraph(self.node_ids[keep], self.lat[keep], self.lon[keep],
+                        offsets_from_counts(np.bincount(chain_sources[edges], minlength=len(keep))),
+                        chain_targets[edges].astype(np.int32), chain_lengths[edges],
+                        offsets_from_counts(counts), geom_lat[points], geom_lon[points],
+                        elevation=None if self.elevation is None else self.elevation[keep],
+                        ascent=None if chain_ascent is None else chain_ascent[edges])
+
+    def to_networkx(self):
+        import networkx as nx
+
+        G = nx.MultiDiGraph(crs="epsg:4326")
+        for i, node in enumerate(self.node_ids.tolist()):
+            G.add_node(node, y=float(self.lat[i]), x=float(self.lon[i]))
+        sources = np.repeat(self.node_ids, np.diff(self.offsets))
+        G.add_edges_from(
+            (int(u), int(v), {"length": float(length)})
+            for u, v, length in zip(sources, self.node_ids[self.targets], self.lengths)
+        )
+        return G
+
+    def index_of(self, node_id):
+        i = int(np.searchsorted(self.node_ids, node_id))
+        if i >= self.n_nodes or self.node_ids[i] != node_id:
+            raise KeyError(node_id)
+        return i
+
+    def edge_index(self, u, v):
+        """Position of the edge u -> v in targets, or -1 if there is none."""
+        start, end = self.offsets[u], self.offsets[u + 1]
+        i = start + int(np.searchsorted(self.targets[start:end], v))
+        return i if i < end and self.targets[i] == v else -1
+
+    def edge_shape(self, edge):
+        """Intermediate (lat, lon) points of an edge, empty if the edge is straight."""
+        if self.geom_offsets is None:
+            return self.lat[:0], self.lon[:0]
+        start, end = self.geom_offsets[edge], self.geom_offsets[edge + 1]
+        return self.geom_lat[start:end], self.geom_lon[start:end]
+
+    def out_edges(self, indices):
+        """Return (sources, edge positions) for all out-edges of the given node indices."""
+        edges, counts = ranges(self.offsets, indices)
+        return np.repeat(indices, counts), edges
+
+    def subgraph(self, keep):
+        """Return the graph induced by the node indices in keep (sorted)."""
+        keep = np.asarray(keep, dtype=np.int64)
+        new_index = np.full(self.n_nodes, -1, dtype=np.int64)
+        new_index[keep] = np.arange(len(keep))
+
+        sources, edges = self.out_edges(keep)
+        targets = new_index[self.targets[edges]]
+        inside = targets >= 0
+        sources = new_index[sources[inside]]
+        edges = edges[inside]
+
+        geometry = (None, None, None)
+        if self.geom_offsets is not None:
+            points, counts = ranges(self.geom_offsets, edges)
+            geometry = (offsets_from_counts(counts), self.geom_lat[points], self.geom_lon[points])
+
+        return CSRGraph(self.node_ids[keep], self.lat[keep], self.lon[keep],
+                        offsets_from_counts(np.bincount(sources, minlength=len(keep))),
+                        targets[inside].astype(np.int32), self.lengths[edges], *geometry,
+                        elevation=None if self.elevation is None else self.elevation[keep],
+                        ascent=None if self.ascent is None else self.ascent[edges])
+
+    def within(self, lat, lon, radius_m):
+        """Cut out the subgraph of nodes within radius_m of a point."""
+        keep = np.nonzero(distances_m(self.lat, self.lon, lat, lon) <= radius_m)[0]
+        return self.subgraph(keep)
+
+    def bbox(self):
+        return [float(self.lat.min()), float(self.lon.min()), float(self.lat.max()), float(self.lon.max())]
+
+    def save(self, path, **meta):
+        """Save the arrays as .npy files so they can be memory-mapped by load()."""
+        os.makedirs(path, exist_ok=True)
+        for name in self.ARRAYS + self.OPTIONAL_ARRAYS:
+            if getattr(self, name) is not None:
+                np.save(os.path.join(path, f"{name}.npy"), getattr(self, name))
+        meta.update(bbox=self.bbox() if self.n_nodes else None, nodes=self.n_nodes, edges=self.n_edges)
+        with open(os.path.join(path, "meta.json"), "w") as f:
+            json.dump(meta, f)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        mode = "r" if mmap else None
+        arrays = {}
+        for name in cls.ARRAYS + cls.OPTIONAL_ARRAYS:
+            file = os.path.join(path, f"{name}.npy")
+            if name in cls.ARRAYS or os.path.exists(file):
+                arrays[name] = np.load(file, mmap_mode=mode)
+        return cls(**arrays)
+
+
+class GraphStore:
+    """Directory of preloaded regions, one CSRGraph per subdirectory."""
+
+    def __init__(self, root=GRAPH_STORE_DIR):
+        self.root = root
+        self._graphs = {}
+        self._indexes = {}
+
+    def regions(self):
+        if not os.path.isdir(self.root):
+            return {}
+        regions = {}
+        for name in sorted(os.listdir(self.root)):
+            meta_file = os.path.join(self.root, name, "meta.json")
+            if os.path.exists(meta_file):
+                with open(meta_file) as f:
+                    regions[name] = json.load(f)
+        return regions
+
+    def get(self, name):
+        if name not in self._graphs:
+            self._graphs[name] = CSRGraph.load(os.path.join(self.root, name))
+        return self._graphs[name]
+
+    def index(self, name):
+        """Spatial index of a region, loaded from disk or built and saved on first use."""
+        if name not in self._indexes:
+            from processing.spatial_index import SpatialIndex
+
+            path = os.path.join(self.root, name, INDEX_FILE)
+            index = None
+            if os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(
+                    os.path.join(self.root, name, "lat.npy")):
+                try:
+                    index = SpatialIndex.load(path)
+                except Exception as e:
+                    logger.warning(f"Rebuilding spatial index of {name}: {e}")
+            if index is None:
+                graph = self.get(name)
+                index = SpatialIndex.build(graph.lat, graph.lon)
+                index.save(path)
+                logger.info(f"Built spatial index of {name}")
+            self._indexes[name] = index
+        return self._indexes[name]
+
+    def snap(self, lat, lon, mode="bike"):
+        """Snap points (scalars or arrays) to the nearest node of the stored regions.
+
+        Returns (OSM node ids, distances in meters) as arrays, with -1 and inf
+        for points outside every region.
+        """
+        lat = np.atleast_1d(np.asarray(lat, dtype=np.float64))
+        lon = np.atleast_1d(np.asarray(lon, dtype=np.float64))
+        node_ids = np.full(len(lat), -1, dtype=np.int64)
+        dist = np.full(len(lat), np.inf)
+        remaining = np.ones(len(lat), dtype=bool)
+        for name, meta in self.regions().items():
+            if meta.get("mode", mode) != mode:
+                continue
+            south, west, north, east = meta["bbox"]
+            inside = remaining & (lat >= south) & (lat <= north) & (lon >= west) & (lon <= east)
+            if inside.any():
+                idx, dist[inside] = self.index(name).nearest(lat[inside], lon[inside])
+                node_ids[inside] = self.get(name).node_ids[idx]
+                remaining &= ~inside
+        return node_ids, dist
+
+    def find(self, lat, lon, radius_m, mode="bike"):
+        """Return the name of a stored region covering the circle, or None."""
+        dlat = math.degrees(radius_m / EARTH_RADIUS_M)
+        dlon = dlat / max(math.cos(math.radians(lat)), 1e-6)
+        for name, meta in self.regions().items():
+            south, west, north, east = meta["bbox"]
+            if meta.get("mode", mode) != mode:
+                continue
+            if south <= lat - dlat and lat + dlat <= north and west <= lon - dlon and lon + dlon <= east:
+                return name
+        return None
+
+    def graph_around(self, lat, lon, radius_m, mode="bike"):
+        """Cut a radius subgraph from a stored region, or return None if no region covers it."""
+        name = self.find(lat, lon, radius_m, mode)
+        if name is None:
+            return None
+        logger.info(f"Using stored region {name} for radius {radius_m / 1000:.2f} km")
+        return self.get(name).within(lat, lon, radius_m)
+
+    def add_region(self, name, source, mode="bike"):
+        """Preload a region from a GraphML or OSM XML extract on disk.
+
+        A GraphML file is stored as it is, so it should hold the network of
+        mode (e.g. saved by osmnx with network_type=mode); an OSM extract is
+        filtered to that network first.
+        """
+        import osmnx as ox
+
+        if source.endswith(".graphml"):
+            G = ox.load_graphml(source)
+        else:
+            G = graph_from_osm_extract(source, mode)
+        graph = CSRGraph.from_networkx(G)
+        del G
+
+        from processing.elevation import get_elevation_model
+
+        dem = get_elevation_model()
+        if dem is not None:
+            dem.add_to(graph)
+        graph.save(os.path.join(self.root, name), mode=mode, source=os.path.basename(source))
+        self._graphs.pop(name, None)
+        self._indexes.pop(name, None)
+        self.index(name)
+        logger.info(f"Stored region {name}: {graph.n_nodes} nodes, {graph.n_edges} edges")
+        return graph
+
+
+def main(argv):
+    """Usage: python -m processing.graph_store <region name> <extract.graphml|extract.osm> [mode]"""
+    if len(argv) < 2:
+        print(main.__doc__)
+        return 1
+    mode = argv[2] if len(argv) > 2 else "bike"
+    GraphStore().add_region(argv[0], argv[1], mode)
+    return 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    sys.exit(main(sys.argv[1:]))
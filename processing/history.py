@@ -0,0 +1,140 @@
+import logging
+import os
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+
+from processing import metrics
+
+logger = logging.getLogger(__name__)
+
+# Cartella con un file Parquet di osservazioni giornaliere per stazione
+HISTORY_CACHE_DIR = os.getenv("HISTORY_CACHE_DIR", "history_cache")
+
+# Meteostat publishes daily data with a few days of delay: the most recent
+# days are fetched again, at most once per REFRESH_INTERVAL seconds
+REFRESH_DAYS = 3
+REFRESH_INTERVAL = int(os.getenv("HISTORY_REFRESH_INTERVAL", "3600"))
+
+
+class StationIndex:
+    """Nearest weather station lookup over the Meteostat station list."""
+
+    def __init__(self):
+        import numpy as np
+        from meteostat import Stations
+        from sklearn.neighbors import BallTree
+
+        stations = Stations().inventory("daily").fetch()
+        stations = stations.dropna(subset=["latitude", "longitude"])
+        self.ids = stations.index.to_numpy()
+        self.names = stations["name"].to_numpy()
+        self.tree = BallTree(np.radians(stations[["latitude", "longitude"]].to_numpy()), metric="haversine")
+
+    def nearest(self, lat, lon):
+        """Return (station id, station name, distance in km)."""
+        import numpy as np
+
+        dist, idx = self.tree.query(np.radians([[lat, lon]]), k=1)
+        i = int(idx[0][0])
+        return self.ids[i], self.names[i], float(dist[0][0]) * 6371
+
+
+class DailyCache:
+    """Daily observations per station, kept in Parquet files and extended incrementally."""
+
+    def __init__(self, root=HISTORY_CACHE_DIR):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, station):
+        return os.path.join(self.root, f"{station}.parquet")
+
+    def load(self, station):
+        path = self._path(station)
+        if not os.path.exists(path):
+            return None
+        import pandas as pd
+
+        try:
+            return pd.read_parquet(path)
+        except (OSError, ValueError) as e:
+            # File rovinato da una scrittura interrotta: viene riscaricato
+            logger.warning(f"Ignoring unreadable history file {path}: {e}")
+            return None
+
+    def _save(self, station, data):
+        """Write a station's file atomically, so readers never see a partial file."""
+        path = self._path(station)
+        tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+        try:
+            data.to_parquet(tmp)
+            os.replace(tmp, path)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def _fetch(self, station, start, end):
+        import pandas as pd
+        from meteostat import Daily
+
+        logger.info(f"Fetching daily data for station {station} from {start:%Y-%m-%d} to {end:%Y-%m-%d}")
+        with metrics.span("upstream_request", service="meteostat"):
+            data = Daily(station, start, end).fetch()
+        # Le date senza dati restano come NaN, così non vengono richieste di nuovo
+        return data.reindex(pd.date_range(start, end, freq="D", name="time"))
+
+    def get(self, station, start, end):
+        """Daily rows for station between start and end, fetching only what is missing."""
+        import pandas as pd
+
+        cached = self.load(station)
+        fresh = cached is not None and time.time() - os.path.getmtime(self._path(station)) < REFRESH_INTERVAL
+
+        if cached is None or cached.empty or cached.index.min() > start:
+            fetch_from = start
+        else:
+            fetch_from = cached.index.max() + timedelta(days=1)
+            if not fresh:
+                fetch_from = min(fetch_from, end - timedelta(days=REFRESH_DAYS - 1))
+
+        metrics.inc("cache_requests_total", cache="history", result="miss" if fetch_from <= end else "hit")
+        if fetch_from <= end:
+            new = self._fetch(station, fetch_from, end)
+            data = new if cached is None else pd.concat([cached, new])
+            data = data[~data.index.duplicated(keep="last")].sort_index()
+            self._save(station, data)
+        else:
+            data = cached
+
+        return data.loc[start:end]
+
+
+_station_index = None
+_daily_cache = None
+# mean_temperatures gira nei thread dell'executor: l'indice delle stazioni va costruito una volta sola
+_init_lock = threading.Lock()
+
+
+def mean_temperatures(lat, lon, days=7):
+    """Mean daily temperature of the last days at the station nearest to a point.
+
+    Returns (station name, Series of tavg indexed by date).
+    """
+    # pandas e meteostat vengono caricati al primo uso, non all'avvio del bot
+    import pandas as pd
+
+    global _station_index, _daily_cache
+    if _station_index is None:
+        with _init_lock:
+            if _station_index is None:
+                _daily_cache = DailyCache()
+                _station_index = StationIndex()
+
+    station, name, distance = _station_index.nearest(lat, lon)
+    logger.info(f"Nearest station {station} ({name}) at {distance:.1f} km")
+
+    end = pd.Timestamp(datetime.now().date()) - timedelta(days=1)
+    start = end - timedelta(days=days - 1)
+    return name, _daily_cache.get(station, start, end)["tavg"]
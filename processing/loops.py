@@ -0,0 +1,195 @@
+import logging
+
+import numpy as np
+from scipy.sparse.csgraph import dijkstra
+
+from processing.graph_store import distances_m
+from processing.routing import walk
+
+logger = logging.getLogger(__name__)
+
+# Tolleranza sulla lunghezza rispetto alla distanza richiesta
+TOLERANCE = 0.3
+
+# Rapporto medio tra distanza su strada e distanza in linea d'aria
+DETOUR_FACTOR = 1.2
+
+# Moltiplicatore sul peso degli archi già usati da un tratto precedente
+REUSE_PENALTY = 5.0
+
+
+def search_radius(target_m, sides=3):
+    """Straight-line radius expected to contain every waypoint of a loop of target_m."""
+    leg = target_m / 2 if sides < 3 else target_m / sides
+    return leg / DETOUR_FACTOR * 1.1
+
+
+def in_band(length, target_m, tolerance=TOLERANCE):
+    return (1 - tolerance) * target_m <= length <= (1 + tolerance) * target_m
+
+
+def path_length(matrix, path):
+    if len(path) < 2:
+        return 0.0
+    return float(np.asarray(matrix[path[:-1], path[1:]]).sum())
+
+
+def reused_fraction(path):
+    """Share of the loop's edges that are travelled more than once, in either direction."""
+    edges = [tuple(sorted(e)) for e in zip(path[:-1], path[1:])]
+    if not edges:
+        return 0.0
+    return 1 - len(set(edges)) / len(edges)
+
+
+def penalize(matrix, path, factor=REUSE_PENALTY):
+    """Copy of matrix with the edges of path (both directions) made more expensive."""
+    penalized = matrix.copy()
+    for u, v in zip(path[:-1], path[1:]):
+        for a, b in ((u, v), (v, u)):
+            row = slice(penalized.indptr[a], penalized.indptr[a + 1])
+            hit = np.nonzero(penalized.indices[row] == b)[0]
+            penalized.data[row][hit] *= factor
+    return penalized
+
+
+def out_and_back(engine, target_m, tolerance=TOLERANCE, limit=5):
+    """Out-and-back loops whose length falls in the target band, best first."""
+    ranked = engine.rank(target_m)
+    lengths = engine.loop_lengths[ranked]
+    ranked = ranked[(lengths >= (1 - tolerance) * target_m) & (lengths <= (1 + tolerance) * target_m)]
+    return [(engine.loop(int(node)), float(engine.loop_lengths[node])) for node in ranked[:limit]]
+
+
+def _spread_by_bearing(graph, start, nodes, score, count):
+    """Pick the best scoring node in each of count directions around start."""
+    bearings = np.degrees(np.arctan2(graph.lon[nodes] - graph.lon[start], graph.lat[nodes] - graph.lat[start]))
+    bins = np.minimum(((bearings + 180) // (360 / count)).astype(int), count - 1)
+    picked = []
+    for b in range(count):
+        in_bin = nodes[bins == b]
+        if len(in_bin):
+            picked.append(int(in_bin[np.argmin(score[in_bin])]))
+    return picked
+
+
+def polygon_through(matrix, lat, lon, start, dist_back, path, leg, sides, stopped=None):
+    """Close a polygon loop whose first leg, from start to the first waypoint, is path.
+
+    Each further leg is routed on a graph where the edges of earlier legs are
+    penalized, so the loop avoids coming back on the same roads. Returns the
+    loop's node path, or None if it cannot be closed or stopped() turns true
+    between two legs.
+    """
+    path = list(path)
+    penalized = penalize(matrix, path)
+    current = path[-1]
+    used = [start, current]
+
+    for k in range(2, sides):
+        if stopped is not None and stopped():
+            return None
+        dist, pred = dijkstra(penalized, indices=current, return_predecessors=True, limit=2 * leg)
+        # Prossimo vertice: circa un lato dal precedente, lontano dai vertici già usati
+        remaining = leg * (sides - k)
+        spread = np.min([distances_m(lat, lon, lat[u], lon[u]) for u in used], axis=0)
+        score = np.abs(dist - leg) + np.abs(dist_back - remaining) - 0.5 * spread
+        score[~np.isfinite(score)] = np.inf
+        score[used] = np.inf
+        nxt = int(np.argmin(score))
+        if not np.isfinite(score[nxt]):
+            return None
+        step = walk(pred, nxt)[::-1]
+        path += step[1:]
+        penalized = penalize(penalized, step)
+        current = nxt
+        used.append(nxt)
+
+    if stopped is not None and stopped():
+        return None
+    dist, pred = dijkstra(penalized.T.tocsr(), indices=start, return_predecessors=True)
+    if not np.isfinite(dist[current]):
+        return None
+    return path + walk(pred, current)[1:]
+
+
+def polygon_loops(engine, target_m, sides=3, tolerance=TOLERANCE, attempts=4, pool=None, enough=None,
+                  accept=None):
+    """Loops through sides - 1 waypoints spaced about target_m / sides apart on the network.
+
+    One candidate is tried per direction around the start. With a pool usable
+    for the graph, candidates are evaluated in parallel (at least one per pool
+    process) and the search stops once enough of them fall in the target band
+    and pass accept. Returns the (path, length) pairs falling in the target
+    band, fewest reused edges first.
+    """
+    graph, start, matrix = engine.graph, engine.start, engine.matrix
+    leg = target_m / sides
+
+    first = np.nonzero((engine.dist_out >= 0.8 * leg) & (engine.dist_out <= 1.2 * leg))[0]
+    if not len(first):
+        return []
+
+    score = np.abs(engine.dist_out - leg)
+    paths = None
+    if pool is not None and pool.usable(graph):
+        waypoints = _spread_by_bearing(graph, start, first, score, max(attempts, pool.workers))
+
+        def good(path):
+            return in_band(path_length(matrix, path), target_m, tolerance) and (accept is None or accept(path))
+
+        paths = pool.polygons(engine, waypoints, leg, sides, good, enough)
+    if paths is None:
+        waypoints = _spread_by_bearing(graph, start, first, score, attempts)
+        paths = [polygon_through(matrix, graph.lat, graph.lon, start, engine.dist_back, engine.path_to(waypoint),
+                                 leg, sides) for waypoint in waypoints]
+
+    loops = []
+    for path in paths:
+        if path is None:
+            continue
+        length = path_length(matrix, path)
+        if in_band(length, target_m, tolerance):
+            loops.append((path, length))
+
+    loops.sort(key=lambda c: (reused_fraction(c[0]), abs(c[1] - target_m)))
+    if loops:
+        logger.info(f"{len(loops)} polygon loops with {sides} sides, best has "
+                    f"{reused_fraction(loops[0][0]):.0%} reused edges")
+    return loops
+
+
+def find_loops(engine, target_m, sides=3, tolerance=TOLERANCE, limit=1, max_ascent=None, pool=None):
+    """Up to limit loops for target_m: polygon loops first, then out-and-back routes.
+
+    With elevation data and a max_ascent budget, loops within the budget are
+    ranked first and the others by how much they exceed it; more directions
+    are tried so a flatter loop can be found. With a CandidatePool the polygon
+    candidates are evaluated in parallel until limit loops (within the ascent
+    budget) are found. Returns a list of (path, length), empty if no loop
+    falls in the band.
+    """
+    climbing = max_ascent is not None and engine.ascent_matrix is not None
+    loops = []
+    if sides >= 3:
+        accept = (lambda path: engine.ascent(path) <= max_ascent) if climbing else None
+        loops = polygon_loops(engine, target_m, sides, tolerance, attempts=8 if climbing else 4, pool=pool,
+                              enough=limit, accept=accept)
+    if len(loops) < limit or climbing:
+        candidates = out_and_back(engine, target_m, tolerance, limit=10 if climbing else 5)
+        loops += sorted(candidates, key=lambda c: (reused_fraction(c[0]), abs(c[1] - target_m)))
+
+    if climbing and loops:
+        # sort stabile: a parità di sforamento resta l'ordine precedente
+        overrun = {id(c): max(0.0, engine.ascent(c[0]) - max_ascent) for c in loops}
+        loops.sort(key=lambda c: overrun[id(c)])
+        if overrun[id(loops[0])] > 0:
+            logger.warning(f"No loop within the {max_ascent:.0f} m ascent budget, "
+                           f"best exceeds it by {overrun[id(loops[0])]:.0f} m")
+    return loops[:limit]
+
+
+def find_loop(engine, target_m, sides=3, tolerance=TOLERANCE, max_ascent=None):
+    """Best loop for target_m as (path, length), or None if no loop falls in the band."""
+    loops = find_loops(engine, target_m, sides, tolerance, max_ascent=max_ascent)
+    return loops[0] if loops else None
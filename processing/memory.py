@@ -0,0 +1,158 @@
+import ctypes
+import ctypes.util
+import gc
+import logging
+import math
+import os
+
+import psutil
+
+logger = logging.getLogger(__name__)
+
+# Budget di memoria per processo di pianificazione in MB (0 = nessun limite)
+PLANNER_MEMORY_BUDGET_MB = int(os.getenv("PLANNER_MEMORY_BUDGET_MB", "0"))
+
+# Extra address space allowed above the budget for memory-mapped regions and thread stacks
+RLIMIT_HEADROOM_MB = int(os.getenv("PLANNER_RLIMIT_HEADROOM_MB", "512"))
+
+# Nodi per km² della rete ciclabile, usato per stimare i grafi scaricati da Overpass
+NODE_DENSITY = float(os.getenv("PLANNER_NODE_DENSITY", "300"))
+EDGES_PER_NODE = 2.6
+
+# Nodi OSM per nodo della rete semplificata, nelle celle scaricate da Overpass prima della semplificazione
+RAW_NODE_FACTOR = float(os.getenv("PLANNER_RAW_NODE_FACTOR", "4"))
+
+# Measured cost of the CSR arrays plus the routing working set (distances,
+# predecessors, sparse matrices), and of an osmnx MultiDiGraph with its tags
+# and geometries while it is converted
+CSR_BYTES_PER_NODE = 64
+CSR_BYTES_PER_EDGE = 40
+NX_BYTES_PER_NODE = 600
+NX_BYTES_PER_EDGE = 1500
+
+
+class MemoryBudgetExceeded(MemoryError):
+    """Raised when a route cannot be planned within the memory budget."""
+
+
+class MemoryLimitReached(MemoryBudgetExceeded):
+    """Raised when planning actually ran out of the process memory limit (RLIMIT_AS)."""
+
+
+def estimate_nodes(radius_m, density=NODE_DENSITY):
+    """Expected number of nodes within radius_m, from a density in nodes per km²."""
+    return int(density * math.pi * (radius_m / 1000) ** 2)
+
+
+def region_density(meta):
+    """Nodes per km² of a stored region, from its meta.json."""
+    south, west, north, east = meta["bbox"]
+    height = math.radians(north - south) * 6371
+    width = math.radians(east - west) * 6371 * math.cos(math.radians((north + south) / 2))
+    return meta["nodes"] / max(height * width, 1e-6)
+
+
+def estimate_graph_bytes(n_nodes, n_edges=None, networkx=False):
+    """Peak bytes needed to load and route on a graph of that size."""
+    if n_edges is None:
+        n_edges = int(n_nodes * EDGES_PER_NODE)
+    total = n_nodes * CSR_BYTES_PER_NODE + n_edges * CSR_BYTES_PER_EDGE
+    if networkx:
+        total += n_nodes * NX_BYTES_PER_NODE + n_edges * NX_BYTES_PER_EDGE
+    return total
+
+
+def current_rss():
+    """Resident memory not backed by files.
+
+    Pages of memory-mapped graph regions can be dropped by the kernel at any
+    time, so they are not charged against the budget.
+    """
+    info = psutil.Process().memory_info()
+    return info.rss - getattr(info, "shared", 0)
+
+
+def _load_libc():
+    name = ctypes.util.find_library("c")
+    try:
+        libc = ctypes.CDLL(name)
+        libc.malloc_trim
+    except (OSError, AttributeError, TypeError):
+        return None
+    return libc
+
+
+_libc = _load_libc()
+
+
+def release_memory():
+    """Collect garbage and hand freed heap pages back to the OS (glibc only)."""
+    gc.collect()
+    if _libc is not None:
+        _libc.malloc_trim(0)
+
+
+class MemoryBudget:
+    """Memory ceiling of one planner process.
+
+    The budget counts from the RSS measured when the limit is installed, so
+    imports are not charged against it. install() also caps the address space
+    with RLIMIT_AS, which turns a runaway allocation into a MemoryError
+    instead of an OOM kill of the whole container.
+    """
+
+    def __init__(self, budget_mb=PLANNER_MEMORY_BUDGET_MB, headroom_mb=RLIMIT_HEADROOM_MB):
+        self.budget = budget_mb * 2 ** 20
+        self.headroom = headroom_mb * 2 ** 20
+        self.baseline = current_rss()
+
+    @property
+    def enabled(self):
+        return self.budget > 0
+
+    def install(self):
+        """Set the baseline to the current RSS and apply RLIMIT_AS where supported."""
+        if not self.enabled:
+            return
+        self.baseline = current_rss()
+        try:
+            import resource
+        except ImportError:
+            logger.warning("RLIMIT_AS is not available on this platform, only soft checks are used")
+            return
+        limit = psutil.Process().memory_info().vms + self.budget + self.headroom
+        _, hard = resource.getrlimit(resource.RLIMIT_AS)
+        if hard != resource.RLIM_INFINITY:
+            limit = min(limit, hard)
+        resource.setrlimit(resource.RLIMIT_AS, (limit, hard))
+        logger.info(f"Planner memory budget {self.budget / 2 ** 20:.0f} MB, address space limit "
+                    f"{limit / 2 ** 20:.0f} MB")
+
+    def available(self):
+        """Bytes still available, or infinity without a budget."""
+        if not self.enabled:
+            return math.inf
+        return self.baseline + self.budget - current_rss()
+
+    def max_radius(self, density, networkx=False, reclaimable=0):
+        """Largest radius whose graph is estimated to fit in the remaining budget.
+
+        reclaimable counts memory that can be freed first, e.g. cached graphs.
+        """
+        available = self.available() + reclaimable
+        if available == math.inf:
+            return math.inf
+        per_node = estimate_graph_bytes(1_000_000, networkx=networkx) / 1_000_000
+        nodes = max(available, 0) / per_node
+        return 1000 * math.sqrt(nodes / (density * math.pi))
+
+    def check(self, what):
+        """Raise MemoryBudgetExceeded if the RSS is already over the budget."""
+        if not self.enabled or self.available() >= 0:
+            return
+        release_memory()
+        if self.available() < 0:
+            used = (current_rss() - self.baseline) / 2 ** 20
+            raise MemoryBudgetExceeded(
+                f"{what} used {used:.0f} MB, over the {self.budget / 2 ** 20:.0f} MB memory budget. "
+                f"Try a shorter distance.")
@@ -0,0 +1,273 @@
+import asyncio
+import functools
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Endpoint Prometheus locale (porta 0 per disattivarlo) e file JSON lines ("" per disattivarlo)
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9108"))
+METRICS_LOG = os.getenv("METRICS_LOG", "metrics.jsonl")
+METRICS_SNAPSHOT_INTERVAL = int(os.getenv("METRICS_SNAPSHOT_INTERVAL", "300"))
+
+# Ogni quanti secondi viene misurato il ritardo dell'event loop (0 per disattivarlo)
+METRICS_LOOP_LAG_INTERVAL = float(os.getenv("METRICS_LOOP_LAG_INTERVAL", "0.5"))
+
+# Histogram buckets in seconds, up to the planner's 10 minute job timeout
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+# Buckets of the histograms that do not measure seconds
+COUNT_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128)
+HISTOGRAM_BUCKETS = {"ai_parse_batch_size": COUNT_BUCKETS}
+
+
+def _labels_key(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+
+class Registry:
+    """Counters, gauges and histograms of one process, plus a JSON lines event log.
+
+    In a planner worker `forward` is set: every update is also queued so the
+    parent can replay it into its own registry with drain() / replay().
+    Histograms use `buckets` unless `histogram_buckets` maps their name to
+    their own.
+    """
+
+    def __init__(self, log_path=METRICS_LOG, buckets=BUCKETS, histogram_buckets=HISTOGRAM_BUCKETS):
+        self.log_path = log_path
+        self.buckets = buckets
+        self.histogram_buckets = dict(histogram_buckets)
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.collectors = []
+        self.forward = False
+        self._events = []
+        self._log = None
+        self._lock = threading.Lock()
+
+    def _update(self, kind, name, value, labels):
+        key = (name, _labels_key(labels))
+        with self._lock:
+            if kind == "inc":
+                self.counters[key] = self.counters.get(key, 0) + value
+            elif kind == "set":
+                self.gauges[key] = value
+            else:
+                buckets = self.buckets_of(name)
+                counts = self.histograms.setdefault(key, [0] * len(buckets) + [0, 0.0])
+                for i, bound in enumerate(buckets):
+                    if value <= bound:
+                        counts[i] += 1
+                counts[-2] += 1
+                counts[-1] += value
+            if self.forward:
+                self._events.append((kind, name, value, labels))
+
+    def buckets_of(self, name):
+        return self.histogram_buckets.get(name, self.buckets)
+
+    def inc(self, name, value=1, **labels):
+        self._update("inc", name, value, labels)
+
+    def set(self, name, value, **labels):
+        self._update("set", name, value, labels)
+
+    def observe(self, name, value, **labels):
+        self._update("observe", name, value, labels)
+
+    def log(self, event, **fields):
+        """Append one event to the JSON lines log."""
+        record = {"ts": round(time.time(), 3), "event": event, **fields}
+        with self._lock:
+            if self.forward:
+                self._events.append(("log", event, None, record))
+                return
+            if not self.log_path:
+                return
+            if self._log is None:
+                self._log = open(self.log_path, "a", buffering=1)
+            self._log.write(json.dumps(record, default=str) + "\n")
+
+    @contextmanager
+    def span(self, name, **labels):
+        """Time a block into the histogram <name>_seconds and log it as an event."""
+        status = "ok"
+        start = time.perf_counter()
+        try:
+            yield labels
+        except BaseException:
+            status = "error"
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            self.observe(f"{name}_seconds", elapsed, status=status, **labels)
+            self.log(name, seconds=round(elapsed, 6), status=status, **labels)
+
+    def drain(self):
+        """Return and forget the updates queued since the last call."""
+        with self._lock:
+            events, self._events = self._events, []
+        return events
+
+    def replay(self, events, **extra):
+        """Apply updates drained from another process, adding extra labels."""
+        for kind, name, value, labels in events:
+            if kind == "log":
+                self.log(labels.pop("event"), **{**labels, **extra})
+            else:
+                self._update(kind, name, value, {**labels, **extra})
+
+    def snapshot(self):
+        """Current values as a JSON-serializable dict."""
+        for collect in self.collectors:
+            collect()
+        with self._lock:
+            def flat(values):
+                return [{"name": name, "labels": dict(key), "value": value} for (name, key), value in values.items()]
+
+            return {
+                "counters": flat(self.counters),
+                "gauges": flat(self.gauges),
+                "histograms": [{"name": name, "labels": dict(key), "count": c[-2], "sum": c[-1]}
+                               for (name, key), c in self.histograms.items()],
+            }
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format."""
+        for collect in self.collectors:
+            collect()
+        lines = []
+        with self._lock:
+            for kind, values in (("counter", self.counters), ("gauge", self.gauges)):
+                for name in sorted({name for name, _ in values}):
+                    lines.append(f"# TYPE {name} {kind}")
+                    lines.extend(f"{name}{_format_labels(key)} {value}"
+                                 for (n, key), value in sorted(values.items()) if n == name)
+            for name in sorted({name for name, _ in self.histograms}):
+                lines.append(f"# TYPE {name} histogram")
+                for (n, key), counts in sorted(self.histograms.items()):
+                    if n != name:
+                        continue
+                    for bound, count in zip(self.buckets_of(name), counts):
+                        lines.append(f"{name}_bucket{_format_labels(key, [('le', bound)])} {count}")
+                    lines.append(f"{name}_bucket{_format_labels(key, [('le', '+Inf')])} {counts[-2]}")
+                    lines.append(f"{name}_sum{_format_labels(key)} {counts[-1]}")
+                    lines.append(f"{name}_count{_format_labels(key)} {counts[-2]}")
+        return "\n".join(lines) + "\n"
+
+    def close(self):
+        with self._lock:
+            if self._log is not None:
+                self._log.close()
+                self._log = None
+
+
+registry = Registry()
+
+inc = registry.inc
+set_gauge = registry.set
+observe = registry.observe
+span = registry.span
+log = registry.log
+
+
+def instrument(handler):
+    """Decorator timing an async bot handler as handler_seconds{handler=...}."""
+    def decorator(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            with span("handler", handler=handler):
+                return await fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class MetricsServer:
+    """Minimal HTTP server answering every GET with registry.render().
+
+    It also appends a snapshot of all metrics to the JSON lines log every
+    snapshot_interval seconds and once more on close, and records how late
+    the event loop wakes up from a sleep of lag_interval seconds as
+    event_loop_lag_seconds.
+    """
+
+    def __init__(self, registry=registry, host=METRICS_HOST, port=METRICS_PORT,
+                 snapshot_interval=METRICS_SNAPSHOT_INTERVAL, lag_interval=METRICS_LOOP_LAG_INTERVAL):
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self.snapshot_interval = snapshot_interval
+        self.lag_interval = lag_interval
+        self._server = None
+        self._snapshots = None
+        self._lag = None
+
+    async def start(self):
+        if self.port:
+            self._server = await asyncio.start_server(self._handle, self.host, self.port)
+            logger.info(f"Metrics endpoint on http://{self.host}:{self.port}/metrics")
+        if self.snapshot_interval > 0:
+            self._snapshots = asyncio.create_task(self._snapshot_loop())
+        if self.lag_interval > 0:
+            self._lag = asyncio.create_task(self._lag_loop())
+
+    async def close(self):
+        if self._snapshots is not None:
+            self._snapshots.cancel()
+            self._snapshots = None
+        if self._lag is not None:
+            self._lag.cancel()
+            self._lag = None
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+        self.registry.log("snapshot", **self.registry.snapshot())
+        self.registry.close()
+
+    async def _snapshot_loop(self):
+        while True:
+            await asyncio.sleep(self.snapshot_interval)
+            self.registry.log("snapshot", **self.registry.snapshot())
+
+    async def _lag_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.lag_interval)
+            # Tempo in cui i callback di altri task hanno tenuto occupato il loop
+            self.registry.observe("event_loop_lag_seconds", max(loop.time() - start - self.lag_interval, 0.0))
+
+    async def _handle(self, reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), timeout=5)
+            method, path = request.split(b" ", 2)[:2]
+            if method != b"GET":
+                status, body = "405 Method Not Allowed", ""
+            elif path.split(b"?")[0] not in (b"/", b"/metrics"):
+                status, body = "404 Not Found", ""
+            else:
+                status, body = "200 OK", self.registry.render()
+            payload = body.encode("utf-8")
+            writer.write(f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                         f"Content-Length: {len(payload)}\r\nConnection: close\r\n\r\n".encode("ascii") + payload)
+            await writer.drain()
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
@@ -0,0 +1,337 @@
+import json
+import logging
+import math
+import os
+import shutil
+import sys
+import time
+import uuid
+from collections import OrderedDict
+
+from processing import metrics
+from processing.graph_store import CSRGraph, EARTH_RADIUS_M, overpass_filter
+
+logger = logging.getLogger(__name__)
+
+# Lato in gradi delle celle in cui la rete viene scaricata da Overpass
+OSM_TILE_DEG = float(os.getenv("OSM_TILE_DEG", "0.05"))
+
+# Celle tenute in memoria da ogni worker
+OSM_TILE_CACHE_SIZE = int(os.getenv("OSM_TILE_CACHE_SIZE", "64"))
+
+# Celle salvate su disco come array, riscaricate dopo OSM_TILE_MAX_AGE giorni (0 = mai)
+OSM_TILE_DIR = os.getenv("OSM_TILE_DIR", "osm_tiles")
+OSM_TILE_MAX_AGE = float(os.getenv("OSM_TILE_MAX_AGE", "30"))
+# Celle senza strade ricontrollate prima, dopo OSM_TILE_EMPTY_MAX_AGE giorni
+OSM_TILE_EMPTY_MAX_AGE = float(os.getenv("OSM_TILE_EMPTY_MAX_AGE", "1"))
+
+# Warmup: bbox "south,west,north,east" o città separate da ";", e raggio intorno alle città
+OSM_WARMUP = os.getenv("OSM_WARMUP", "")
+OSM_WARMUP_RADIUS_KM = float(os.getenv("OSM_WARMUP_RADIUS_KM", "20"))
+
+# Istanza Overpass alternativa, ad esempio "http://127.0.0.1:12345/api" ("" = quella di osmnx)
+OVERPASS_URL = os.getenv("OVERPASS_URL", "")
+
+# Formato delle celle su disco; le celle di un formato precedente vengono riscaricate
+TILE_FORMAT = 2
+
+
+def tile_of(lat, lon, size=OSM_TILE_DEG):
+    return math.floor(lat / size), math.floor(lon / size)
+
+
+def tile_bounds(tile, size=OSM_TILE_DEG):
+    """(south, west, north, east) of a tile."""
+    row, col = tile
+    return row * size, col * size, (row + 1) * size, (col + 1) * size
+
+
+def tile_area_km2(lat, size=OSM_TILE_DEG):
+    """Area of a tile at a given latitude."""
+    side = math.radians(size) * EARTH_RADIUS_M / 1000
+    return side * side * math.cos(math.radians(lat))
+
+
+def tiles_in_bbox(south, west, north, east, size=OSM_TILE_DEG):
+    """Tiles intersecting a bounding box."""
+    first_row, first_col = tile_of(south, west, size)
+    last_row, last_col = tile_of(north, east, size)
+    return [(row, col) for row in range(first_row, last_row + 1) for col in range(first_col, last_col + 1)]
+
+
+def tiles_covering(lat, lon, radius_m, size=OSM_TILE_DEG):
+    """Tiles intersecting the circle of radius_m around a point."""
+    dlat = math.degrees(radius_m / EARTH_RADIUS_M)
+    dlon = dlat / max(math.cos(math.radians(lat)), 1e-6)
+    south, west = tile_of(lat - dlat, lon - dlon, size)
+    north, east = tile_of(lat + dlat, lon + dlon, size)
+    tiles = []
+    for row in range(south, north + 1):
+        for col in range(west, east + 1):
+            # Punto della cella più vicino al centro, confrontato con il raggio
+            s, w, n, e = tile_bounds((row, col), size)
+            y = math.radians(min(max(lat, s), n) - lat) * EARTH_RADIUS_M
+            x = math.radians(min(max(lon, w), e) - lon) * EARTH_RADIUS_M * math.cos(math.radians(lat))
+            if math.hypot(x, y) <= radius_m:
+                tiles.append((row, col))
+    return tiles
+
+
+def _no_roads(responses, bounds):
+    """Whether the Overpass answers of a tile fetch all succeeded and hold no node inside the tile.
+
+    osmnx raises the same errors for a tile without roads and for a failed
+    query (an error page, or a timeout remark without elements), so the
+    answers are checked before a tile is taken as empty.
+    """
+    south, west, north, east = bounds
+    # Le risposte 429/504 vengono ripetute da osmnx; /status non porta dati
+    answers = [response for response in responses
+               if "/interpreter" in response.url and response.status_code not in (429, 504)]
+    if not answers:
+        return False
+    for response in answers:
+        if not response.ok:
+            return False
+        try:
+            data = response.json()
+        except ValueError:
+            return False
+        if not isinstance(data, dict) or "remark" in data or not isinstance(data.get("elements"), list):
+            return False
+        for element in data["elements"]:
+            if (element.get("type") == "node" and south <= element.get("lat", math.inf) <= north
+                    and west <= element.get("lon", math.inf) <= east):
+                return False
+    return True
+
+
+def fetch_tile(tile, mode="bike", size=OSM_TILE_DEG):
+    """Download the road network of one tile from Overpass as an unsimplified CSRGraph.
+
+    Every OSM node is kept and edges crossing the border are kept with
+    their outer node, so adjacent tiles share those edges and can be joined
+    with CSRGraph.merge; the joined network is simplified afterwards, since
+    simplifying each tile would end a road at different nodes on the two
+    sides of a border. A tile comes back empty only if Overpass answered
+    without any node in it; failed queries raise.
+    """
+    import networkx as nx
+    import osmnx as ox
+
+    if OVERPASS_URL:
+        ox.settings.overpass_url = OVERPASS_URL
+    south, west, north, east = tile_bounds(tile, size)
+    # Le celle hanno già il loro archivio su disco: la cache di osmnx servirebbe risposte vecchie al
+    # rinnovo, e le risposte vengono raccolte per distinguere una cella vuota da una richiesta fallita
+    responses = []
+    hooks = {"response": lambda response, **_: responses.append(response)}
+    overrides = {"use_cache": False, "requests_kwargs": {**ox.settings.requests_kwargs, "hooks": hooks}}
+    previous = {name: getattr(ox.settings, name) for name in overrides}
+    for name, value in overrides.items():
+        setattr(ox.settings, name, value)
+    try:
+        with metrics.span("upstream_request", service="overpass"):
+            G = ox.graph_from_bbox((west, south, east, north), network_type=mode, simplify=False,
+                                   retain_all=True, truncate_by_edge=True, custom_filter=overpass_filter(mode))
+    except ValueError as e:
+        if not _no_roads(responses, (south, west, north, east)):
+            raise
+        # Cella senza strade (mare, montagna) o senza nodi rimasti dopo il taglio
+        logger.info(f"No roads in tile {tile}: {e}")
+        G = nx.MultiDiGraph()
+    finally:
+        for name, value in previous.items():
+            setattr(ox.settings, name, value)
+        responses.clear()
+    with metrics.span("planner_stage", stage="graph_convert"):
+        graph = CSRGraph.from_networkx(G)
+    del G
+
+    from processing.elevation import get_elevation_model
+
+    dem = get_elevation_model()
+    if dem is not None and graph.n_nodes:
+        with metrics.span("planner_stage", stage="elevation"):
+            dem.add_to(graph)
+    return graph
+
+
+class TileLoader:
+    """Road network assembled from fixed tiles, each downloaded once.
+
+    Tiles are stored under root as memory-mappable CSRGraph arrays, so any
+    center and radius is served from the tiles already on disk and shared
+    by all workers. When the planner widens its search only the tiles the
+    larger circle adds are fetched from Overpass.
+    """
+
+    def __init__(self, size=OSM_TILE_DEG, max_tiles=OSM_TILE_CACHE_SIZE, root=OSM_TILE_DIR,
+                 max_age_days=OSM_TILE_MAX_AGE, empty_max_age_days=OSM_TILE_EMPTY_MAX_AGE):
+        self.size = size
+        self.max_tiles = max_tiles
+        self.root = root
+        self.max_age = max_age_days * 86400
+        self.empty_max_age = empty_max_age_days * 86400
+        self._tiles = OrderedDict()
+
+    def path(self, tile, mode="bike"):
+        return os.path.join(self.root, mode, f"{self.size:g}", f"{tile[0]}_{tile[1]}")
+
+    def stored(self, tile, mode="bike"):
+        """Whether a fresh copy of the tile is on disk; tiles without roads expire after empty_max_age."""
+        meta_file = os.path.join(self.path(tile, mode), "meta.json")
+        if not os.path.exists(meta_file):
+            return False
+        with open(meta_file) as f:
+            meta = json.load(f)
+        if meta.get("format") != TILE_FORMAT:
+            return False
+        max_age = self.max_age if meta.get("nodes") else self.empty_max_age
+        return max_age <= 0 or time.time() - meta.get("fetched", 0) <= max_age
+
+    def save(self, tile, graph, mode="bike"):
+        """Write a tile atomically; a copy saved meanwhile by another worker wins."""
+        path = self.path(tile, mode)
+        tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+        graph.save(tmp, mode=mode, tile=list(tile), size=self.size, fetched=time.time(), format=TILE_FORMAT)
+        if os.path.exists(path) and not self.stored(tile, mode):
+            shutil.rmtree(path, ignore_errors=True)
+        try:
+            os.rename(tmp, path)
+        except OSError:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    def tile(self, tile, mode="bike"):
+        key = (tile, mode)
+        graph = self._tiles.get(key)
+        if graph is not None:
+            self._tiles.move_to_end(key)
+            metrics.inc("cache_requests_total", cache="osm_tile", result="hit")
+            return graph
+        if self.stored(tile, mode):
+            metrics.inc("cache_requests_total", cache="osm_tile", result="disk")
+            graph = CSRGraph.load(self.path(tile, mode))
+        else:
+            metrics.inc("cache_requests_total", cache="osm_tile", result="miss")
+            graph = fetch_tile(tile, mode, self.size)
+            logger.info(f"Fetched tile {tile}: {graph.n_nodes} nodes, {graph.n_edges} edges")
+            self.save(tile, graph, mode)
+            if self.stored(tile, mode):
+                # La cache tiene la copia mappata dal disco, non gli array scaricati
+                graph = CSRGraph.load(self.path(tile, mode))
+        self._tiles[key] = graph
+        while len(self._tiles) > self.max_tiles:
+            self._tiles.popitem(last=False)
+        return graph
+
+    def missing(self, lat, lon, radius_m, mode="bike"):
+        """Tiles of the circle that would have to be downloaded."""
+        return [tile for tile in tiles_covering(lat, lon, radius_m, self.size)
+                if (tile, mode) not in self._tiles and not self.stored(tile, mode)]
+
+    def warmup(self, tiles, mode="bike"):
+        """Download and store the given tiles that are not on disk yet; return how many were fetched.
+
+        A tile whose download fails is not stored and is tried again at the next warmup.
+        """
+        fetched = 0
+        for i, tile in enumerate(tiles, 1):
+            if self.stored(tile, mode):
+                continue
+            try:
+                graph = fetch_tile(tile, mode, self.size)
+            except Exception as e:
+                logger.error(f"Tile {tile} ({i}/{len(tiles)}) could not be downloaded: {e}")
+                continue
+            self.save(tile, graph, mode)
+            fetched += 1
+            logger.info(f"Tile {tile} ({i}/{len(tiles)}): {graph.n_nodes} nodes, {graph.n_edges} edges")
+        return fetched
+
+    def graph_around(self, lat, lon, radius_m, mode="bike"):
+        """Cut a radius subgraph from the merged tiles covering the circle, then simplify it.
+
+        Each tile is cut to the circle as soon as it is loaded, so only the
+        cut parts are held until the merge, however many tiles the circle
+        needs; the cache keeps the last max_tiles tiles.
+        """
+        parts = [self.tile(tile, mode).within(lat, lon, radius_m)
+                 for tile in tiles_covering(lat, lon, radius_m, self.size)]
+        with metrics.span("planner_stage", stage="graph_merge"):
+            graph = CSRGraph.merge(parts)
+        del parts
+        with metrics.span("planner_stage", stage="graph_simplify"):
+            return graph.simplified()
+
+    def nbytes(self):
+        return sum(graph.nbytes for graph in self._tiles.values())
+
+    def clear(self):
+        self._tiles.clear()
+
+
+def warmup_tiles(target, size=OSM_TILE_DEG, radius_km=OSM_WARMUP_RADIUS_KM):
+    """Tiles of a warmup target: a "south,west,north,east" bbox or a place name."""
+    parts = target.split(",")
+    if len(parts) == 4:
+        try:
+            return tiles_in_bbox(*map(float, parts), size=size)
+        except ValueError:
+            pass
+    from processing.utils import get_coordinates
+
+    lat, lon = get_coordinates(target)
+    return tiles_covering(lat, lon, radius_km * 1000, size)
+
+
+def preference_targets():
+    """(address, radius in km) around the home addresses and recent route starts of the bot's users."""
+    from processing.loops import search_radius
+    from processing.persistence import UserPreferences
+
+    preferences = UserPreferences()
+    try:
+        spots = preferences.hot_spots()
+    finally:
+        preferences.close()
+    # Raggio del primo grafo caricato dal planner per la distanza più lunga richiesta
+    return [(address, search_radius(distance_km * 1000) / 1000 if distance_km else OSM_WARMUP_RADIUS_KM)
+            for address, distance_km in spots]
+
+
+def main(argv):
+    """Usage: python -m processing.osm_tiles [--mode bike] [--preferences] <south,west,north,east | city> ...
+
+    Pre-builds the Overpass tiles of bounding boxes and of the area within
+    OSM_WARMUP_RADIUS_KM of cities, so planning there needs no download.
+    --preferences adds the users' home addresses and recent route starts.
+    Without targets the ";"-separated ones of OSM_WARMUP are used.
+    """
+    mode = "bike"
+    if len(argv) >= 2 and argv[0] == "--mode":
+        mode, argv = argv[1], argv[2:]
+    from_preferences = "--preferences" in argv
+    argv = [arg for arg in argv if arg != "--preferences"]
+    targets = [(target, OSM_WARMUP_RADIUS_KM)
+               for target in argv or [t.strip() for t in OSM_WARMUP.split(";") if t.strip()]]
+    if from_preferences:
+        targets += preference_targets()
+    if not targets:
+        print(main.__doc__)
+        return 1
+    loader = TileLoader(max_tiles=1)
+    for target, radius_km in targets:
+        try:
+            tiles = warmup_tiles(target, loader.size, radius_km)
+        except ValueError as e:
+            print(f"{target}: {e}")
+            continue
+        fetched = loader.warmup(tiles, mode)
+        print(f"{target}: {len(tiles)} tiles, {fetched} downloaded")
+    return 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,216 @@
+import ctypes
+import ctypes.util
+import logging
+import multiprocessing
+import os
+import signal
+import sys
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+
+import numpy as np
+import psutil
+from scipy.sparse import csr_matrix
+
+from processing import metrics
+from processing.loops import polygon_through
+
+logger = logging.getLogger(__name__)
+
+# Processi che valutano in parallelo i candidati di un percorso (0 o 1 = nel processo del planner)
+PLANNER_PARALLEL_WORKERS = int(os.getenv("PLANNER_PARALLEL_WORKERS", "0"))
+
+# Below this many nodes candidates are evaluated in the planner process, where they are faster than
+# the cost of sharing the graph
+PLANNER_PARALLEL_MIN_NODES = int(os.getenv("PLANNER_PARALLEL_MIN_NODES", "20000"))
+
+# Secondi di CPU che i candidati di un percorso possono usare in tutto (0 = nessun limite)
+PLANNER_CPU_BUDGET = float(os.getenv("PLANNER_CPU_BUDGET", "0"))
+
+# Intervallo di controllo del budget di CPU mentre i candidati sono in corso
+POLL_INTERVAL = 0.05
+
+PR_SET_PDEATHSIG = 1
+
+
+class SharedArrays:
+    """Read-only numpy arrays copied once into a shared memory block.
+
+    Pool processes map the block from its small picklable spec instead of
+    receiving pickled copies of the arrays. The byte after the arrays is a
+    stop flag the owner raises to end the tasks still running.
+    """
+
+    def __init__(self, arrays):
+        layout = {}
+        size = 0
+        for name, array in arrays.items():
+            # Ogni array allineato a 64 byte
+            size = -(-size // 64) * 64
+            layout[name] = (size, array.dtype.str, array.shape)
+            size += array.nbytes
+        self.shm = shared_memory.SharedMemory(create=True, size=size + 1)
+        for name, array in arrays.items():
+            offset, dtype, shape = layout[name]
+            np.ndarray(shape, dtype, buffer=self.shm.buf, offset=offset)[...] = array
+        self.shm.buf[size] = 0
+        self.spec = (self.shm.name, layout, size)
+        self.nbytes = size
+
+    def stop(self):
+        self.shm.buf[self.spec[2]] = 1
+
+    def close(self):
+        self.shm.close()
+        self.shm.unlink()
+
+
+def _views(shm, spec):
+    _, layout, _ = spec
+    return {name: np.ndarray(shape, dtype, buffer=shm.buf, offset=offset)
+            for name, (offset, dtype, shape) in layout.items()}
+
+
+def _init_process():
+    """Pool process setup: die with the planner worker, which may be killed by a timeout or /cancel."""
+    if sys.platform.startswith("linux"):
+        try:
+            ctypes.CDLL(ctypes.util.find_library("c")).prctl(PR_SET_PDEATHSIG, signal.SIGKILL)
+        except (OSError, AttributeError, TypeError):
+            pass
+
+
+def _ready(_):
+    return os.getpid()
+
+
+def _polygon(shm, spec, path, leg, sides):
+    arrays = _views(shm, spec)
+    n = len(arrays["lat"])
+    matrix = csr_matrix((arrays["data"], arrays["indices"], arrays["indptr"]), shape=(n, n))
+    flag = spec[2]
+    return polygon_through(matrix, arrays["lat"], arrays["lon"], int(arrays["start"][0]), arrays["dist_back"],
+                           path, leg, sides, stopped=lambda: shm.buf[flag] != 0)
+
+
+def _polygon_task(spec, path, leg, sides):
+    """Close one polygon candidate on the shared graph; runs in a pool process."""
+    try:
+        shm = shared_memory.SharedMemory(name=spec[0])
+    except FileNotFoundError:
+        # Il percorso è già stato deciso e il blocco rimosso
+        return None
+    try:
+        return _polygon(shm, spec, path, leg, sides)
+    finally:
+        try:
+            shm.close()
+        except BufferError:
+            # Viste ancora referenziate dal traceback di un errore: le libera il garbage collector
+            pass
+
+
+class CandidatePool:
+    """Pool of processes evaluating the loop candidates of one route at a time.
+
+    The pool is started on first use and kept for the life of the planner
+    worker. For each route the routing arrays are placed in shared memory,
+    candidates are submitted together and evaluation stops as soon as enough
+    of them are good or the pool processes used cpu_budget seconds of CPU
+    for the route. Graphs under min_nodes stay in the planner process.
+    """
+
+    def __init__(self, workers=PLANNER_PARALLEL_WORKERS, min_nodes=PLANNER_PARALLEL_MIN_NODES,
+                 cpu_budget=PLANNER_CPU_BUDGET):
+        self.workers = workers
+        self.min_nodes = min_nodes
+        self.cpu_budget = cpu_budget
+        self._executor = None
+
+    def usable(self, graph):
+        return self.workers > 1 and graph.n_nodes >= self.min_nodes
+
+    def _start(self):
+        if self._executor is None:
+            # I worker del planner sono daemon e non potrebbero avere figli; i processi del pool
+            # vengono chiusi da close() o muoiono con il worker (PR_SET_PDEATHSIG)
+            multiprocessing.current_process().daemon = False
+            self._executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"),
+                                                 initializer=_init_process)
+            # Avvia i processi subito, così il loro import non pesa sul budget di CPU del primo percorso
+            list(self._executor.map(_ready, range(self.workers)))
+            metrics.inc("planner_candidate_pool_starts_total")
+            logger.info(f"Candidate pool started with {self.workers} processes")
+        return self._executor
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+
+    @staticmethod
+    def _cpu_seconds():
+        """CPU time used so far by the children of this process."""
+        total = 0.0
+        for child in psutil.Process().children():
+            try:
+                times = child.cpu_times()
+            except psutil.Error:
+                continue
+            total += times.user + times.system
+        return total
+
+    def polygons(self, engine, waypoints, leg, sides, good, enough=None):
+        """Polygon loop paths (None where a candidate failed) through each first waypoint.
+
+        Stops once enough paths pass good(path) or the CPU budget is spent;
+        candidates not evaluated by then are left out. Returns None if the
+        pool broke, so the caller can evaluate the candidates itself.
+        """
+        matrix = engine.matrix
+        shared = SharedArrays({
+            "data": matrix.data, "indices": matrix.indices, "indptr": matrix.indptr,
+            "lat": np.asarray(engine.graph.lat), "lon": np.asarray(engine.graph.lon),
+            "dist_back": engine.dist_back, "start": np.array([engine.start]),
+        })
+        paths = []
+        accepted = 0
+        reason = "done"
+        try:
+            executor = self._start()
+            cpu_start = self._cpu_seconds()
+            pending = {executor.submit(_polygon_task, shared.spec, engine.path_to(waypoint), leg, sides)
+                       for waypoint in waypoints}
+            while pending:
+                done, pending = wait(pending, timeout=POLL_INTERVAL, return_when=FIRST_COMPLETED)
+                for future in done:
+                    path = future.result()
+                    paths.append(path)
+                    accepted += path is not None and good(path)
+                if enough and accepted >= enough:
+                    reason = "found"
+                elif self.cpu_budget and self._cpu_seconds() - cpu_start > self.cpu_budget:
+                    reason = "cpu_budget"
+                if reason != "done" and pending:
+                    # I candidati in corso si fermano al prossimo tratto, quelli in coda non partono
+                    shared.stop()
+                    for future in pending:
+                        future.cancel()
+                    break
+            cpu = self._cpu_seconds() - cpu_start
+        except BrokenProcessPool as e:
+            logger.error(f"Candidate pool broke, evaluating the candidates in the planner process: {e}")
+            metrics.inc("planner_candidate_stops_total", reason="broken")
+            self._executor = None
+            return None
+        finally:
+            shared.close()
+
+        metrics.inc("planner_candidate_stops_total", reason=reason)
+        metrics.inc("planner_candidates_total", len(paths), result="evaluated")
+        metrics.inc("planner_candidates_total", len(waypoints) - len(paths), result="skipped")
+        metrics.observe("planner_candidate_cpu_seconds", cpu)
+        logger.info(f"Evaluated {len(paths)} of {len(waypoints)} loop candidates on {self.workers} processes "
+                    f"({accepted} good, {cpu:.2f} s CPU, {shared.nbytes / 2 ** 20:.1f} MB shared, stop: {reason})")
+        return paths
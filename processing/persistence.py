@@ -0,0 +1,219 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import pickle
+import sqlite3
+import threading
+import time
+
+from telegram.ext import BasePersistence
+
+logger = logging.getLogger(__name__)
+
+# Database SQLite con lo stato del bot e le preferenze degli utenti
+STATE_DB = os.getenv("STATE_DB", "bot_state.sqlite")
+
+# Secondi tra un salvataggio dello stato e il successivo
+PERSISTENCE_INTERVAL = float(os.getenv("PERSISTENCE_INTERVAL", "60"))
+
+# Percorsi recenti ricordati per ogni utente
+RECENT_ROUTES = int(os.getenv("RECENT_ROUTES", "5"))
+
+
+def _connect(path):
+    conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+class SQLitePersistence(BasePersistence):
+    """Bot state in SQLite, one row per user, chat and conversation key.
+
+    The Application hands over its data every update_interval seconds; a
+    row is rewritten only when its pickled value changed since it was last
+    loaded or written, so a save costs what changed instead of the whole
+    state. On first start the data of a PicklePersistence file given as
+    migrate_from is imported.
+    """
+
+    def __init__(self, path=STATE_DB, store_data=None, update_interval=PERSISTENCE_INTERVAL, migrate_from=None):
+        super().__init__(store_data=store_data, update_interval=update_interval)
+        self.path = path
+        self.migrate_from = migrate_from
+        self.writes = 0
+        self._conn = None
+        self._lock = threading.Lock()
+        self._digests = {}
+
+    def _db(self):
+        if self._conn is None:
+            self._conn = _connect(self.path)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS state ("
+                "kind TEXT NOT NULL, key TEXT NOT NULL, value BLOB NOT NULL, PRIMARY KEY (kind, key))")
+            empty = self._conn.execute("SELECT COUNT(*) FROM state").fetchone()[0] == 0
+            if empty and self.migrate_from and os.path.exists(self.migrate_from):
+                self._migrate(self.migrate_from)
+        return self._conn
+
+    def _migrate(self, path):
+        with open(path, "rb") as f:
+            data = pickle.load(f)
+        for kind in ("user_data", "chat_data"):
+            for key, value in (data.get(kind) or {}).items():
+                self._write(kind, str(key), value)
+        if data.get("bot_data"):
+            self._write("bot_data", "", data["bot_data"])
+        if data.get("callback_data"):
+            self._write("callback_data", "", data["callback_data"])
+        for name, states in (data.get("conversations") or {}).items():
+            for key, state in states.items():
+                self._write(f"conversation:{name}", json.dumps(list(key)), state)
+        logger.info(f"Imported the bot state from {path}")
+
+    def _load(self, kind):
+        with self._lock:
+            rows = self._db().execute("SELECT key, value FROM state WHERE kind = ?", (kind,)).fetchall()
+            result = {}
+            for key, blob in rows:
+                self._digests[(kind, key)] = hashlib.blake2b(blob, digest_size=16).digest()
+                result[key] = pickle.loads(blob)
+        return result
+
+    def _write(self, kind, key, value):
+        blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        digest = hashlib.blake2b(blob, digest_size=16).digest()
+        if self._digests.get((kind, key)) == digest:
+            return
+        self._db().execute("INSERT OR REPLACE INTO state VALUES (?, ?, ?)", (kind, key, blob))
+        self._digests[(kind, key)] = digest
+        self.writes += 1
+
+    def _put(self, kind, key, value):
+        with self._lock:
+            self._write(kind, key, value)
+
+    def _delete(self, kind, key):
+        with self._lock:
+            self._db().execute("DELETE FROM state WHERE kind = ? AND key = ?", (kind, key))
+            self._digests.pop((kind, key), None)
+
+    async def get_user_data(self):
+        data = await asyncio.to_thread(self._load, "user_data")
+        return {int(key): value for key, value in data.items()}
+
+    async def get_chat_data(self):
+        data = await asyncio.to_thread(self._load, "chat_data")
+        return {int(key): value for key, value in data.items()}
+
+    async def get_bot_data(self):
+        return (await asyncio.to_thread(self._load, "bot_data")).get("", {})
+
+    async def get_callback_data(self):
+        return (await asyncio.to_thread(self._load, "callback_data")).get("")
+
+    async def get_conversations(self, name):
+        data = await asyncio.to_thread(self._load, f"conversation:{name}")
+        return {tuple(json.loads(key)): state for key, state in data.items()}
+
+    async def update_conversation(self, name, key, new_state):
+        if new_state is None:
+            await asyncio.to_thread(self._delete, f"conversation:{name}", json.dumps(list(key)))
+        else:
+            await asyncio.to_thread(self._put, f"conversation:{name}", json.dumps(list(key)), new_state)
+
+    async def update_user_data(self, user_id, data):
+        await asyncio.to_thread(self._put, "user_data", str(user_id), data)
+
+    async def update_chat_data(self, chat_id, data):
+        await asyncio.to_thread(self._put, "chat_data", str(chat_id), data)
+
+    async def update_bot_data(self, data):
+        await asyncio.to_thread(self._put, "bot_data", "", data)
+
+    async def update_callback_data(self, data):
+        await asyncio.to_thread(self._put, "callback_data", "", data)
+
+    async def drop_user_data(self, user_id):
+        await asyncio.to_thread(self._delete, "user_data", str(user_id))
+
+    async def drop_chat_data(self, chat_id):
+        await asyncio.to_thread(self._delete, "chat_data", str(chat_id))
+
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def flush(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+        logger.info(f"Bot state saved to {self.path} ({self.writes} rows written)")
+
+
+class UserPreferences:
+    """Home address, default level and recent routes of each user.
+
+    Rows are read one user at a time when needed, never all at startup.
+    """
+
+    def __init__(self, path=STATE_DB, recent=RECENT_ROUTES):
+        self.recent = recent
+        self._lock = threading.Lock()
+        self._conn = _connect(path)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS preferences ("
+            "user_id INTEGER PRIMARY KEY, home_address TEXT, level TEXT, recent TEXT NOT NULL DEFAULT '[]', "
+            "updated REAL)")
+
+    def get(self, user_id):
+        with self._lock:
+            row = self._conn.execute("SELECT home_address, level, recent FROM preferences WHERE user_id = ?",
+                                     (user_id,)).fetchone()
+        if row is None:
+            return {"home_address": None, "level": None, "recent": []}
+        return {"home_address": row[0], "level": row[1], "recent": json.loads(row[2])}
+
+    def set_home(self, user_id, address):
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO preferences (user_id, home_address, updated) VALUES (?, ?, ?) "
+                "ON CONFLICT(user_id) DO UPDATE SET home_address = excluded.home_address, updated = excluded.updated",
+                (user_id, address, time.time()))
+
+    def add_route(self, user_id, address, distance_km, level):
+        """Remember a planned route; its level becomes the user's default."""
+        route = {"address": address, "distance_km": distance_km, "level": level, "ts": round(time.time())}
+        with self._lock:
+            row = self._conn.execute("SELECT recent FROM preferences WHERE user_id = ?", (user_id,)).fetchone()
+            recent = [route] + (json.loads(row[0]) if row else [])[:self.recent - 1]
+            self._conn.execute(
+                "INSERT INTO preferences (user_id, level, recent, updated) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(user_id) DO UPDATE SET level = excluded.level, recent = excluded.recent, "
+                "updated = excluded.updated",
+                (user_id, level, json.dumps(recent), time.time()))
+
+    def hot_spots(self):
+        """(address, longest distance in km or None) of every home address and recent route start."""
+        spots = {}
+        with self._lock:
+            rows = self._conn.execute("SELECT home_address, recent FROM preferences").fetchall()
+        for home, recent in rows:
+            if home:
+                spots.setdefault(home, None)
+            for route in json.loads(recent):
+                spots[route["address"]] = max(spots.get(route["address"]) or 0, route["distance_km"])
+        return list(spots.items())
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
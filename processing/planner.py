@@ -0,0 +1,322 @@
+import gc
+import logging
+import os
+from collections import OrderedDict
+
+import osmnx as ox
+
+from processing import metrics
+from processing.elevation import get_elevation_model
+from processing.gpx import gpx_bytes
+from processing.graph_store import GraphStore
+from processing.loops import TOLERANCE, find_loops, search_radius
+from processing.memory import (NODE_DENSITY, RAW_NODE_FACTOR, MemoryBudget, MemoryBudgetExceeded,
+                               MemoryLimitReached, estimate_graph_bytes, estimate_nodes, region_density, release_memory)
+from processing.osm_tiles import TileLoader, tile_area_km2
+from processing.parallel import CandidatePool
+from processing.route_cache import RouteCache, route_key
+from processing.routing import RoutingEngine, nearest_node
+from processing.utils import get_coordinates, get_training_params
+
+
+logger = logging.getLogger("route_planner")
+
+# Configure OSMnx to use less memory
+ox.settings.use_cache = True
+ox.settings.log_console = True
+ox.settings.log_file = True
+# Solo i tag OSM usati dal planner, senza dizionari di tag inutili per ogni arco
+ox.settings.useful_tags_way = ["highway", "oneway", "junction"]
+ox.settings.useful_tags_node = ["highway"]
+
+# Numero di grafi tenuti in memoria da ogni worker
+GRAPH_CACHE_SIZE = int(os.getenv("PLANNER_GRAPH_CACHE_SIZE", "2"))
+
+# Below this fraction of the wanted search radius a route is not attempted under a memory budget
+MIN_RADIUS_FRACTION = 0.6
+
+_graph_cache = OrderedDict()
+graph_store = GraphStore()
+tile_loader = TileLoader()
+route_cache = RouteCache()
+budget = MemoryBudget()
+candidate_pool = CandidatePool()
+
+
+def graph_density(lat, lon, dist, mode="bike"):
+    """Return (nodes per km², whether it has to be downloaded) for the graph around a point."""
+    name = graph_store.find(lat, lon, dist, mode)
+    if name is None:
+        return NODE_DENSITY, True
+    return region_density(graph_store.regions()[name]), False
+
+
+def _reserve(lat, lon, dist, mode):
+    """Make room in the memory budget for a graph of radius dist, or raise MemoryBudgetExceeded."""
+    density, download = graph_density(lat, lon, dist, mode)
+    needed = estimate_graph_bytes(estimate_nodes(dist, density))
+    if download:
+        # Le parti ritagliate dalle celle e la loro unione, non ancora semplificate, esistono insieme;
+        # le celle restano mappate dal disco e solo una alla volta passa da networkx
+        needed += 2 * estimate_graph_bytes(int(estimate_nodes(dist, density) * RAW_NODE_FACTOR))
+        if tile_loader.missing(lat, lon, dist, mode):
+            tile_nodes = int(density * RAW_NODE_FACTOR * tile_area_km2(lat, tile_loader.size))
+            needed += estimate_graph_bytes(tile_nodes, networkx=True)
+    # Libera i grafi in cache prima di caricarne uno che non ci starebbe
+    release_memory()
+    while _graph_cache and needed > budget.available():
+        _graph_cache.popitem(last=False)
+        release_memory()
+    if needed > budget.available():
+        raise MemoryBudgetExceeded(
+            f"The road network within {dist / 1000:.1f} km needs about {needed / 2 ** 20:.0f} MB, more than the "
+            f"{max(budget.available(), 0) / 2 ** 20:.0f} MB left in the memory budget. Try a shorter distance.")
+
+
+def load_graph(lat, lon, dist, mode="bike"):
+    """Return the road graph around a point as a CSRGraph, reusing recently loaded graphs."""
+    key = (round(lat, 4), round(lon, 4), int(dist), mode)
+    graph = _graph_cache.get(key)
+    if graph is not None:
+        _graph_cache.move_to_end(key)
+        logger.info(f"Graph cache hit for {key}")
+        metrics.inc("cache_requests_total", cache="graph", result="hit")
+        return graph
+    metrics.inc("cache_requests_total", cache="graph", result="miss")
+    if budget.enabled:
+        _reserve(lat, lon, dist, mode)
+
+    # Usa una regione precaricata se copre il raggio richiesto, altrimenti le celle
+    # scaricate da Overpass (solo quelle che mancano ancora)
+    with metrics.span("planner_stage", stage="graph_store"):
+        graph = graph_store.graph_around(lat, lon, dist, mode)
+    source = "store"
+    if graph is None:
+        source = "overpass"
+        graph = tile_loader.graph_around(lat, lon, dist, mode)
+    metrics.inc("planner_graph_loads_total", source=source)
+
+    # Quote dal DEM locale, in un solo passaggio vettoriale su tutti i nodi
+    if graph.elevation is None:
+        dem = get_elevation_model()
+        if dem is not None:
+            with metrics.span("planner_stage", stage="elevation"):
+                dem.add_to(graph)
+    budget.check("Loading the road network")
+    _graph_cache[key] = graph
+    while len(_graph_cache) > GRAPH_CACHE_SIZE:
+        _graph_cache.popitem(last=False)
+        gc.collect()
+    return graph
+
+
+def plan_route(address, distance_km, level, output_file=None, mode="bike", sides=3, progress=None, start=None):
+    """Plan a circular route and return its GPX track, also written to output_file if given.
+
+    sides >= 3 asks for a polygon loop through sides - 1 waypoints, sides=2 for
+    an out-and-back route. progress, if given, is called with (stage name,
+    percent) as planning advances. start, if given, is the (lat, lon) of
+    the address, which is then not geocoded. Returns a dict describing the
+    route with the GPX as bytes under "gpx", raises
+    ValueError if no route is found and MemoryBudgetExceeded if it does not
+    fit in the memory budget (MemoryLimitReached if it ran out of memory).
+    """
+    try:
+        return _plan_route(address, distance_km, level, output_file, mode, sides, progress or _no_progress, start)
+    except MemoryBudgetExceeded:
+        raise
+    except MemoryError as e:
+        # Limite RLIMIT_AS raggiunto: libera la cache e riporta un errore leggibile
+        _graph_cache.clear()
+        tile_loader.clear()
+        release_memory()
+        raise MemoryLimitReached(
+            f"Planning a {distance_km:g} km route ran out of the {budget.budget / 2 ** 20:.0f} MB memory budget. "
+            f"Try a shorter distance.") from e
+
+
+def _no_progress(stage, percent):
+    pass
+
+
+def start_index(graph, start_id, lat, lon):
+    """Index of the start node in graph: the snapped node if present, else the nearest one."""
+    if start_id is not None:
+        try:
+            return graph.index_of(start_id)
+        except KeyError:
+            pass
+    return nearest_node(graph, lat, lon)
+
+
+def cached_route(lat, lon, distance_km, level, mode="bike", sides=3):
+    """Return (start node OSM id or None, cached route or None) for a start point."""
+    with metrics.span("planner_stage", stage="route_cache_lookup"):
+        start_id = route_cache.snapped_node(lat, lon, mode)
+        if start_id is None:
+            # Aggancio con l'indice spaziale della regione, senza caricare il grafo
+            node_ids, _ = graph_store.snap(lat, lon, mode)
+            if node_ids[0] >= 0:
+                start_id = int(node_ids[0])
+                route_cache.remember_snap(lat, lon, start_id, mode)
+        cached = None
+        if start_id is not None:
+            cached = route_cache.get(route_key(start_id, distance_km, level, mode, sides))
+    metrics.inc("cache_requests_total", cache="route", result="miss" if cached is None else "hit")
+    return start_id, cached
+
+
+def search_loops(graph, lat, lon, distance_m, level, sides=3, start_id=None):
+    """Return (engine, loops) for loops of distance_m starting near (lat, lon) on graph.
+
+    loops holds up to route_cache.alternatives (path, length) pairs, best
+    first, and is empty if none fits in the graph; the engine is on the
+    pruned graph the paths refer to.
+    """
+    # Find the nearest node to the starting point
+    with metrics.span("planner_stage", stage="nearest_node"):
+        start_node = start_index(graph, start_id, lat, lon)
+
+    # Two Dijkstra runs give the loop length through every node
+    with metrics.span("planner_stage", stage="shortest_paths"):
+        engine = RoutingEngine(graph, start_node)
+
+    # Solo i nodi che possono stare su un anello della lunghezza richiesta
+    with metrics.span("planner_stage", stage="prune"):
+        engine = engine.pruned(distance_m * (1 + TOLERANCE))
+
+    # Pick the turnaround points from the target distance band,
+    # keeping a few alternatives for the route cache
+    with metrics.span("planner_stage", stage="loop_search"):
+        loops = find_loops(engine, distance_m, sides, limit=route_cache.alternatives,
+                           max_ascent=get_training_params(level)["max_elevation_gain"], pool=candidate_pool)
+    budget.check("Searching the route")
+    return engine, loops
+
+
+def save_routes(engine, loops, lat, lon, distance_km, level, mode="bike", sides=3, output_file=None):
+    """Write the GPX tracks of loops found by search_loops to the route cache; return the result of plan_route."""
+    graph = engine.graph
+    route, length = loops[0]
+    ascent = engine.ascent(route)
+    with metrics.span("planner_stage", stage="gpx_write"):
+        tracks = [gpx_bytes(graph, path, elevation=graph.elevation) for path, _ in loops]
+    if output_file is not None:
+        with open(output_file, "wb") as f:
+            f.write(tracks[0])
+        logger.info(f"Route saved to {output_file}")
+
+    start_id = int(graph.node_ids[engine.start])
+    with metrics.span("planner_stage", stage="route_cache_store"):
+        route_cache.remember_snap(lat, lon, start_id, mode)
+        key = route_key(start_id, distance_km, level, mode, sides)
+        for (path, path_length), gpx in zip(loops, tracks):
+            route_cache.put(key, graph.node_ids[path], path_length, gpx)
+
+    return {"gpx": tracks[0], "length_m": length, "ascent_m": ascent, "nodes": len(route),
+            "node_ids": graph.node_ids[route], "cached": False}
+
+
+def _plan_route(address, distance_km, level, output_file, mode, sides, progress, start=None):
+    if start is None:
+        progress("Looking up the address", 5)
+        with metrics.span("planner_stage", stage="geocode"):
+            start_lat, start_lon = get_coordinates(address)
+        logger.info(f"Coordinates for address {address}: {start_lat}, {start_lon}")
+    else:
+        start_lat, start_lon = start
+
+    # Punto di partenza noto: il percorso potrebbe essere già in cache
+    start_id, cached = cached_route(start_lat, start_lon, distance_km, level, mode, sides)
+    if cached is not None:
+        logger.info(f"Route cache hit for start node {start_id}")
+        if output_file is not None:
+            with open(output_file, "wb") as f:
+                f.write(cached["gpx"])
+        return {"gpx": cached["gpx"], "length_m": cached["length_m"], "nodes": len(cached["nodes"]),
+                "node_ids": cached["nodes"], "cached": True}
+
+    training_params = get_training_params(level)
+    logger.info(f"Training params: {training_params}")
+
+    max_distance_m = distance_km * 1000
+    logger.info(f"Max distance in meters: {max_distance_m}")
+
+    # Start from the radius that should contain the loop's waypoints
+    initial_radius = search_radius(max_distance_m, sides)
+    radius_cap = max_distance_m * 0.8
+    if budget.enabled:
+        release_memory()
+        density, download = graph_density(start_lat, start_lon, initial_radius, mode)
+        if download:
+            # Mentre vengono unite, le celle non semplificate occupano più del grafo finale
+            density *= 1 + 2 * RAW_NODE_FACTOR
+        reclaimable = sum(graph.nbytes for graph in _graph_cache.values())
+        radius_cap = min(radius_cap, budget.max_radius(density, reclaimable=reclaimable))
+        if radius_cap < initial_radius * MIN_RADIUS_FRACTION:
+            raise MemoryBudgetExceeded(
+                f"A {distance_km:g} km route needs the road network within {initial_radius / 1000:.1f} km, but the "
+                f"{budget.budget / 2 ** 20:.0f} MB memory budget only fits {radius_cap / 1000:.1f} km. "
+                f"Try a shorter distance.")
+        if radius_cap < initial_radius:
+            logger.warning(f"Memory budget limits the search radius to {radius_cap / 1000:.2f} km")
+            initial_radius = radius_cap
+    radius = initial_radius
+    logger.info(f"Loading initial graph with radius {initial_radius / 1000:.2f} km...")
+    progress("Loading the road network", 15)
+    with metrics.span("planner_stage", stage="graph_load"):
+        graph = load_graph(start_lat, start_lon, initial_radius, mode)
+
+    # Incrementally expand if needed
+    max_iterations = 5
+    current_iteration = 0
+    loops = []
+
+    while not loops and current_iteration < max_iterations:
+        try:
+            progress("Searching for loops", 40 + 10 * current_iteration)
+            engine, loops = search_loops(graph, start_lat, start_lon, max_distance_m, level, sides, start_id)
+            graph = engine.graph
+            if loops:
+                logger.info(f"Found suitable route with length: {loops[0][1] / 1000:.2f} km")
+
+            # If we couldn't find a good route, expand the graph
+            if not loops:
+                current_iteration += 1
+                if current_iteration >= max_iterations:
+                    break
+
+                new_radius = initial_radius * (1 + current_iteration)
+                new_radius = min(new_radius, radius_cap)  # Cap maximum radius
+                if new_radius <= radius:
+                    logger.info("Search radius already at its cap, not expanding")
+                    break
+                radius = new_radius
+
+                logger.info(
+                    f"Expanding graph with radius: {new_radius / 1000:.2f} km (iteration {current_iteration})")
+                metrics.inc("planner_graph_expansions_total")
+                progress("Expanding the search area", 35 + 10 * current_iteration)
+                with metrics.span("planner_stage", stage="graph_load"):
+                    graph = load_graph(start_lat, start_lon, new_radius, mode)
+
+        except MemoryError:
+            raise
+        except Exception as e:
+            logger.error(f"Error during route finding: {e}")
+            current_iteration += 1
+
+            # Try again with a smaller graph
+            new_radius = radius = initial_radius * (0.8 ** current_iteration)
+            logger.info(f"Retrying with smaller radius: {new_radius / 1000:.2f} km")
+            metrics.inc("planner_graph_retries_total")
+            with metrics.span("planner_stage", stage="graph_load"):
+                graph = load_graph(start_lat, start_lon, new_radius, mode)
+
+    if not loops:
+        raise ValueError("Failed to find a suitable route after multiple attempts")
+
+    # Create GPX file from route
+    logger.info("Creating GPX file...")
+    progress("Writing the GPX track", 90)
+    return save_routes(engine, loops, start_lat, start_lon, distance_km, level, mode, sides, output_file)
@@ -0,0 +1,111 @@
+import logging
+import os
+import random
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Configurazione della cache dei percorsi
+ROUTE_CACHE_PATH = os.getenv("ROUTE_CACHE_PATH", "route_cache.sqlite")
+ROUTE_CACHE_MAX_BYTES = int(os.getenv("ROUTE_CACHE_MAX_BYTES", str(200 * 1024 * 1024)))
+ROUTE_CACHE_ALTERNATIVES = int(os.getenv("ROUTE_CACHE_ALTERNATIVES", "3"))
+ROUTE_CACHE_MAX_SNAPS = int(os.getenv("ROUTE_CACHE_MAX_SNAPS", "100000"))
+
+# Requested distances are bucketed to this many km
+DISTANCE_STEP_KM = float(os.getenv("ROUTE_CACHE_DISTANCE_STEP", "1"))
+
+
+def route_key(start_node, distance_km, level, mode="bike", sides=3):
+    bucket = round(distance_km / DISTANCE_STEP_KM) * DISTANCE_STEP_KM
+    return f"{int(start_node)}:{bucket:g}:{level}:{mode}:{int(sides)}"
+
+
+def _coord_key(lat, lon, mode):
+    return f"{lat:.5f},{lon:.5f}:{mode}"
+
+
+class RouteCache:
+    """Computed loops shared by all workers, stored in SQLite.
+
+    Each key holds up to `alternatives` different loops (OSM node ids and GPX
+    bytes); lookups return one of them at random. The least recently used
+    entries are evicted once the GPX payload exceeds max_bytes, and the
+    least recently used start points once more than max_snaps are known.
+    """
+
+    def __init__(self, path=ROUTE_CACHE_PATH, max_bytes=ROUTE_CACHE_MAX_BYTES,
+                 alternatives=ROUTE_CACHE_ALTERNATIVES, max_snaps=ROUTE_CACHE_MAX_SNAPS):
+        self.max_bytes = max_bytes
+        self.alternatives = alternatives
+        self.max_snaps = max_snaps
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS routes ("
+            "key TEXT, variant INTEGER, nodes BLOB, length REAL, gpx BLOB, size INTEGER, last_used REAL, "
+            "PRIMARY KEY (key, variant))")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS routes_last_used ON routes (last_used)")
+        # Coordinate di partenza già agganciate a un nodo, per evitare di caricare il grafo
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(snapped)")]
+        if columns and "last_used" not in columns:
+            # Tabella di una versione precedente, senza la data d'uso per l'eviction
+            self._conn.execute("DROP TABLE IF EXISTS snapped")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS snapped (coords TEXT PRIMARY KEY, node INTEGER, last_used REAL)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS snapped_last_used ON snapped (last_used)")
+
+    def snapped_node(self, lat, lon, mode="bike"):
+        coords = _coord_key(lat, lon, mode)
+        with self._lock:
+            row = self._conn.execute("SELECT node FROM snapped WHERE coords = ?", (coords,)).fetchone()
+            if row is not None:
+                self._conn.execute("UPDATE snapped SET last_used = ? WHERE coords = ?", (time.time(), coords))
+        return row[0] if row else None
+
+    def remember_snap(self, lat, lon, node, mode="bike"):
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO snapped VALUES (?, ?, ?)",
+                               (_coord_key(lat, lon, mode), int(node), time.time()))
+            count = self._conn.execute("SELECT COUNT(*) FROM snapped").fetchone()[0]
+            if count > self.max_snaps:
+                self._conn.execute("DELETE FROM snapped WHERE coords IN "
+                                   "(SELECT coords FROM snapped ORDER BY last_used LIMIT ?)",
+                                   (count - self.max_snaps,))
+
+    def get(self, key):
+        """Return one cached alternative as dict(nodes, length_m, gpx), or None."""
+        with self._lock:
+            rows = self._conn.execute("SELECT variant, nodes, length, gpx FROM routes WHERE key = ?",
+                                      (key,)).fetchall()
+            if not rows:
+                return None
+            variant, nodes, length, gpx = random.choice(rows)
+            self._conn.execute("UPDATE routes SET last_used = ? WHERE key = ? AND variant = ?",
+                               (time.time(), key, variant))
+        return {"nodes": np.frombuffer(nodes, dtype=np.int64), "length_m": length, "gpx": gpx}
+
+    def put(self, key, nodes, length_m, gpx):
+        """Add an alternative for key; ignored once the key has enough of them."""
+        nodes = np.asarray(nodes, dtype=np.int64).tobytes()
+        with self._lock:
+            variants, variant = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(MAX(variant) + 1, 0) FROM routes WHERE key = ?", (key,)).fetchone()
+            if variants >= self.alternatives:
+                return
+            self._conn.execute("INSERT INTO routes VALUES (?, ?, ?, ?, ?, ?, ?)",
+                               (key, variant, nodes, length_m, gpx, len(gpx) + len(nodes), time.time()))
+            self._evict()
+
+    def _evict(self):
+        total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM routes").fetchone()[0]
+        while total > self.max_bytes:
+            row = self._conn.execute("SELECT key, variant, size FROM routes ORDER BY last_used LIMIT 1").fetchone()
+            if row is None:
+                break
+            self._conn.execute("DELETE FROM routes WHERE key = ? AND variant = ?", row[:2])
+            total -= row[2]
@@ -0,0 +1,253 @@
+import asyncio
+import json
+import logging
+import math
+import os
+import re
+
+import httpx
+
+from processing import metrics
+from processing.weather import TTLCache
+
+logger = logging.getLogger(__name__)
+
+LEVELS = ("beginner", "intermediate", "advanced")
+DEFAULT_LEVEL = "intermediate"
+
+MISTRAL_MODEL = os.getenv("MISTRAL_MODEL", "mistral-small-latest")
+
+# Endpoint alternativo dell'API Mistral ("" = quello ufficiale)
+MISTRAL_SERVER_URL = os.getenv("MISTRAL_SERVER_URL", "")
+
+# Durata della cache dei parametri estratti dal modello
+AI_PARSE_CACHE_TTL = int(os.getenv("AI_PARSE_CACHE_TTL", "86400"))
+
+# Le richieste che arrivano entro AI_BATCH_WINDOW secondi vanno al modello in un solo prompt
+AI_BATCH_WINDOW = float(os.getenv("AI_BATCH_WINDOW", "0.05"))
+AI_BATCH_SIZE = int(os.getenv("AI_BATCH_SIZE", "8"))
+
+_DISTANCE = re.compile(r"^(\d+(?:[.,]\d+)?)(km)?$", re.IGNORECASE)
+
+PROMPT = (
+    "Extract the parameters of a bike route request from each numbered text: the start address, the "
+    "distance in km and the training level (one of beginner, intermediate, advanced). "
+    'Answer with a JSON object {"results": [...]} holding one object per text, in the same order, with '
+    'the keys "address" (string), "distance" (number) and "level" (string). Use null for a value the text '
+    "does not give. Ignore irrelevant details.\n"
+)
+
+
+class RouteParseError(ValueError):
+    """Raised when route parameters cannot be extracted from the text."""
+
+
+def parse_route_command(text, home=None, default_level=DEFAULT_LEVEL):
+    """Parse the documented `[Address] [km] [level]` syntax without calling the model.
+
+    Returns the parameters, or None when the text does not follow the syntax.
+    Without a level the distance needs its "km" unit, otherwise it could be
+    the house number of the address. Without an address, home is used.
+    """
+    words = text.split()
+    level = None
+    if words and words[-1].lower().strip(".,;") in LEVELS:
+        level = words.pop().lower().strip(".,;")
+    if len(words) >= 2 and words[-1].lower() == "km":
+        words[-2:] = [words[-2] + "km"]
+    if not words:
+        return None
+
+    match = _DISTANCE.match(words[-1].strip(".,;"))
+    if match is None or (level is None and match[2] is None):
+        return None
+    distance = float(match[1].replace(",", "."))
+    address = " ".join(words[:-1]).strip(" ,;") or home
+    if distance <= 0 or not address or not re.search(r"[^\W\d_]", address):
+        return None
+    return {"address": address, "distance": distance, "level": level or default_level}
+
+
+def _validate(item):
+    """Route parameters from one object of the model's answer, None for an address or level it does not give."""
+    if not isinstance(item, dict):
+        raise RouteParseError("The request could not be understood.")
+    try:
+        distance = float(str(item.get("distance")).replace(",", "."))
+    except ValueError:
+        raise RouteParseError("No distance found in the request.") from None
+    if not math.isfinite(distance) or distance <= 0:
+        raise RouteParseError("The distance must be a positive number of km.")
+    level = str(item.get("level") or "").lower()
+    return {"address": str(item.get("address") or "").strip() or None, "distance": distance,
+            "level": level if level in LEVELS else None}
+
+
+def _with_defaults(params, home, default_level):
+    """Fill in the user's home and level where the model found none."""
+    params = dict(params, address=params["address"] or home, level=params["level"] or default_level)
+    if not params["address"]:
+        raise RouteParseError("No start address found in the request.")
+    return params
+
+
+class RouteParser:
+    """Route parameters from a /route request, asking Mistral only when needed.
+
+    Requests in the documented syntax are parsed locally. The others share
+    one pooled client: answers are cached per text, ignoring case and
+    spacing, concurrent identical texts share one call and texts arriving
+    within batch_window seconds of each other are sent in a single prompt.
+    """
+
+    def __init__(self, api_key, model=MISTRAL_MODEL, batch_window=AI_BATCH_WINDOW, batch_size=AI_BATCH_SIZE,
+                 cache_ttl=AI_PARSE_CACHE_TTL, timeout=30.0, max_concurrency=4):
+        self.api_key = api_key
+        self.model = model
+        self.batch_window = batch_window
+        self.batch_size = batch_size
+        self.cache_ttl = cache_ttl
+        self.timeout = timeout
+        self.max_concurrency = max_concurrency
+        self.cache = TTLCache()
+        self._client = None
+        self._http = None
+        self._inflight = {}
+        self._pending = []
+        self._flush_handle = None
+        # Riferimenti ai batch in corso, che altrimenti potrebbero essere raccolti dal garbage collector
+        self._batches = set()
+
+    def _ensure_client(self):
+        if self._client is None:
+            from mistralai import Mistral
+
+            self._http = httpx.AsyncClient(
+                timeout=self.timeout,
+                limits=httpx.Limits(max_connections=self.max_concurrency,
+                                    max_keepalive_connections=self.max_concurrency),
+            )
+            self._client = Mistral(api_key=self.api_key, async_client=self._http,
+                                   server_url=MISTRAL_SERVER_URL or None)
+        return self._client
+
+    async def close(self):
+        # I testi in attesa partono subito e i batch in corso finiscono prima di chiudere il client
+        self._flush()
+        if self._batches:
+            await asyncio.gather(*self._batches, return_exceptions=True)
+        if self._http is not None:
+            await self._http.aclose()
+            self._http = None
+            self._client = None
+
+    async def parse(self, text, home=None, default_level=DEFAULT_LEVEL):
+        """Return {"address", "distance", "level"} or raise RouteParseError.
+
+        home and default_level fill in what the request leaves out. The
+        model's answers are cached without them, so they always come from
+        the current call.
+        """
+        params = parse_route_command(text, home, default_level)
+        if params is not None:
+            metrics.inc("cache_requests_total", cache="route_parse", result="rule")
+            return params
+
+        # Solo spazi e maiuscole: la punteggiatura cambia il significato ("10.5 km" non è "10 5 km")
+        key = " ".join(text.split()).casefold()
+        if not key:
+            raise RouteParseError("The request is empty.")
+        found, params = self.cache.get(key)
+        if found:
+            metrics.inc("cache_requests_total", cache="route_parse", result="hit")
+            return _with_defaults(params, home, default_level)
+
+        future = self._inflight.get(key)
+        if future is None:
+            future = self._enqueue(text)
+            self._inflight[key] = future
+            future.add_done_callback(lambda f: self._done(key, f))
+            metrics.inc("cache_requests_total", cache="route_parse", result="miss")
+        else:
+            metrics.inc("cache_requests_total", cache="route_parse", result="coalesced")
+
+        # shield: se un chiamante viene cancellato gli altri ricevono comunque il risultato
+        return _with_defaults(await asyncio.shield(future), home, default_level)
+
+    def _done(self, key, future):
+        self._inflight.pop(key, None)
+        if not future.cancelled() and future.exception() is None:
+            self.cache.put(key, future.result(), self.cache_ttl)
+
+    def _enqueue(self, text):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((text, future))
+        if len(self._pending) >= self.batch_size:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.batch_window, self._flush)
+        return future
+
+    def _flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.ensure_future(self._run_batch(batch))
+            self._batches.add(task)
+            task.add_done_callback(self._batch_done)
+
+    def _batch_done(self, task):
+        self._batches.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"AI parsing batch failed: {task.exception()!r}")
+
+    async def _run_batch(self, batch):
+        metrics.observe("ai_parse_batch_size", len(batch))
+        try:
+            results = await self._complete([text for text, _ in batch])
+        except Exception as e:
+            logger.error(f"AI parsing of {len(batch)} requests failed: {e}")
+            results = [RouteParseError("The request could not be understood.")] * len(batch)
+        for (_, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    async def _complete(self, texts):
+        """One model call for all texts; a list of parameters or RouteParseError per text."""
+        client = self._ensure_client()
+        prompt = PROMPT + "".join(f"{i}. {text.strip()}\n" for i, text in enumerate(texts, 1))
+        with metrics.span("upstream_request", service="mistral"):
+            response = await client.chat.complete_async(
+                model=self.model,
+                messages=[{"content": prompt, "role": "user"}],
+                response_format={"type": "json_object"},
+                temperature=0,
+            )
+        response_text = response.choices[0].message.content.strip()
+        response_text = re.sub(r"```json\n(.*?)\n```", r"\1", response_text, flags=re.DOTALL)
+        answer = json.loads(response_text)
+        items = answer.get("results") if isinstance(answer, dict) else answer
+        if isinstance(answer, dict) and items is None and len(texts) == 1:
+            items = [answer]
+        if not isinstance(items, list) or len(items) != len(texts):
+            if len(texts) == 1:
+                raise RouteParseError("The request could not be understood.")
+            # Risposta del batch non allineata: ogni testo viene richiesto da solo
+            logger.warning(f"AI answer for a batch of {len(texts)} requests is misaligned, retrying one by one")
+            singles = await asyncio.gather(*(self._complete([text]) for text in texts), return_exceptions=True)
+            return [single[0] if isinstance(single, list) else single for single in singles]
+
+        results = []
+        for item in items:
+            try:
+                results.append(_validate(item))
+            except RouteParseError as e:
+                results.append(e)
+        return results
@@ -0,0 +1,95 @@
+import logging
+
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+
+from processing.graph_store import distances_m
+
+logger = logging.getLogger(__name__)
+
+# Le lunghezze nulle verrebbero ignorate da csgraph
+MIN_EDGE_LENGTH = 0.01
+
+
+def to_matrix(graph):
+    """Sparse adjacency matrix view of a CSRGraph, weighted by edge length."""
+    lengths = np.maximum(np.asarray(graph.lengths, dtype=np.float64), MIN_EDGE_LENGTH)
+    return csr_matrix((lengths, graph.targets, graph.offsets), shape=(graph.n_nodes, graph.n_nodes))
+
+
+def nearest_node(graph, lat, lon):
+    return int(np.argmin(distances_m(graph.lat, graph.lon, lat, lon)))
+
+
+def walk(predecessors, node):
+    """Follow a predecessor array from node back to the Dijkstra source."""
+    path = [node]
+    while predecessors[path[-1]] >= 0:
+        path.append(int(predecessors[path[-1]]))
+    return path
+
+
+class RoutingEngine:
+    """Shortest-path distances from and back to a start node.
+
+    One Dijkstra on the graph and one on the reversed graph give, for every
+    node, the length of the shortest out-and-back loop through it.
+    """
+
+    def __init__(self, graph, start):
+        self.graph = graph
+        self.start = start
+        self.matrix = matrix = to_matrix(graph)
+        self.dist_out, self.pred_out = dijkstra(matrix, indices=start, return_predecessors=True)
+
+        # Per i grafi non orientati il ritorno coincide con l'andata
+        reverse = matrix.T.tocsr()
+        if (matrix != reverse).nnz == 0:
+            self.dist_back, self.pred_back = self.dist_out, self.pred_out
+        else:
+            self.dist_back, self.pred_back = dijkstra(reverse, indices=start, return_predecessors=True)
+
+        self.loop_lengths = self.dist_out + self.dist_back
+
+        # Dislivello positivo per arco, se il grafo ha le quote
+        self.ascent_matrix = None
+        if graph.ascent is not None:
+            self.ascent_matrix = csr_matrix((np.asarray(graph.ascent, dtype=np.float64), graph.targets, graph.offsets),
+                                            shape=matrix.shape)
+
+    def pruned(self, max_loop_m, min_saving=0.25):
+        """Engine on the part of the graph that can lie on a loop of at most max_loop_m.
+
+        A node is on such a loop only if its own out-and-back loop is no longer,
+        so everything else (the outside of a network-distance ellipse with
+        both foci at the start, and unreachable components) is dropped. Returns
+        self when that would remove less than min_saving of the nodes.
+        """
+        keep = np.nonzero(self.loop_lengths <= max_loop_m)[0]
+        if len(keep) > (1 - min_saving) * self.graph.n_nodes:
+            return self
+        start = int(np.searchsorted(keep, self.start))
+        return RoutingEngine(self.graph.subgraph(keep), start)
+
+    def rank(self, target_m):
+        """Reachable turnaround nodes sorted by how close their loop is to target_m."""
+        candidates = np.nonzero(np.isfinite(self.loop_lengths))[0]
+        candidates = candidates[candidates != self.start]
+        return candidates[np.argsort(np.abs(self.loop_lengths[candidates] - target_m))]
+
+    def path_to(self, node):
+        return walk(self.pred_out, node)[::-1]
+
+    def path_back(self, node):
+        return walk(self.pred_back, node)
+
+    def ascent(self, path):
+        """Total climbing in meters along path, 0 without elevation data."""
+        if self.ascent_matrix is None or len(path) < 2:
+            return 0.0
+        return float(np.asarray(self.ascent_matrix[path[:-1], path[1:]]).sum())
+
+    def loop(self, node):
+        """Node indices of the loop start -> node -> start."""
+        return self.path_to(node) + self.path_back(node)[1:]
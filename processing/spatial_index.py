@@ -0,0 +1,50 @@
+import logging
+import os
+import pickle
+
+import numpy as np
+
+from processing.graph_store import EARTH_RADIUS_M
+
+logger = logging.getLogger(__name__)
+
+
+def unit_vectors(lat, lon):
+    """Points on the unit sphere, where euclidean distance is monotonic in great-circle distance."""
+    lat = np.radians(np.atleast_1d(np.asarray(lat, dtype=np.float64)))
+    lon = np.radians(np.atleast_1d(np.asarray(lon, dtype=np.float64)))
+    cos_lat = np.cos(lat)
+    return np.column_stack((cos_lat * np.cos(lon), cos_lat * np.sin(lon), np.sin(lat)))
+
+
+class SpatialIndex:
+    """KD-tree over the nodes of a graph for nearest-node snapping.
+
+    Built once per stored region and pickled next to its arrays, so every
+    worker loads it instead of scanning all nodes for each lookup.
+    """
+
+    def __init__(self, tree):
+        self.tree = tree
+
+    @classmethod
+    def build(cls, lat, lon):
+        from scipy.spatial import cKDTree
+
+        return cls(cKDTree(unit_vectors(lat, lon)))
+
+    def save(self, path):
+        tmp = f"{path}.tmp"
+        with open(tmp, "wb") as f:
+            pickle.dump(self.tree, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as f:
+            return cls(pickle.load(f))
+
+    def nearest(self, lat, lon):
+        """Snap arrays of points: return (node indices, distances in meters)."""
+        chord, idx = self.tree.query(unit_vectors(lat, lon), k=1)
+        return idx, 2 * EARTH_RADIUS_M * np.arcsin(np.minimum(chord / 2, 1.0))
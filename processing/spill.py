@@ -0,0 +1,72 @@
+import logging
+import os
+import tempfile
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+# Cartella temporanea per i file troppo grandi da passare via pipe
+SPILL_DIR = os.getenv("SPILL_DIR", os.path.join(tempfile.gettempdir(), "outdoor_buddy_spill"))
+SPILL_MAX_BYTES = int(os.getenv("SPILL_MAX_BYTES", str(100 * 1024 * 1024)))
+SPILL_MAX_AGE = int(os.getenv("SPILL_MAX_AGE", "3600"))
+
+
+class SpillStore:
+    """Size-capped directory of short-lived files handed from workers to the bot.
+
+    Files are deleted when taken; gc() removes the ones older than max_age and
+    the oldest ones beyond max_bytes, e.g. left behind by a crashed bot.
+    """
+
+    def __init__(self, root=SPILL_DIR, max_bytes=SPILL_MAX_BYTES, max_age=SPILL_MAX_AGE):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        os.makedirs(root, exist_ok=True)
+
+    def put(self, data, suffix=""):
+        """Write data to a new file and return its path."""
+        self.gc(reserve=len(data))
+        path = os.path.join(self.root, f"{uuid.uuid4().hex}{suffix}")
+        tmp = f"{path}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+        return path
+
+    def take(self, path):
+        """Read a spilled file and delete it."""
+        if os.path.dirname(os.path.abspath(path)) != os.path.abspath(self.root):
+            raise ValueError(f"{path} is not in the spill store")
+        with open(path, "rb") as f:
+            data = f.read()
+        os.remove(path)
+        return data
+
+    def gc(self, reserve=0):
+        """Delete expired files, then the oldest until reserve more bytes fit under max_bytes."""
+        files = []
+        for entry in os.scandir(self.root):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, entry.path))
+        files.sort()
+
+        now = time.time()
+        total = sum(size for _, size, _ in files)
+        removed = 0
+        for mtime, size, path in files:
+            if now - mtime <= self.max_age and total + reserve <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                removed += 1
+            except FileNotFoundError:
+                pass
+            total -= size
+        if removed:
+            logger.info(f"Removed {removed} files from the spill store")
+        return removed
@@ -1,27 +1,14 @@
-import osmnx as ox
-import networkx as nx
-import gpxpy.gpx
-from geopy.geocoders import Nominatim
-import random
 import logging
-import sys
+
+from processing.geocoding import get_geocoder
 
 
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO,
-    handlers=[
-        logging.FileHandler("bot.log"),
-        logging.StreamHandler(sys.stdout)
-    ]
-)
 logger = logging.getLogger(__name__)
 
 def get_coordinates(address):
-    geolocator = Nominatim(user_agent="route_planner_bot")
-    location = geolocator.geocode(address)
+    location = get_geocoder().geocode(address)
     if location:
-        return location.latitude, location.longitude
+        return location
     else:
         raise ValueError("Address not found.")
 
@@ -36,6 +23,13 @@ def get_training_params(level):
 
 
 def plan_circular_route(address, desired_distance_km, training_level, mode="bike", output_file="bike_route.gpx"):
+    # Stack di routing caricato solo qui: il bot usa questo modulo senza osmnx e scipy
+    import osmnx as ox
+
+    from processing.gpx import write_gpx
+    from processing.graph_store import CSRGraph
+    from processing.routing import RoutingEngine, nearest_node
+
     try:
         logger.info(f"Planning route for address: {address}, distance: {desired_distance_km}, level: {training_level}")
         start_lat, start_lon = get_coordinates(address)
@@ -48,38 +42,27 @@ def plan_circular_route(address, desired_distance_km, training_level, mode="bike
         logger.info(f"Max distance in meters: {max_distance_m}")
 
         G = ox.graph_from_point((start_lat, start_lon), dist=max_distance_m * 1.5, network_type=mode)
+        graph = CSRGraph.from_networkx(G)
+        del G
 
-        start_node = ox.distance.nearest_nodes(G, start_lon, start_lat)
-
-        nodes = list(G.nodes())
-        random_node = random.choice(nodes)
-
-        route_to_random = nx.shortest_path(G, start_node, random_node, weight="length")
-
-        route_back = nx.shortest_path(G, random_node, start_node, weight="length")
+        start_node = nearest_node(graph, start_lat, start_lon)
 
-        route = route_to_random + route_back[1:]
+        # Loop lengths through every node from one Dijkstra out and one back
+        engine = RoutingEngine(graph, start_node)
+        ranked = engine.rank(max_distance_m)
+        if not len(ranked):
+            print("No route found for the address and distance.")
+            return
 
-        route_length = sum(nx.get_edge_attributes(G, "length")[edge] for edge in zip(route[:-1], route[1:]))
+        route = engine.loop(int(ranked[0]))
+        route_length = float(engine.loop_lengths[ranked[0]])
 
         if abs(route_length - max_distance_m) > 0.3 * max_distance_m:
             print("No route found for the address and distance.")
             return
 
-        gdf_nodes, _ = ox.graph_to_gdfs(G, nodes=True, edges=True)
-        gdf_route = gdf_nodes.loc[route]
-
-        gpx = gpxpy.gpx.GPX()
-        track = gpxpy.gpx.GPXTrack()
-        gpx.tracks.append(track)
-        segment = gpxpy.gpx.GPXTrackSegment()
-
-        for _, node in gdf_route.iterrows():
-            segment.points.append(gpxpy.gpx.GPXTrackPoint(node["y"], node["x"]))
-        track.segments.append(segment)
-
         with open(output_file, "w") as f:
-            f.write(gpx.to_xml())
+            write_gpx(f, graph, route)
 
         print(f"Suggested circular route: {route_length / 1000:.2f} km, saved in {output_file}")
     except Exception as e:
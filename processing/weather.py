@@ -0,0 +1,167 @@
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict
+
+import httpx
+
+from processing import metrics
+from processing.geocoding import normalize_address
+
+logger = logging.getLogger(__name__)
+
+URL = "http://api.weatherapi.com/v1"
+
+# Durata della cache: meteo attuale e previsioni
+CURRENT_TTL = int(os.getenv("WEATHER_CURRENT_TTL", "600"))
+FORECAST_TTL = int(os.getenv("WEATHER_FORECAST_TTL", "3600"))
+
+# Lato della griglia in gradi per le posizioni GPS (circa 5 km)
+GRID_STEP = float(os.getenv("WEATHER_GRID_STEP", "0.05"))
+
+
+def grid_cell(lat, lon, step=GRID_STEP):
+    """Center of the grid cell containing a GPS position, as a weatherapi.com query."""
+    return f"{round(lat / step) * step:.4f},{round(lon / step) * step:.4f}"
+
+
+class TTLCache:
+    """Small in-memory LRU cache whose entries expire after a per-entry TTL."""
+
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """Return (found, value)."""
+        entry = self._entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            self._entries.pop(key, None)
+            self.misses += 1
+            return False, None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return True, entry[1]
+
+    def put(self, key, value, ttl):
+        self._entries[key] = (time.monotonic() + ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+
+class WeatherClient:
+    """Async weatherapi.com client sharing one keep-alive connection pool.
+
+    Transient failures (network errors, 429 and 5xx) are retried with
+    exponential backoff; at most max_concurrency requests are in flight.
+    Lookups are cached per normalized location and concurrent identical
+    lookups share one upstream call.
+    """
+
+    def __init__(self, api_key, base_url=URL, timeout=10.0, retries=3, backoff=0.5, max_concurrency=10):
+        self.api_key = api_key
+        self.base_url = base_url
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_concurrency = max_concurrency
+        self._client = None
+        self._semaphore = None
+        self.cache = TTLCache()
+        self.coalesced = 0
+        self._inflight = {}
+
+    def _ensure_client(self):
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                base_url=self.base_url,
+                timeout=self.timeout,
+                limits=httpx.Limits(max_connections=self.max_concurrency,
+                                    max_keepalive_connections=self.max_concurrency),
+            )
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._client
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def get(self, endpoint, **params):
+        """GET an endpoint and return its JSON, or None if the location is not found."""
+        client = self._ensure_client()
+        params = {"key": self.api_key, "lang": "en", **params}
+        for attempt in range(self.retries + 1):
+            start = time.perf_counter()
+            try:
+                async with self._semaphore:
+                    response = await client.get(endpoint, params=params)
+                metrics.observe("upstream_request_seconds", time.perf_counter() - start, service="weatherapi",
+                                endpoint=endpoint, status=response.status_code)
+                if response.status_code == 200:
+                    return response.json()
+                if response.status_code != 429 and response.status_code < 500:
+                    logger.info(f"Weather API {endpoint} returned {response.status_code}")
+                    return None
+                error = httpx.HTTPStatusError(f"HTTP {response.status_code}", request=response.request,
+                                              response=response)
+            except httpx.TransportError as e:
+                metrics.observe("upstream_request_seconds", time.perf_counter() - start, service="weatherapi",
+                                endpoint=endpoint, status="transport_error")
+                error = e
+
+            if attempt == self.retries:
+                raise error
+            metrics.inc("upstream_retries_total", service="weatherapi")
+            delay = self.backoff * 2 ** attempt
+            logger.warning(f"Weather API {endpoint} failed ({error}), retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+    async def _cached(self, key, ttl, endpoint, **params):
+        found, data = self.cache.get(key)
+        if found:
+            metrics.inc("cache_requests_total", cache="weather", result="hit")
+            return data
+
+        task = self._inflight.get(key)
+        if task is None:
+            async def fetch():
+                result = await self.get(endpoint, **params)
+                self.cache.put(key, result, ttl)
+                return result
+
+            task = asyncio.ensure_future(fetch())
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+            metrics.inc("cache_requests_total", cache="weather", result="miss")
+        else:
+            self.coalesced += 1
+            metrics.inc("cache_requests_total", cache="weather", result="coalesced")
+
+        # shield: se un chiamante viene cancellato gli altri ricevono comunque il risultato
+        return await asyncio.shield(task)
+
+    def stats(self):
+        lookups = self.cache.hits + self.cache.misses
+        return {
+            "hits": self.cache.hits,
+            "misses": self.cache.misses,
+            "coalesced": self.coalesced,
+            "hit_rate": self.cache.hits / lookups if lookups else 0.0,
+        }
+
+    async def current(self, q):
+        return await self._cached(("current", normalize_address(q)), CURRENT_TTL, "/current.json", q=q)
+
+    async def current_at(self, lat, lon):
+        """Current weather for a GPS position, shared by every position in the same grid cell."""
+        q = grid_cell(lat, lon)
+        return await self._cached(("current", q), CURRENT_TTL, "/current.json", q=q)
+
+    async def forecast(self, q, days=5):
+        return await self._cached(("forecast", normalize_address(q), days), FORECAST_TTL,
+                                  "/forecast.json", q=q, days=days)
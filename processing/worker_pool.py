@@ -0,0 +1,393 @@
+import asyncio
+import concurrent.futures
+import itertools
+import logging
+import math
+import multiprocessing
+import os
+import sys
+import time
+
+import psutil
+
+from processing import metrics
+from processing.spill import SpillStore
+
+logger = logging.getLogger(__name__)
+
+# GPX più grandi di così passano da un file nello spill store invece che dalla pipe
+PIPE_MAX_BYTES = int(os.getenv("PLANNER_PIPE_MAX_BYTES", str(16 * 1024 * 1024)))
+
+# Log condiviso con il bot
+LOG_FILE = os.getenv("LOG_FILE", "bot.log")
+
+
+class PlannerPoolFull(Exception):
+    """Raised when the job queue is full."""
+
+
+class PlannerTimeout(Exception):
+    """Raised when a job exceeds the per-job timeout."""
+
+
+class PlannerError(Exception):
+    """Raised when the worker fails to plan the route."""
+
+
+class PlannerMemoryError(PlannerError):
+    """Raised when the route does not fit in the worker's memory budget."""
+
+
+class PlannerBusy(Exception):
+    """Raised when the user already has a job queued or running."""
+
+
+class PlannerCancelled(Exception):
+    """Raised when the job is cancelled by its user."""
+
+
+def _worker_main(conn):
+    """Entry point of a planner worker: warm up the heavy imports, then serve jobs.
+
+    Every reply carries the metrics recorded during the job, so the parent
+    can expose them; the parent samples the worker's RSS itself.
+    """
+    # Il processo figlio parte senza la configurazione di logging del bot
+    logging.basicConfig(
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        level=logging.INFO,
+        handlers=[
+            logging.FileHandler(LOG_FILE),
+            logging.StreamHandler(sys.stdout)
+        ]
+    )
+    # Le metriche del worker vengono inoltrate al processo principale
+    metrics.registry.forward = True
+    # Import pesanti fatti una sola volta per processo
+    from processing import planner
+    from processing.memory import MemoryBudgetExceeded, MemoryLimitReached
+
+    planner.budget.install()
+    spill = SpillStore()
+
+    def progress(stage, percent):
+        conn.send(("progress", (stage, percent), metrics.registry.drain()))
+
+    conn.send(("ready", None, metrics.registry.drain()))
+    while True:
+        try:
+            job = conn.recv()
+        except EOFError:
+            break
+        if job is None:
+            break
+        try:
+            with metrics.span("planner_job"):
+                result = planner.plan_route(**job, progress=progress)
+            if len(result["gpx"]) > PIPE_MAX_BYTES:
+                result["gpx_file"] = spill.put(result.pop("gpx"), ".gpx")
+            status = "ok"
+        except MemoryLimitReached as e:
+            status, result = "memory", str(e)
+        except MemoryBudgetExceeded as e:
+            # Rifiutato prima di superare il budget: il processo e i grafi in cache restano buoni
+            status, result = "budget", str(e)
+        except MemoryError as e:
+            # Dopo un MemoryError il processo viene sostituito da uno pulito
+            status, result = "memory", str(e)
+        except Exception as e:
+            status, result = "error", str(e)
+        conn.send((status, result, metrics.registry.drain()))
+    planner.candidate_pool.close()
+    conn.close()
+
+
+class _Worker:
+    def __init__(self, ctx):
+        self.conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(target=_worker_main, args=(child_conn,), daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.jobs = 0
+
+    def stop(self, timeout=5):
+        try:
+            self.conn.send(None)
+        except (OSError, BrokenPipeError):
+            pass
+        self.process.join(timeout)
+        if self.process.is_alive():
+            self.kill()
+        self.conn.close()
+
+    def kill(self):
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+
+class PlannerJob:
+    """A route request waiting for, or running on, a planner worker."""
+
+    def __init__(self, params, user, priority, seq, progress=None):
+        self.params = params
+        self.user = user
+        self.priority = priority
+        self.seq = seq
+        self.progress = progress
+        self.future = asyncio.get_running_loop().create_future()
+        self.queued_at = time.monotonic()
+        self.worker = None
+        self.cancelled = False
+        self.ahead = 0
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class PlannerPool:
+    """Fixed pool of long-lived route planner processes.
+
+    Each worker keeps osmnx/networkx imported and recently used graphs loaded.
+    Jobs go through a priority queue of at most queue_size waiting jobs,
+    cancelled ones not counted. A job is ordered by its arrival time plus
+    seconds_per_km per requested km: shorter routes go first, but a long
+    route only yields to the ones that arrived up to that many seconds
+    after it, so it cannot wait forever. Each user can have one job at a
+    time, every job has a timeout and can be cancelled, and workers are
+    recycled after max_jobs_per_worker jobs or once they ran out of memory.
+    Blocking reads from the workers' pipes run on their own threads, one per
+    worker, so they never hold up the loop's default executor.
+    """
+
+    def __init__(self, workers=2, queue_size=8, job_timeout=600, max_jobs_per_worker=20, seconds_per_km=3.0):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.job_timeout = job_timeout
+        self.max_jobs_per_worker = max_jobs_per_worker
+        self.seconds_per_km = seconds_per_km
+        self._ctx = multiprocessing.get_context("spawn")
+        self._queue = None
+        self._slots = []
+        self._workers = {}
+        self._busy = 0
+        self._active = {}
+        # Job in coda non ancora presi da un worker né annullati, e job in esecuzione
+        self._waiting = set()
+        self._running = set()
+        self._stopping = False
+        self._seq = itertools.count()
+        self._spill = None
+        # Thread per le letture bloccanti dalle pipe dei worker, separati dall'executor di default
+        self._pipes = None
+        metrics.registry.collectors.append(self._collect)
+
+    async def start(self):
+        self._spill = SpillStore()
+        # File rimasti da un'esecuzione precedente
+        self._spill.gc()
+        self._pipes = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers,
+                                                            thread_name_prefix="planner-pipe")
+        # Senza limite: la capienza conta solo i job in attesa, non quelli annullati ancora in coda
+        self._queue = asyncio.PriorityQueue()
+        self._slots = [asyncio.create_task(self._run_slot(i)) for i in range(self.workers)]
+        logger.info(f"Planner pool started with {self.workers} workers")
+
+    async def close(self):
+        for _ in self._slots:
+            await self._queue.put((math.inf, next(self._seq), None))
+        await asyncio.gather(*self._slots, return_exceptions=True)
+        self._slots = []
+        self._pipes.shutdown(wait=False)
+
+    def enqueue(self, user=None, progress=None, **params):
+        """Queue a planning job and return it; its future resolves to the result dict.
+
+        progress is an optional coroutine function called with (stage, percent)
+        as the worker reports them. Raises PlannerBusy if user already has a
+        job and PlannerPoolFull if the queue is full.
+        """
+        if self._stopping:
+            metrics.inc("planner_jobs_total", status="rejected")
+            raise PlannerPoolFull("The route planner is shutting down")
+        if user is not None and user in self._active:
+            metrics.inc("planner_jobs_total", status="busy")
+            raise PlannerBusy("A route is already being planned for you")
+        if len(self._waiting) >= self.queue_size:
+            metrics.inc("planner_jobs_total", status="rejected")
+            raise PlannerPoolFull("Too many route requests, try again later")
+        # Invecchiamento: ogni km vale seconds_per_km secondi di attesa in più
+        priority = time.monotonic() + params.get("distance_km", 0) * self.seconds_per_km
+        job = PlannerJob(params, user, priority, next(self._seq), progress)
+        self._queue.put_nowait((job.priority, job.seq, job))
+        self._waiting.add(job)
+        job.future.add_done_callback(lambda _: self._waiting.discard(job))
+
+        job.ahead = sum(1 for other in self._active.values() if other.worker is None and other < job)
+        if user is not None:
+            self._active[user] = job
+            job.future.add_done_callback(lambda _: self._active.pop(user, None))
+        return job
+
+    async def submit(self, user=None, progress=None, **params):
+        """Queue a planning job and wait for its result dict."""
+        return await self.enqueue(user, progress, **params).future
+
+    def cancel(self, user):
+        """Cancel the user's job, killing its worker if it is running. Returns False if there is none."""
+        job = self._active.get(user)
+        if job is None:
+            return False
+        self._cancel(job, "Route planning cancelled")
+        return True
+
+    def stop(self):
+        """Refuse new jobs and cancel every queued and running one, e.g. when the bot shuts down.
+
+        Their futures fail with PlannerCancelled right away instead of keeping
+        the shutdown waiting for them; close() then stops the workers.
+        """
+        self._stopping = True
+        jobs = self._waiting | self._running
+        for job in jobs:
+            self._cancel(job, "Route planning stopped, the bot is restarting")
+        if jobs:
+            logger.info(f"Cancelled {len(jobs)} planner jobs on shutdown")
+
+    def _cancel(self, job, reason):
+        job.cancelled = True
+        if job.worker is not None:
+            logger.info(f"Killing planner worker running the job of user {job.user}")
+            job.worker.process.kill()
+        if not job.future.done():
+            job.future.set_exception(PlannerCancelled(reason))
+
+    async def _report(self, job, stage, percent):
+        try:
+            await job.progress(stage, percent)
+        except Exception as e:
+            logger.warning(f"Progress callback failed: {e}")
+
+    def _collect(self):
+        """Refresh the pool gauges, including the RSS of every live worker."""
+        metrics.set_gauge("planner_queue_depth", len(self._waiting))
+        metrics.set_gauge("planner_busy_workers", self._busy)
+        for slot, worker in list(self._workers.items()):
+            rss = 0
+            if worker is not None and worker.process.is_alive():
+                try:
+                    rss = psutil.Process(worker.process.pid).memory_info().rss
+                except psutil.Error:
+                    pass
+            metrics.set_gauge("planner_worker_current_rss_bytes", rss, slot=slot)
+
+    async def _spawn(self, slot):
+        loop = asyncio.get_running_loop()
+        metrics.inc("planner_worker_spawns_total")
+        with metrics.span("planner_worker_start", slot=slot):
+            worker = _Worker(self._ctx)
+            try:
+                # Attende che gli import pesanti siano completati
+                _, _, events = await loop.run_in_executor(self._pipes, worker.conn.recv)
+            except (EOFError, OSError) as e:
+                logger.error(f"Planner worker {slot} failed to start: {e}")
+                worker.kill()
+                return None
+        metrics.registry.replay(events, slot=slot)
+        self._workers[slot] = worker
+        return worker
+
+    async def _run_slot(self, slot):
+        loop = asyncio.get_running_loop()
+        worker = await self._spawn(slot)
+        try:
+            while True:
+                _, _, job = await self._queue.get()
+                if job is None:
+                    break
+                if job.cancelled or job.future.done():
+                    metrics.inc("planner_jobs_total", status="cancelled")
+                    continue
+                self._waiting.discard(job)
+                self._running.add(job)
+                metrics.observe("planner_queue_wait_seconds", time.monotonic() - job.queued_at)
+
+                self._busy += 1
+                events = []
+                try:
+                    if worker is None or not worker.process.is_alive():
+                        worker = await self._spawn(slot)
+                    if worker is None:
+                        raise EOFError("worker unavailable")
+                    job.worker = worker
+                    worker.conn.send(job.params)
+                    # Il worker invia messaggi di avanzamento prima del risultato finale
+                    deadline = loop.time() + self.job_timeout
+                    while True:
+                        status, result, events = await asyncio.wait_for(
+                            loop.run_in_executor(self._pipes, worker.conn.recv), timeout=max(deadline - loop.time(), 0))
+                        if status != "progress":
+                            break
+                        metrics.registry.replay(events, slot=slot)
+                        events = []
+                        if job.progress is not None and not job.cancelled:
+                            await self._report(job, *result)
+                    worker.jobs += 1
+                except asyncio.TimeoutError:
+                    logger.error(f"Planner worker {slot} timed out after {self.job_timeout}s, killing it")
+                    worker.kill()
+                    worker = None
+                    status, result = "timeout", f"Route planning timed out after {self.job_timeout}s"
+                except (EOFError, OSError) as e:
+                    if worker is not None:
+                        worker.kill()
+                    worker = None
+                    if job.cancelled:
+                        logger.info(f"Planner worker {slot} killed, job cancelled")
+                        status, result = "cancelled", "Route planning cancelled"
+                    else:
+                        logger.error(f"Planner worker {slot} died: {e}")
+                        status, result = "error", "Route planner worker crashed"
+                finally:
+                    self._busy -= 1
+                    job.worker = None
+                    self._running.discard(job)
+
+                metrics.registry.replay(events, slot=slot)
+                metrics.inc("planner_jobs_total", status=status)
+                if status != "ok":
+                    metrics.log("planner_failure", slot=slot, status=status, reason=result,
+                                waited=round(time.monotonic() - job.queued_at, 3))
+
+                if status == "ok" and "gpx_file" in result:
+                    try:
+                        result["gpx"] = await loop.run_in_executor(None, self._spill.take, result.pop("gpx_file"))
+                    except (OSError, ValueError) as e:
+                        status, result = "error", f"Lost the spilled GPX file: {e}"
+
+                future = job.future
+                if not future.done():
+                    if status == "ok":
+                        future.set_result(result)
+                    elif status == "timeout":
+                        future.set_exception(PlannerTimeout(result))
+                    elif status in ("memory", "budget"):
+                        future.set_exception(PlannerMemoryError(result))
+                    elif status == "cancelled":
+                        future.set_exception(PlannerCancelled(result))
+                    else:
+                        future.set_exception(PlannerError(result))
+
+                if worker is not None and (worker.jobs >= self.max_jobs_per_worker or status == "memory"):
+                    logger.info(f"Recycling planner worker {slot} after {worker.jobs} jobs ({status})")
+                    await loop.run_in_executor(self._pipes, worker.stop)
+                    worker = None
+                    metrics.inc("planner_worker_recycles_total")
+
+                # Rimpiazza subito il worker, così il prossimo job lo trova già caldo (non in chiusura)
+                if worker is None and not self._stopping:
+                    worker = await self._spawn(slot)
+        finally:
+            self._workers.pop(slot, None)
+            if worker is not None:
+                await loop.run_in_executor(self._pipes, worker.stop)